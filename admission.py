@@ -0,0 +1,230 @@
+"""Admission control in front of the LLM call.
+
+``AdmissionController.admit(user_id)`` holds one of ``max_concurrent``
+slots for the duration of a chat. Each user is also limited by a token
+bucket (``user_rate`` chats per second, bursts of ``user_burst``). When
+every slot is busy, callers wait in a per-user FIFO queue. Slots are handed
+out round-robin across users, so one user with many queued chats waits
+behind everyone else's next chat rather than in front of it.
+
+A chat is rejected with ``Rejected`` instead of waiting when:
+
+- the user's bucket is empty (``user_rate``),
+- the queue is full, or that user already has ``max_queue_per_user``
+  chats waiting (``queue_full``),
+- no slot frees up within ``max_wait`` seconds (``queue_timeout``).
+
+``Rejected.retry_after`` is a hint in seconds for a ``Retry-After``
+header. Routes turn it into a 429 response.
+
+State is guarded by a thread lock and waiters are woken through their own
+event loop, so one controller can serve several loops (as with Mangum,
+which runs each invocation on the calling thread's loop).
+"""
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Callable, Deque, Dict, Optional
+
+from metrics import admission_rejected_total, current_route, observe
+from rate_limit import TokenBucket
+
+LLM_MAX_CONCURRENT = int(os.environ.get("LLM_MAX_CONCURRENT", "32"))
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", "128"))
+ADMISSION_MAX_QUEUE_PER_USER = int(os.environ.get("ADMISSION_MAX_QUEUE_PER_USER", "2"))
+ADMISSION_MAX_WAIT = float(os.environ.get("ADMISSION_MAX_WAIT", "10"))
+USER_RATE_PER_MINUTE = float(os.environ.get("USER_RATE_PER_MINUTE", "20"))
+USER_BURST = float(os.environ.get("USER_BURST", "5"))
+# Buckets of users idle long enough to be full again are dropped past this many
+MAX_TRACKED_USERS = 10000
+
+
+class Rejected(Exception):
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(f"Too many requests ({reason}); retry in {math.ceil(retry_after)}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def headers(self) -> Dict[str, str]:
+        return {"Retry-After": str(max(1, math.ceil(self.retry_after)))}
+
+
+class _Waiter:
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+        self.granted = False
+
+    def wake(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class AdmissionController:
+    def __init__(self, max_concurrent: int = LLM_MAX_CONCURRENT, max_queue: int = ADMISSION_MAX_QUEUE,
+                 max_queue_per_user: int = ADMISSION_MAX_QUEUE_PER_USER, max_wait: float = ADMISSION_MAX_WAIT,
+                 user_rate: float = USER_RATE_PER_MINUTE / 60, user_burst: float = USER_BURST):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_queue_per_user = max_queue_per_user
+        self.max_wait = max_wait
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self._lock = threading.Lock()
+        self._active = 0
+        # Users with waiting chats, in the order they are next served
+        self._queues: "OrderedDict[str, Deque[_Waiter]]" = OrderedDict()
+        self._queued = 0
+        self._buckets: Dict[str, TokenBucket] = {}
+        # Moving average of how long a slot is held, for Retry-After hints
+        self._hold_avg = 1.0
+        self.admitted = 0
+        self.waited = 0
+        self.rejected: Dict[str, int] = {}
+
+    def _bucket(self, user_id: str) -> TokenBucket:
+        with self._lock:
+            bucket = self._buckets.get(user_id)
+            if bucket is None:
+                if len(self._buckets) >= MAX_TRACKED_USERS:
+                    self._prune_buckets()
+                bucket = self._buckets[user_id] = TokenBucket(self.user_rate, self.user_burst)
+            return bucket
+
+    def _prune_buckets(self):
+        idle = self.user_burst / self.user_rate
+        now = time.monotonic()
+        for user_id in [u for u, b in self._buckets.items() if now - b.updated > idle]:
+            del self._buckets[user_id]
+
+    def _reject(self, reason: str, retry_after: float):
+        with self._lock:
+            self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        admission_rejected_total.inc(reason, current_route())
+        raise Rejected(reason, retry_after)
+
+    def _queue_hint(self) -> float:
+        # Roughly how long until the current queue has drained
+        return self._hold_avg * (self._queued + 1) / self.max_concurrent
+
+    def check_user(self, user_id: str):
+        """Apply ``user_id``'s own limits without taking a slot; raises ``Rejected``.
+
+        A call shared by several users (see ``single_flight``) checks the
+        caller that starts it here, then takes its slot with
+        ``user_limits=False``, so a rejection inside the shared call is
+        never one user's own.
+        """
+        wait = self._bucket(user_id).try_acquire()
+        if wait:
+            self._reject("user_rate", wait)
+        with self._lock:
+            queue = self._queues.get(user_id)
+            full = queue is not None and len(queue) >= self.max_queue_per_user
+            hint = self._queue_hint()
+        if full:
+            self._reject("queue_full", hint)
+
+    async def acquire(self, user_id: str, user_limits: bool = True) -> Callable[[], None]:
+        """Take a slot for ``user_id``, waiting in the fair queue if needed; raises ``Rejected``.
+
+        Returns the function that gives the slot back (safe to call twice).
+        ``user_limits=False`` skips the checks in ``check_user``.
+        """
+        if user_limits:
+            self.check_user(user_id)
+        with self._lock:
+            if self._active < self.max_concurrent and not self._queued:
+                self._active += 1
+                self.admitted += 1
+                return self._releaser()
+            full = self._queued >= self.max_queue
+            if not full:
+                waiter = _Waiter(user_id)
+                self._queues.setdefault(user_id, deque()).append(waiter)
+                self._queued += 1
+            hint = self._queue_hint()
+        if full:
+            self._reject("queue_full", hint)
+
+        start = time.perf_counter()
+        try:
+            await asyncio.wait({waiter.future}, timeout=self.max_wait)
+        except BaseException:
+            # Cancelled while waiting (e.g. the client went away): leave the
+            # queue, or pass on a slot that was granted in the meantime
+            if not self._withdraw(waiter):
+                self.release()
+            raise
+        finally:
+            observe("admission_wait", time.perf_counter() - start)
+        # A slot granted just as the wait timed out is still taken
+        if self._withdraw(waiter):
+            self._reject("queue_timeout", self._queue_hint())
+        with self._lock:
+            self.admitted += 1
+            self.waited += 1
+        return self._releaser()
+
+    def _withdraw(self, waiter: _Waiter) -> bool:
+        """Take ``waiter`` out of the queue unless it was granted a slot; True if withdrawn."""
+        with self._lock:
+            if waiter.granted:
+                return False
+            queue = self._queues.get(waiter.user_id)
+            if queue is not None and waiter in queue:
+                queue.remove(waiter)
+                self._queued -= 1
+                if not queue:
+                    del self._queues[waiter.user_id]
+            return True
+
+    def release(self, held: Optional[float] = None):
+        """Free a slot, handing it straight to the next user in turn if any are waiting."""
+        with self._lock:
+            if held is not None:
+                self._hold_avg += 0.1 * (held - self._hold_avg)
+            while self._queues:
+                user_id, queue = next(iter(self._queues.items()))
+                waiter = queue.popleft()
+                self._queued -= 1
+                if queue:
+                    self._queues.move_to_end(user_id)
+                else:
+                    del self._queues[user_id]
+                try:
+                    waiter.loop.call_soon_threadsafe(waiter.wake)
+                except RuntimeError:  # its event loop has closed
+                    continue
+                waiter.granted = True
+                return
+            self._active -= 1
+
+    def _releaser(self) -> Callable[[], None]:
+        start = time.monotonic()
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self.release(time.monotonic() - start)
+        return release
+
+    @asynccontextmanager
+    async def admit(self, user_id: str, user_limits: bool = True):
+        release = await self.acquire(user_id, user_limits)
+        try:
+            yield
+        finally:
+            release()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"active": self._active, "queued": self._queued, "max_concurrent": self.max_concurrent,
+                    "admitted": self.admitted, "waited": self.waited, "rejected": dict(self.rejected)}
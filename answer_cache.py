@@ -0,0 +1,187 @@
+"""Shared answer cache for repeated and near-identical questions.
+
+Questions are normalized (case, punctuation, whitespace) and looked up
+exactly first. Otherwise MinHash signatures over character shingles find
+candidate entries through LSH buckets, and a candidate counts as a hit when
+the Jaccard similarity of the shingle sets reaches ``threshold`` and the
+two questions differ only in wording (see ``same_meaning``). Character
+overlap alone cannot tell "step 1" from "step 2" or "UK" from "USA".
+Entries expire after ``ttl`` seconds and the least recently used entry is
+evicted once ``max_entries`` is reached. Everything is local; no embedding
+service.
+"""
+import random
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict, defaultdict
+from typing import Dict, FrozenSet, List, Optional, Sequence, Tuple
+
+_PUNCT = re.compile(r"[^\w\s]")
+_SPACES = re.compile(r"\s+")
+_PRIME = (1 << 61) - 1
+
+# Words that change what a question is about: a near-duplicate must name
+# the same ones, in the same order. Words containing digits (step 1, h1b,
+# top 10) always count, and so do question words (see QUESTION_WORDS).
+ENTITIES = frozenset("""
+    usa us america american uk britain british england canada canadian australia australian ireland
+    germany german france uae dubai singapore newzealand zealand india indian nepal nepali pakistan
+    pakistani bangladesh bangladeshi sri lanka china chinese philippines egypt nigeria iran caribbean
+    california texas florida newyork york illinois michigan ohio pennsylvania massachusetts boston
+    chicago
+    usmle plab amc mccqe neet fmge nclex mcat toefl ielts oet ecfmg eras nrmp ck cs pg
+    visa j1 h1b f1 b1 b2 o1 greencard
+    dermatology dermo derm cardiology cardio neurology neuro surgery pediatrics psychiatry radiology
+    oncology anesthesia anesthesiology orthopedics ortho gynecology obgyn pathology emergency family
+    internal medicine
+    md mbbs dnb phd mph
+""".split())
+# Question words set the intent ("why X" is not "how X"), so they are key
+# terms too
+QUESTION_WORDS = frozenset("what which who whom whose when where why how".split())
+# Politeness and address that may differ between near-duplicates without
+# changing the question
+FILLER = frozenset(
+    "a an the please pls plz kindly hey hi hello dear sir maam can could would you u tell me just "
+    "also so".split()
+)
+# Other differing words must be misspellings of each other, this close in character bigrams
+MISSPELLING = 0.5
+
+
+def normalize_question(text: str) -> str:
+    return _SPACES.sub(" ", _PUNCT.sub(" ", text.lower())).strip()
+
+
+def shingles(text: str, size: int = 3) -> FrozenSet[str]:
+    if len(text) <= size:
+        return frozenset([text])
+    return frozenset(text[i:i + size] for i in range(len(text) - size + 1))
+
+
+def jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def key_terms(words: Sequence[str]) -> Tuple[str, ...]:
+    return tuple(w for w in words if w in ENTITIES or w in QUESTION_WORDS or any(c.isdigit() for c in w))
+
+
+def _misspelled(word: str, others) -> bool:
+    grams = shingles(word, 2)
+    return any(len(word) >= 4 and len(other) >= 4 and jaccard(grams, shingles(other, 2)) >= MISSPELLING
+               for other in others)
+
+
+def same_meaning(a: Sequence[str], b: Sequence[str]) -> bool:
+    """Whether two normalized questions, as word lists, differ only in wording.
+
+    They must name the same key terms and question words in the same
+    order, and every other word only one of them has must be politeness
+    filler or a misspelling of a word only the other has.
+    """
+    if key_terms(a) != key_terms(b):
+        return False
+    only_a = set(a) - set(b) - FILLER
+    only_b = set(b) - set(a) - FILLER
+    return all(_misspelled(w, only_b) for w in only_a) and all(_misspelled(w, only_a) for w in only_b)
+
+
+class AnswerCache:
+    """Thread-safe TTL + LRU cache with MinHash near-duplicate matching."""
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 24 * 3600,
+                 threshold: float = 0.8, bands: int = 16, rows: int = 4):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = rows
+        rng = random.Random(0)
+        self._coeffs = [(rng.randrange(1, _PRIME), rng.randrange(0, _PRIME)) for _ in range(bands * rows)]
+        # normalized question -> (answer, shingles, band keys, stored_at, words)
+        self._entries: "OrderedDict[str, Tuple[str, FrozenSet[str], List[Tuple], float, List[str]]]" = OrderedDict()
+        self._buckets: Dict[Tuple, set] = defaultdict(set)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _band_keys(self, grams: FrozenSet[str]) -> List[Tuple]:
+        hashes = [zlib.crc32(g.encode("utf-8")) for g in grams]
+        signature = [min((a * h + b) % _PRIME for h in hashes) for a, b in self._coeffs]
+        return [(band, tuple(signature[band * self.rows:(band + 1) * self.rows])) for band in range(self.bands)]
+
+    def _remove(self, key: str):
+        band_keys = self._entries.pop(key)[2]
+        for band_key in band_keys:
+            bucket = self._buckets[band_key]
+            bucket.discard(key)
+            if not bucket:
+                del self._buckets[band_key]
+
+    def _live(self, key: str, now: float) -> bool:
+        if now - self._entries[key][3] > self.ttl:
+            self._remove(key)
+            return False
+        return True
+
+    def get(self, question: str) -> Optional[str]:
+        """Return a cached answer for this or a near-identical question."""
+        key = normalize_question(question)
+        now = time.time()
+        with self._lock:
+            if key in self._entries and self._live(key, now):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            grams = shingles(key)
+            words = key.split()
+            best, best_score = None, self.threshold
+            candidates = set()
+            for band_key in self._band_keys(grams):
+                candidates |= self._buckets.get(band_key, set())
+            for candidate in candidates:
+                if not self._live(candidate, now):
+                    continue
+                score = jaccard(grams, self._entries[candidate][1])
+                if score >= best_score and same_meaning(words, self._entries[candidate][4]):
+                    best, best_score = candidate, score
+            if best is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best)
+            self.hits += 1
+            self.near_hits += 1
+            return self._entries[best][0]
+
+    def put(self, question: str, answer: str):
+        key = normalize_question(question)
+        grams = shingles(key)
+        band_keys = self._band_keys(grams)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            while len(self._entries) >= self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+            self._entries[key] = (answer, grams, band_keys, time.time(), key.split())
+            for band_key in band_keys:
+                self._buckets[band_key].add(key)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "near_hits": self.near_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
@@ -0,0 +1,166 @@
+"""Answer a JSONL file of questions in bulk, resumably.
+
+Questions are streamed from the input file and answered by a bounded pool
+of asyncio workers, using the same ``llm.agenerate_answer`` as ``/chat``,
+behind a token bucket so the upstream rate limit is respected. A blocking
+``answer_fn`` runs on a thread pool of ``--workers`` threads instead, so
+``--workers`` is the real concurrency either way. Every result
+is appended to the output file as soon as it is ready, and that file is the
+checkpoint: rerunning the same command skips ids already answered.
+
+    python batch_answer.py questions.jsonl answers.jsonl --workers 32 --rate 10
+    python batch_answer.py questions.jsonl answers.jsonl --fake-llm-latency 0.2
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, Set, Tuple
+
+from rate_limit import TokenBucket
+
+
+def read_questions(path: str, question_field: str, id_field: str) -> Iterator[Tuple[str, Dict]]:
+    """Yield ``(id, record)`` pairs; records without an id use their line number."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if not record.get(question_field):
+                continue
+            yield str(record.get(id_field, line_no)), record
+
+
+def completed_ids(path: str, retry_errors: bool) -> Set[str]:
+    """Ids already present in a previous run's output."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue  # a line cut short by a crash
+            if not (retry_errors and "error" in result):
+                done.add(result["id"])
+    return done
+
+
+async def run_batch(input_path: str, output_path: str, answer_fn: Callable,
+                    workers: int = 16, rate: float = 5.0, burst: float = None,
+                    question_field: str = "question", id_field: str = "id",
+                    retry_errors: bool = False, save: Callable = None, user_field: str = None,
+                    progress_every: int = 100) -> Dict:
+    skip = completed_ids(output_path, retry_errors)
+    bucket = TokenBucket(rate, burst)
+    queue = asyncio.Queue(maxsize=workers * 2)
+    stats = {"skipped": 0, "answered": 0, "failed": 0}
+    started = time.monotonic()
+    loop = asyncio.get_running_loop()
+    # asyncio.to_thread would share the default executor, capped near 32 threads
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch")
+
+    async def ask(question: str) -> str:
+        if asyncio.iscoroutinefunction(answer_fn):
+            return await answer_fn(question)
+        return await loop.run_in_executor(executor, answer_fn, question)
+
+    with executor, open(output_path, "a", encoding="utf-8") as out:
+        def write(result: Dict):
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+            done = stats["answered"] + stats["failed"]
+            if progress_every and done % progress_every == 0:
+                elapsed = time.monotonic() - started
+                print(f"{done} done, {done / elapsed:.1f}/s", file=sys.stderr)
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                record_id, record = item
+                question = record[question_field]
+                await bucket.acquire()
+                start = time.monotonic()
+                try:
+                    answer = await ask(question)
+                except Exception as e:
+                    stats["failed"] += 1
+                    write({"id": record_id, "question": question, "error": str(e)})
+                    continue
+                latency_ms = round(1000 * (time.monotonic() - start), 1)
+                if save and user_field and record.get(user_field):
+                    await loop.run_in_executor(executor, save, record[user_field], question, answer)
+                stats["answered"] += 1
+                write({"id": record_id, "question": question, "answer": answer, "latency_ms": latency_ms})
+
+        tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+        # The bounded queue keeps only a few records in memory however large the input
+        for record_id, record in read_questions(input_path, question_field, id_field):
+            if record_id in skip:
+                stats["skipped"] += 1
+                continue
+            await queue.put((record_id, record))
+        for _ in tasks:
+            await queue.put(None)
+        await asyncio.gather(*tasks)
+
+    stats["seconds"] = round(time.monotonic() - started, 2)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("input", help="JSONL file with one question per line")
+    parser.add_argument("output", help="JSONL results file, appended to and used to resume")
+    parser.add_argument("--workers", type=int, default=16, help="Concurrent LLM calls")
+    parser.add_argument("--rate", type=float, default=5.0, help="Requests per second")
+    parser.add_argument("--burst", type=float, default=None, help="Token bucket capacity")
+    parser.add_argument("--question-field", default="question")
+    parser.add_argument("--id-field", default="id")
+    parser.add_argument("--retry-errors", action="store_true", help="Re-ask questions that failed last time")
+    parser.add_argument("--save-user-field", default=None,
+                        help="Also save each answer to the chat history of the user named in this field")
+    parser.add_argument("--fake-llm-latency", type=float, default=None,
+                        help="Answer with fakes.FakeLLM at this latency instead of OpenAI")
+    args = parser.parse_args()
+
+    if args.fake_llm_latency is not None:
+        from fakes import FakeLLM
+        answer_fn = FakeLLM(latency=args.fake_llm_latency).agenerate_answer
+    else:
+        import llm
+        answer_fn = llm.agenerate_answer
+
+    save = None
+    if args.save_user_field:
+        from history_search import HistorySearch
+        from storage import get_storage, get_summary, make_record
+        from write_behind import WriteBehindQueue
+        storage = get_storage()
+        # Stored the way /chat stores turns (compaction when due, search index
+        # updates), but before the result is written, so a resumed run never
+        # skips a question whose turn was lost
+        writer = WriteBehindQueue(storage)
+        writer.add_listener(HistorySearch(storage, storage.load_chat_history).index_records)
+
+        def save(user_id, question, answer):
+            writer.write_now(user_id, [make_record(get_summary(question), question, answer)])
+
+    stats = asyncio.run(run_batch(
+        args.input, args.output, answer_fn,
+        workers=args.workers, rate=args.rate, burst=args.burst,
+        question_field=args.question_field, id_field=args.id_field,
+        retry_errors=args.retry_errors, save=save, user_field=args.save_user_field,
+    ))
+    print(json.dumps(stats))
+
+
+if __name__ == "__main__":
+    main()
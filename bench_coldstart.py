@@ -0,0 +1,123 @@
+"""Profile Lambda cold starts of ``lambda_function``.
+
+Each run starts a fresh interpreter with ``-X importtime``, imports the
+handler module (the Lambda init phase) and sends it one API Gateway event
+(the first request), like a new container would. Prints one JSON line per
+run and a summary with the median init and first-request times and the
+packages that cost the most to import:
+
+    python bench_coldstart.py --runs 5 --path /change-user
+    python bench_coldstart.py --prewarm off init background
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+from typing import Dict, List
+
+_CHILD = r"""
+import json, sys, time
+start = time.perf_counter()
+import lambda_function
+init = time.perf_counter() - start
+event = json.loads(sys.argv[1])
+start = time.perf_counter()
+response = lambda_function.handler(event, None)
+first = time.perf_counter() - start
+print(json.dumps({"init_ms": round(1000 * init, 1), "first_request_ms": round(1000 * first, 1),
+                  "status": response["statusCode"]}))
+"""
+
+
+def make_event(method: str, path: str, body: Dict) -> Dict:
+    return {
+        "version": "2.0",
+        "routeKey": "$default",
+        "rawPath": path,
+        "rawQueryString": "",
+        "headers": {"content-type": "application/json", "host": "coldstart.local"},
+        "requestContext": {
+            "http": {"method": method, "path": path, "protocol": "HTTP/1.1", "sourceIp": "127.0.0.1"},
+            "stage": "$default",
+        },
+        "body": json.dumps(body) if body else "",
+        "isBase64Encoded": False,
+    }
+
+
+def parse_importtime(stderr: str) -> Dict[str, float]:
+    """Self import time in ms per top-level package, from ``-X importtime`` output."""
+    totals = defaultdict(float)
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            self_us = int(fields[0])
+        except ValueError:
+            continue  # the header line
+        totals[fields[2].strip().split(".")[0]] += self_us / 1000
+    return totals
+
+
+def run_once(event: Dict, prewarm: str, cwd: str) -> Dict:
+    env = {**os.environ, "PREWARM_CLIENTS": prewarm}
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _CHILD, json.dumps(event)],
+        cwd=cwd, env=env, capture_output=True, text=True, check=False,
+    )
+    lines = [line for line in proc.stdout.splitlines() if line.startswith("{")]
+    if proc.returncode or not lines:
+        raise RuntimeError(f"Cold start run failed:\n{proc.stderr[-2000:]}")
+    result = json.loads(lines[-1])
+    result["imports_ms"] = parse_importtime(proc.stderr)
+    return result
+
+
+def summarize(prewarm: str, path: str, runs: List[Dict], top: int) -> Dict:
+    packages = defaultdict(list)
+    for run in runs:
+        for name, ms in run["imports_ms"].items():
+            packages[name].append(ms)
+    heaviest = sorted(((statistics.median(v), k) for k, v in packages.items()), reverse=True)[:top]
+    return {
+        "summary": True,
+        "prewarm": prewarm,
+        "path": path,
+        "runs": len(runs),
+        "init_ms_median": statistics.median(r["init_ms"] for r in runs),
+        "first_request_ms_median": statistics.median(r["first_request_ms"] for r in runs),
+        "import_ms_median": statistics.median(sum(r["imports_ms"].values()) for r in runs),
+        "heaviest_imports_ms": {name: round(ms, 1) for ms, name in heaviest},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--method", default="POST")
+    parser.add_argument("--path", default="/change-user")
+    parser.add_argument("--body", default='{"current_user_id": "a", "new_user_id": "b"}',
+                        help="JSON request body for the first request")
+    parser.add_argument("--prewarm", nargs="+", choices=("off", "background", "init"), default=["off", "background"],
+                        help="PREWARM_CLIENTS settings to compare")
+    parser.add_argument("--top", type=int, default=15, help="How many packages to list")
+    args = parser.parse_args()
+
+    event = make_event(args.method, args.path, json.loads(args.body) if args.body else None)
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    for prewarm in args.prewarm:
+        runs = []
+        for _ in range(args.runs):
+            run = run_once(event, prewarm, cwd)
+            runs.append(run)
+            print(json.dumps({"prewarm": prewarm, "path": args.path, "init_ms": run["init_ms"],
+                              "first_request_ms": run["first_request_ms"], "status": run["status"]}))
+        print(json.dumps(summarize(prewarm, args.path, runs, args.top)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Compare history snapshot formats on stored history files.
+
+For each file (by default the ``*.json`` histories next to this script),
+and for a longer history built by repeating its turns ``--grow-to`` times,
+prints one JSON line per format. Each line gives the encoded size, its
+ratio to compact JSON, and the mean encode and decode times:
+
+    python bench_history_format.py
+    python bench_history_format.py navneet1.json --grow-to 500 --repeat 200
+
+The formats compared are JSON pretty-printed as the local backend used to
+write it, compact JSON as S3 stores it, and ``history_codec`` with zlib
+(plus zstd when the ``zstandard`` package is installed).
+"""
+import argparse
+import glob
+import json
+import os
+import time
+from typing import Callable, Dict, List, Tuple
+
+import history_codec
+
+
+def formats() -> List[Tuple[str, Callable[[Dict], bytes], Callable[[bytes], Dict]]]:
+    result = [
+        ("json_indent", lambda chats: json.dumps(chats, indent=2).encode("utf-8"), history_codec.loads),
+        ("json", lambda chats: json.dumps(chats).encode("utf-8"), history_codec.loads),
+        ("binary_zlib", lambda chats: history_codec.dumps(chats, history_codec.ZLIB), history_codec.loads),
+    ]
+    try:
+        import zstandard  # noqa: F401
+        result.append(("binary_zstd", lambda chats: history_codec.dumps(chats, history_codec.ZSTD),
+                       history_codec.loads))
+    except ImportError:
+        pass
+    return result
+
+
+def grow(chats: Dict, turns: int) -> Dict:
+    """A ``turns``-long history that reuses the stored turns in order."""
+    items = list(chats.values())
+    return {f"turn_{i}": dict(items[i % len(items)]) for i in range(turns)}
+
+
+def mean_ms(fn: Callable, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return round(1000 * (time.perf_counter() - start) / repeat, 4)
+
+
+def measure(name: str, chats: Dict, repeat: int) -> List[Dict]:
+    results = []
+    baseline = len(json.dumps(chats).encode("utf-8"))
+    for fmt, encode, decode in formats():
+        data = encode(chats)
+        assert decode(data) == chats, (name, fmt)
+        results.append({
+            "history": name,
+            "turns": len(chats),
+            "format": fmt,
+            "bytes": len(data),
+            "ratio_vs_json": round(len(data) / baseline, 3),
+            "encode_ms": mean_ms(lambda: encode(chats), repeat),
+            "decode_ms": mean_ms(lambda: decode(data), repeat),
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser.add_argument("files", nargs="*", help="History files (default: *.json next to this script)")
+    parser.add_argument("--grow-to", type=int, default=200,
+                        help="Also measure each history repeated to this many turns (0 to skip)")
+    parser.add_argument("--repeat", type=int, default=100, help="Timing iterations per measurement")
+    args = parser.parse_args()
+
+    for path in args.files or sorted(glob.glob(os.path.join(here, "*.json"))):
+        with open(path, "rb") as f:
+            chats = history_codec.loads(f.read())
+        name = os.path.basename(path)
+        for result in measure(name, chats, args.repeat):
+            print(json.dumps(result))
+        if args.grow_to and chats:
+            for result in measure(f"{name}*{args.grow_to}", grow(chats, args.grow_to), args.repeat):
+                print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+"""Load-test the API end to end against local stand-ins.
+
+The app in ``lambda_function`` is driven through the Mangum handler (one
+API Gateway event per request) or through uvicorn over HTTP, at each of
+the given concurrency levels and seeded history sizes. OpenAI calls go to
+a ``FakeOpenAIServer`` through the real client, and storage is S3Storage
+on a ``FakeS3Client``, so no network access or credentials are needed.
+
+One JSON line is printed per (target, scenario, history size, concurrency)
+with throughput, latency percentiles, bytes on the wire and S3 calls and
+bytes per request:
+
+    python bench_load.py --target mangum uvicorn --concurrency 1 8 32 --history-turns 10 500
+    python bench_load.py --out run.jsonl --baseline main.jsonl --max-regression 0.25
+
+With ``--baseline``, the exit status is non-zero if any p95 latency or
+S3 bytes-per-request figure is more than ``--max-regression`` worse.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+from urllib.parse import urlencode
+
+from fakes import FakeOpenAIServer, FakeS3Client
+
+SCENARIOS = ("chat", "chat_stream", "history", "history_page", "active_users")
+BUCKET = "bench-bucket"
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    rank = max(0, math.ceil(pct / 100 * len(sorted_values)) - 1)
+    return sorted_values[rank]
+
+
+def build_request(scenario: str, n: int, users: int) -> Tuple[str, str, Dict, bytes]:
+    """``(method, path, query, body)`` for the ``n``-th request of a scenario."""
+    user_id = f"bench_user_{n % users}"
+    if scenario in ("chat", "chat_stream"):
+        # Near-identical questions would be answer-cache hits; bypass it so every request reaches the LLM
+        body = json.dumps({"user_id": user_id, "question": f"How do I prepare for role {n}?",
+                           "bypass_cache": True}).encode("utf-8")
+        return "POST", "/chat" if scenario == "chat" else "/chat/stream", {}, body
+    if scenario == "history":
+        return "GET", f"/get-history/{user_id}", {}, b""
+    if scenario == "history_page":
+        return "GET", f"/get-history/{user_id}", {"limit": 20}, b""
+    if scenario == "active_users":
+        return "GET", "/get-active-users", {"limit": 50}, b""
+    raise ValueError(f"Unknown scenario {scenario!r}")
+
+
+class MangumTarget:
+    """Calls ``lambda_function.handler`` with API Gateway HTTP API events.
+
+    Concurrent calls share one warm module, so this measures the handler
+    itself rather than Lambda scaling.
+    """
+
+    name = "mangum"
+
+    def __init__(self, app_module):
+        self.app = app_module
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def init_worker(self):
+        # Mangum runs each invocation on the calling thread's event loop
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+    def request(self, method: str, path: str, query: Dict, body: bytes) -> Tuple[int, bytes]:
+        event = {
+            "version": "2.0",
+            "routeKey": "$default",
+            "rawPath": path,
+            "rawQueryString": urlencode(query),
+            "headers": {"content-type": "application/json", "host": "bench.local"},
+            "requestContext": {
+                "http": {"method": method, "path": path, "protocol": "HTTP/1.1", "sourceIp": "127.0.0.1"},
+                "stage": "$default",
+            },
+            "body": body.decode("utf-8"),
+            "isBase64Encoded": False,
+        }
+        response = self.app.handler(event, None)
+        return response["statusCode"], (response.get("body") or "").encode("utf-8")
+
+
+class UvicornTarget:
+    """Serves the app with uvicorn on a free local port and calls it over HTTP."""
+
+    name = "uvicorn"
+
+    def __init__(self, app_module, concurrency: int):
+        self.app = app_module
+        self.concurrency = concurrency
+        self.server = None
+        self.client = None
+
+    def start(self):
+        import httpx
+        import uvicorn
+
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        self.server = uvicorn.Server(uvicorn.Config(self.app.app, host="127.0.0.1", port=port, log_level="warning"))
+        threading.Thread(target=self.server.run, name="uvicorn", daemon=True).start()
+        deadline = time.monotonic() + 10
+        while not self.server.started:
+            if time.monotonic() > deadline:
+                raise RuntimeError("uvicorn did not start")
+            time.sleep(0.05)
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        self.client = httpx.Client(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=60)
+
+    def stop(self):
+        self.client.close()
+        self.server.should_exit = True
+
+    def init_worker(self):
+        pass
+
+    def request(self, method: str, path: str, query: Dict, body: bytes) -> Tuple[int, bytes]:
+        response = self.client.request(method, path, params=query, content=body or None,
+                                       headers={"Content-Type": "application/json"})
+        return response.status_code, response.content
+
+
+def load_app(data_dir: str):
+    """Import ``lambda_function`` and wire it to a fresh in-memory S3."""
+    # Keep import-time side effects local: file storage and a throwaway FAQ index
+    os.environ.setdefault("CHAT_STORAGE", "file")
+    os.environ.setdefault("CHAT_DATA_DIR", data_dir)
+    os.environ.setdefault("FAQ_INDEX_PATH", os.path.join(data_dir, "faq_index.bin"))
+    # A few simulated users send every request, so per-user rate limits are
+    # off unless set explicitly; the global concurrency limit still applies
+    os.environ.setdefault("USER_RATE_PER_MINUTE", "1e9")
+    os.environ.setdefault("USER_BURST", "1e9")
+    os.environ.setdefault("ADMISSION_MAX_QUEUE_PER_USER", "1000000")
+    import lambda_function
+    return lambda_function
+
+
+def reset_storage(app_module, history_turns: int, users: int, payloads) -> FakeS3Client:
+    from event_log import S3SegmentSink
+    from storage import S3Storage
+
+    s3 = FakeS3Client()
+    storage = S3Storage(BUCKET, client=s3)
+    for user in range(users):
+        user_id = f"bench_user_{user}"
+        turns = [payloads[t % len(payloads)] for t in range(history_turns)]
+        for start in range(0, len(turns), 50):
+            records = [{"title": f"turn_{start + i}", "question": q, "answer": a}
+                       for i, (q, a) in enumerate(turns[start:start + 50])]
+            storage.save_chats(user_id, records)
+        if storage.needs_compaction(user_id):
+            storage.compact(user_id)
+    app_module.write_queue.flush()
+    app_module.events.flush()
+    app_module.storage = storage
+    app_module.write_queue.storage = storage
+    app_module.summarizer.storage = storage
+    app_module.history_search.storage = storage
+    app_module.event_sink = app_module.events.sink = S3SegmentSink(s3, BUCKET)
+    return s3
+
+
+def run_scenario(target, scenario: str, concurrency: int, requests: int, users: int,
+                 app_module, s3: FakeS3Client) -> Dict:
+    latencies, sizes, errors = [], [], 0
+    request_bytes = 0
+    lock = threading.Lock()
+
+    def one(n: int):
+        nonlocal errors, request_bytes
+        method, path, query, body = build_request(scenario, n, users)
+        start = time.perf_counter()
+        try:
+            status, content = target.request(method, path, query, body)
+            # Routes report failures as {"error": ...} with a 200
+            ok = status < 400 and not content.startswith(b'{"error"') and b"event: error" not in content
+        except Exception:
+            content, ok = b"", False
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            sizes.append(len(content))
+            request_bytes += len(body)
+            if not ok:
+                errors += 1
+
+    s3.reset_counters()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency, initializer=target.init_worker) as pool:
+        list(pool.map(one, range(requests)))
+    wall = time.perf_counter() - started
+    # Writes queued by the requests count towards this scenario's S3 traffic
+    app_module.write_queue.flush()
+    app_module.events.flush()
+
+    latencies.sort()
+    return {
+        "target": target.name,
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": errors,
+        "throughput_rps": round(requests / wall, 2),
+        "p50_ms": round(1000 * percentile(latencies, 50), 3),
+        "p95_ms": round(1000 * percentile(latencies, 95), 3),
+        "p99_ms": round(1000 * percentile(latencies, 99), 3),
+        "request_bytes_avg": round(request_bytes / requests, 1),
+        "response_bytes_avg": round(sum(sizes) / requests, 1),
+        "s3_calls_per_request": round(sum(s3.calls.values()) / requests, 3),
+        "s3_bytes_in_per_request": round(s3.bytes_in / requests, 1),
+        "s3_bytes_out_per_request": round(s3.bytes_out / requests, 1),
+    }
+
+
+def result_key(result: Dict) -> Tuple:
+    return (result["target"], result["scenario"], result["history_turns"], result["concurrency"])
+
+
+def compare(results: List[Dict], baseline_path: str, max_regression: float) -> List[str]:
+    with open(baseline_path, "r") as f:
+        baseline = {result_key(r): r for r in map(json.loads, f) if "scenario" in r}
+    regressions = []
+    for result in results:
+        base = baseline.get(result_key(result))
+        if base is None:
+            continue
+        for metric in ("p95_ms", "s3_bytes_out_per_request", "s3_bytes_in_per_request"):
+            if base[metric] and result[metric] > base[metric] * (1 + max_regression):
+                regressions.append(f"{result_key(result)} {metric}: {base[metric]} -> {result[metric]}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--target", nargs="+", choices=("mangum", "uvicorn"), default=["mangum", "uvicorn"])
+    parser.add_argument("--scenario", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--history-turns", nargs="+", type=int, default=[10, 200])
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario and level")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="Seconds per fake completion")
+    parser.add_argument("--llm-tokens", type=int, default=200, help="Words per fake completion")
+    parser.add_argument("--s3-latency", type=float, default=0.0, help="Simulated seconds per fake S3 call")
+    parser.add_argument("--sample", default=os.path.join(os.path.dirname(__file__), "navneet1.json"),
+                        help="History file whose turns seed the histories")
+    parser.add_argument("--out", default=None, help="Also append the JSON lines to this file")
+    parser.add_argument("--baseline", default=None, help="Earlier --out file to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    args = parser.parse_args()
+
+    from bench_storage import sample_turns
+    payloads = sample_turns(args.sample)
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp, FakeOpenAIServer(args.llm_latency, tokens=args.llm_tokens) as llm_server:
+        # Read by the OpenAI clients, which llm creates on first use
+        os.environ["OPENAI_BASE_URL"] = llm_server.url
+        os.environ["OPENAI_API_KEY"] = "fake"
+        app_module = load_app(tmp)
+
+        for history_turns in args.history_turns:
+            for target_name in args.target:
+                for concurrency in args.concurrency:
+                    s3 = reset_storage(app_module, history_turns, args.users, payloads)
+                    s3.latency = args.s3_latency
+                    target = (MangumTarget(app_module) if target_name == "mangum"
+                              else UvicornTarget(app_module, concurrency))
+                    target.start()
+                    try:
+                        for scenario in args.scenario:
+                            result = run_scenario(target, scenario, concurrency, args.requests,
+                                                  args.users, app_module, s3)
+                            result["history_turns"] = history_turns
+                            result["llm_latency_ms"] = round(1000 * args.llm_latency, 1)
+                            result["s3_latency_ms"] = round(1000 * args.s3_latency, 1)
+                            results.append(result)
+                            line = json.dumps(result)
+                            print(line, flush=True)
+                            if args.out:
+                                with open(args.out, "a") as f:
+                                    f.write(line + "\n")
+                    finally:
+                        target.stop()
+
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""Check the LLM call policy in ``llm`` against injected latency and errors.
+
+Each fault profile starts a ``FakeOpenAIServer`` that misbehaves in one
+way, and ``--requests`` answers are generated through ``llm`` and the real
+OpenAI client under each call policy:
+
+- ``none``: one attempt with no timeout or breaker to speak of, as before
+  the policy existed;
+- ``retry``: the deadline, per-attempt timeout, retries and breaker;
+- ``hedge``: the same plus hedged requests.
+
+The fault profiles are:
+
+- ``errors``: ``--error-rate`` of calls fail with a 500;
+- ``tail``: ``--slow-rate`` of calls take ``--slow-latency`` seconds;
+- ``stall``: ``--slow-rate`` of calls hang for longer than the deadline;
+- ``outage``: every call fails, which should trip the breaker.
+
+One JSON line is printed per (profile, policy), with the success rate,
+latency percentiles and what the policy did (upstream calls, retries,
+hedges, short-circuited calls):
+
+    python bench_resilience.py
+    python bench_resilience.py --profile tail --requests 500 --concurrency 16 --check
+
+With ``--check``, the exit status is non-zero if a policy does not beat
+``none`` where it should: fewer failures under ``errors``, a lower p99
+under ``tail`` (with hedging), no request past the deadline under
+``stall`` and few upstream calls under ``outage``.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from typing import Dict, List
+
+from fakes import FakeOpenAIServer
+
+PROFILES = ("errors", "tail", "stall", "outage")
+POLICIES = ("none", "retry", "hedge")
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(pct / 100 * len(sorted_values)))]
+
+
+def make_caller(policy: str, args):
+    from resilience import CircuitBreaker, ResilientCaller
+
+    if policy == "none":
+        # The old behaviour: the client's own timeout, nothing else
+        return ResilientCaller("openai", deadline=3600, attempt_timeout=3600, max_attempts=1,
+                               breaker=CircuitBreaker("openai", failure_threshold=10 ** 9))
+    return ResilientCaller("openai", deadline=args.deadline, attempt_timeout=args.attempt_timeout,
+                           max_attempts=3, base_delay=0.05, hedge=policy == "hedge",
+                           hedge_percentile=args.hedge_percentile, hedge_min_delay=args.hedge_min_delay,
+                           breaker=CircuitBreaker("openai", failure_threshold=5, reset_timeout=args.breaker_reset))
+
+
+def server_for(profile: str, args) -> FakeOpenAIServer:
+    if profile == "errors":
+        return FakeOpenAIServer(args.latency, error_rate=args.error_rate, tokens=args.tokens)
+    if profile == "tail":
+        return FakeOpenAIServer(args.latency, tokens=args.tokens, slow_rate=args.slow_rate,
+                                slow_latency=args.slow_latency)
+    if profile == "stall":
+        return FakeOpenAIServer(args.latency, tokens=args.tokens, slow_rate=args.slow_rate,
+                                slow_latency=args.deadline * 3)
+    server = FakeOpenAIServer(args.latency, tokens=args.tokens, error_status=503)
+    server.llm.down = True
+    return server
+
+
+async def drive(requests: int, concurrency: int) -> List[Dict]:
+    import llm
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int) -> Dict:
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await llm.agenerate_answer(f"question {i}")
+                error = None
+            except Exception as e:
+                error = type(e).__name__
+            return {"seconds": time.perf_counter() - start, "error": error}
+
+    return await asyncio.gather(*(one(i) for i in range(requests)))
+
+
+def run(profile: str, policy: str, args) -> Dict:
+    import llm
+
+    with server_for(profile, args) as server:
+        os.environ["OPENAI_BASE_URL"] = server.url
+        # Async clients are per event loop, so each run's client reads the new URL
+        llm.caller = caller = make_caller(policy, args)
+        results = asyncio.run(drive(args.requests, args.concurrency))
+        upstream_calls = server.llm.calls
+
+    latencies = sorted(r["seconds"] for r in results)
+    errors: Dict[str, int] = {}
+    for r in results:
+        if r["error"]:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    return {
+        "profile": profile,
+        "policy": policy,
+        "requests": len(results),
+        "ok_rate": round(1 - sum(errors.values()) / len(results), 4),
+        "errors": errors,
+        "p50_ms": round(1000 * percentile(latencies, 50), 1),
+        "p95_ms": round(1000 * percentile(latencies, 95), 1),
+        "p99_ms": round(1000 * percentile(latencies, 99), 1),
+        "max_ms": round(1000 * latencies[-1], 1),
+        "upstream_calls": upstream_calls,
+        **{k: v for k, v in caller.stats().items() if k != "hedge_after"},
+    }
+
+
+def check(results: List[Dict], args) -> List[str]:
+    by_key = {(r["profile"], r["policy"]): r for r in results}
+    failures = []
+    for (profile, policy), r in by_key.items():
+        base = by_key.get((profile, "none"))
+        if policy == "none" or base is None:
+            continue
+        if profile == "errors" and r["ok_rate"] <= base["ok_rate"]:
+            failures.append(f"{profile}/{policy}: ok rate {r['ok_rate']} not above {base['ok_rate']}")
+        if profile == "tail" and policy == "hedge" and r["p99_ms"] >= base["p99_ms"]:
+            failures.append(f"{profile}/{policy}: p99 {r['p99_ms']}ms not below {base['p99_ms']}ms")
+        if profile == "stall" and r["max_ms"] > 1000 * args.deadline * 1.2:
+            failures.append(f"{profile}/{policy}: a request took {r['max_ms']}ms, deadline {args.deadline}s")
+        if profile == "outage" and r["upstream_calls"] > args.requests / 4:
+            failures.append(f"{profile}/{policy}: {r['upstream_calls']} upstream calls despite the breaker")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--profile", nargs="+", choices=PROFILES, default=list(PROFILES))
+    parser.add_argument("--policy", nargs="+", choices=POLICIES, default=list(POLICIES))
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.05, help="Normal fake LLM latency in seconds")
+    parser.add_argument("--tokens", type=int, default=50)
+    parser.add_argument("--error-rate", type=float, default=0.2)
+    parser.add_argument("--slow-rate", type=float, default=0.05)
+    parser.add_argument("--slow-latency", type=float, default=1.5)
+    parser.add_argument("--deadline", type=float, default=3.0, help="LLM_DEADLINE for the retry and hedge policies")
+    parser.add_argument("--attempt-timeout", type=float, default=1.0)
+    parser.add_argument("--hedge-percentile", type=float, default=90.0)
+    parser.add_argument("--hedge-min-delay", type=float, default=0.1)
+    parser.add_argument("--breaker-reset", type=float, default=30.0)
+    parser.add_argument("--check", action="store_true", help="Exit non-zero if a policy misses its expectation")
+    args = parser.parse_args()
+
+    os.environ.setdefault("OPENAI_API_KEY", "fake")
+    results = []
+    for profile in args.profile:
+        for policy in args.policy:
+            result = run(profile, policy, args)
+            results.append(result)
+            print(json.dumps(result), flush=True)
+
+    if args.check:
+        failures = check(results, args)
+        for failure in failures:
+            print(failure, file=sys.stderr)
+        sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
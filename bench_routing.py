@@ -0,0 +1,79 @@
+"""Replay stored questions through the chat router and estimate the savings.
+
+Every question in the given history files (by default the ``*.json``
+histories next to this script) is classified with ``router.classify``.
+One JSON line is printed per route and reason, with its share of traffic
+and example questions. A summary line follows with the classifier's mean
+time per question and the estimated model cost with and without routing.
+Cost is estimated from the stored answers' length, about 4 characters per
+token, at ``--full-price`` and ``--cheap-price`` per 1K output tokens;
+template answers cost nothing:
+
+    python bench_routing.py
+    python bench_routing.py navneet1.json --full-price 0.06 --cheap-price 0.0006
+
+Use ``--show`` to print every question with its decision, to review the
+rules before enabling them (``CHAT_ROUTING=shadow`` does the same on live
+traffic).
+"""
+import argparse
+import glob
+import json
+import os
+import time
+from collections import defaultdict
+
+import history_codec
+import router
+
+CHARS_PER_TOKEN = 4
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser.add_argument("files", nargs="*", help="History files (default: *.json next to this script)")
+    parser.add_argument("--full-price", type=float, default=0.06, help="Full model $ per 1K output tokens")
+    parser.add_argument("--cheap-price", type=float, default=0.0006, help="Cheap model $ per 1K output tokens")
+    parser.add_argument("--show", action="store_true", help="Print each question and its decision")
+    args = parser.parse_args()
+
+    turns = []
+    for path in args.files or sorted(glob.glob(os.path.join(here, "*.json"))):
+        with open(path, "rb") as f:
+            turns += history_codec.loads(f.read()).values()
+
+    groups = defaultdict(list)
+    cost = {"routed": 0.0, "unrouted": 0.0}
+    prices = {router.TEMPLATE: 0.0, router.CHEAP: args.cheap_price, router.FULL: args.full_price}
+    start = time.perf_counter()
+    decisions = [router.classify(turn["question"]) for turn in turns]
+    elapsed = time.perf_counter() - start
+
+    for turn, decision in zip(turns, decisions):
+        groups[(decision.route, decision.reason)].append(turn["question"])
+        tokens = len(turn["answer"]) / CHARS_PER_TOKEN / 1000
+        cost["routed"] += tokens * prices[decision.route]
+        cost["unrouted"] += tokens * args.full_price
+        if args.show:
+            print(json.dumps({"route": decision.route, "reason": decision.reason, "question": turn["question"]}))
+
+    for (route, reason), questions in sorted(groups.items()):
+        print(json.dumps({
+            "route": route,
+            "reason": reason,
+            "questions": len(questions),
+            "share": round(len(questions) / len(turns), 3),
+            "examples": questions[:3],
+        }))
+    print(json.dumps({
+        "questions": len(turns),
+        "classify_us": round(1e6 * elapsed / max(1, len(turns)), 1),
+        "cost_unrouted": round(cost["unrouted"], 4),
+        "cost_routed": round(cost["routed"], 4),
+        "cost_saved": round(1 - cost["routed"] / cost["unrouted"], 3) if cost["unrouted"] else 0.0,
+    }))
+
+
+if __name__ == "__main__":
+    main()
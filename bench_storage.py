@@ -0,0 +1,80 @@
+"""Benchmark the chat storage backends against each other.
+
+Runs the same write/read workload through S3Storage (backed by the
+in-memory FakeS3Client), FileStorage and SQLiteStorage and prints one JSON
+line per backend:
+
+    python bench_storage.py --users 5 --turns 200 --s3-latency 0.01
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from fakes import FakeS3Client
+from storage import FileStorage, S3Storage, SQLiteStorage
+
+
+def sample_turns(path: str):
+    """Question/answer pairs from a stored history file, used as payloads."""
+    with open(path, "r") as f:
+        return [(chat["question"], chat["answer"]) for chat in json.load(f).values()]
+
+
+def run(name: str, storage, users: int, turns: int, payloads, s3=None) -> dict:
+    write_times, read_times = [], []
+    for turn in range(turns):
+        question, answer = payloads[turn % len(payloads)]
+        for user in range(users):
+            start = time.perf_counter()
+            storage.save_chat(f"bench_user_{user}", f"turn_{turn}", question, answer)
+            write_times.append(time.perf_counter() - start)
+            # Compaction runs after writes in the write-behind worker, off the request path
+            if storage.needs_compaction(f"bench_user_{user}"):
+                storage.compact(f"bench_user_{user}")
+    for user in range(users):
+        start = time.perf_counter()
+        chats = storage.load_chat_history(f"bench_user_{user}")
+        read_times.append(time.perf_counter() - start)
+        assert len(chats) == turns, (name, len(chats))
+    result = {
+        "backend": name,
+        "users": users,
+        "turns": turns,
+        "write_avg_ms": round(1000 * sum(write_times) / len(write_times), 3),
+        "write_last_ms": round(1000 * write_times[-1], 3),
+        "read_avg_ms": round(1000 * sum(read_times) / len(read_times), 3),
+    }
+    if s3 is not None:
+        result["s3_calls"] = dict(s3.calls)
+        result["s3_bytes_in"] = s3.bytes_in
+        result["s3_bytes_out"] = s3.bytes_out
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--s3-latency", type=float, default=0.0,
+                        help="Simulated seconds per fake S3 call")
+    parser.add_argument("--sample", default=os.path.join(os.path.dirname(__file__), "navneet1.json"),
+                        help="History file whose turns are used as payloads")
+    args = parser.parse_args()
+    payloads = sample_turns(args.sample)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        s3 = FakeS3Client(latency=args.s3_latency)
+        backends = [
+            ("s3", S3Storage("bench-bucket", client=s3), s3),
+            ("file", FileStorage(os.path.join(tmp, "files")), None),
+            ("sqlite", SQLiteStorage(os.path.join(tmp, "chats.db")), None),
+        ]
+        for name, storage, client in backends:
+            print(json.dumps(run(name, storage, args.users, args.turns, payloads, client)))
+        backends[2][1].close()
+
+
+if __name__ == "__main__":
+    main()
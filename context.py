@@ -0,0 +1,255 @@
+"""Token-budgeted conversation context with a rolling per-user summary.
+
+``build_context`` turns a user's history into prompt messages that fit in
+``budget`` tokens. It starts with the rolling summary, if there is one. It
+then adds the past turns that score best on a mix of relevance to the new
+question and recency, with long answers cut to ``answer_tokens``. The
+chosen turns are returned oldest first. Only turns at least
+``MIN_RELEVANCE`` relevant compete, unless the question is a follow-up
+("yes", "tell me more", or ``follow_up=True``), which leans on the latest
+exchanges.
+When no turn qualifies the context is empty, summary included: the
+question does not depend on the conversation, so its answer can be cached
+and shared like anyone else's.
+
+The summary lives in the user's meta record (``meta["summary"]``, next to
+the history). It covers the first ``through`` turns. ``RollingSummarizer``
+folds newer turns into it in the background once ``every`` of them have
+piled up, so the prompt stays bounded however long the conversation gets.
+Where the process can be frozen between requests (Lambda), a background
+thread would be cut off mid-call. Pass ``dispatch`` to run the updates
+elsewhere instead (e.g. an asynchronous invocation that calls ``update``)
+and call ``dispatch_due`` once a request's turns are stored. Either way no
+reply waits on the summary's LLM call.
+
+Tokens are counted with ``tiktoken`` when it is installed. Otherwise an
+approximation is used: runs of up to four word characters, plus
+punctuation.
+"""
+import logging
+import math
+import os
+import re
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from faq_index import tokenize
+
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("cl100k_base")
+except Exception:  # not installed, or the encoding could not be loaded offline
+    _ENCODING = None
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "1500"))
+CONTEXT_ANSWER_TOKENS = int(os.environ.get("CONTEXT_ANSWER_TOKENS", "250"))
+SUMMARY_MAX_TOKENS = int(os.environ.get("SUMMARY_MAX_TOKENS", "300"))
+SUMMARY_EVERY = int(os.environ.get("SUMMARY_EVERY", "4"))
+SUMMARY_CHUNK_TURNS = 8
+# A dispatched update is not sent again for the same turns within this many
+# seconds, however many turns the user sends while it runs
+SUMMARY_REDISPATCH_AFTER = 300
+# Chosen turns compete for the budget with this bonus for being recent
+RECENCY_WEIGHT = 1.0
+# Past turns must be at least this relevant to the question to be included
+MIN_RELEVANCE = float(os.environ.get("CONTEXT_MIN_RELEVANCE", "1.0"))
+# Questions with at most this many terms are follow-ups to the latest turns
+FOLLOW_UP_TERMS = 1
+
+_APPROX_TOKEN = re.compile(r"\w{1,4}|[^\w\s]")
+
+
+def count_tokens(text: str) -> int:
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text, disallowed_special=()))
+    return len(_APPROX_TOKEN.findall(text))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    if _ENCODING is not None:
+        tokens = _ENCODING.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        return _ENCODING.decode(tokens[:max_tokens]).rstrip() + " ..."
+    for i, match in enumerate(_APPROX_TOKEN.finditer(text)):
+        if i == max_tokens:
+            return text[:match.start()].rstrip() + " ..."
+    return text
+
+
+def relevance(question_terms: set, turn: Dict) -> float:
+    """Share of the question's terms found in a past turn, weighted towards its question."""
+    if not question_terms:
+        return 0.0
+    asked = set(tokenize(turn["question"]))
+    answered = set(tokenize(turn["answer"][:2000]))
+    hits = sum(1.0 if term in asked else 0.5 if term in answered else 0.0 for term in question_terms)
+    return hits / math.sqrt(len(question_terms))
+
+
+def turn_messages(turn: Dict, answer_tokens: int) -> List[Dict]:
+    return [
+        {"role": "user", "content": turn["question"]},
+        {"role": "assistant", "content": truncate_tokens(turn["answer"], answer_tokens)},
+    ]
+
+
+def summary_message(summary: Optional[Dict]) -> Optional[Dict]:
+    if not summary or not summary.get("text"):
+        return None
+    return {"role": "system", "content": f"Summary of the conversation so far: {summary['text']}"}
+
+
+def build_context(chats: Dict, summary: Optional[Dict], question: str,
+                  budget: int = CONTEXT_TOKEN_BUDGET, answer_tokens: int = CONTEXT_ANSWER_TOKENS,
+                  follow_up: bool = False) -> List[Dict]:
+    """Prompt messages drawn from ``chats`` and ``summary`` that fit in ``budget`` tokens.
+
+    Empty when nothing in the history bears on ``question``. ``follow_up``
+    keeps the latest turns whatever their relevance.
+    """
+    turns = list(chats.values())
+    question_terms = set(tokenize(question))
+    follow_up = follow_up or len(question_terms) <= FOLLOW_UP_TERMS
+    scored = []
+    for position, turn in enumerate(turns):
+        score = relevance(question_terms, turn)
+        if score < MIN_RELEVANCE and not follow_up:
+            continue
+        recency = RECENCY_WEIGHT * (position + 1) / len(turns)
+        scored.append((score + recency, position))
+    if not scored:
+        return []
+
+    messages = []
+    remaining = budget
+    header = summary_message(summary)
+    if header is not None:
+        cost = count_tokens(header["content"])
+        if cost <= remaining:
+            messages.append(header)
+            remaining -= cost
+    chosen = []
+    for _, position in sorted(scored, reverse=True):
+        pair = turn_messages(turns[position], answer_tokens)
+        cost = sum(count_tokens(m["content"]) for m in pair)
+        if cost <= remaining:
+            chosen.append((position, pair))
+            remaining -= cost
+        if remaining <= 0:
+            break
+    for _, pair in sorted(chosen, key=lambda item: item[0]):
+        messages.extend(pair)
+    return messages
+
+
+def summary_prompt(previous: str, turns: List[Dict], max_tokens: int) -> List[Dict]:
+    transcript = "\n\n".join(
+        f"User: {t['question']}\nAssistant: {truncate_tokens(t['answer'], 400)}" for t in turns
+    )
+    return [
+        {"role": "system", "content": (
+            "You maintain a running summary of a counselling conversation with an international "
+            "medical graduate. Keep the user's goals, background, constraints and the key advice "
+            f"already given. Reply with the updated summary only, under {max_tokens} tokens."
+        )},
+        {"role": "user", "content": f"Current summary:\n{previous or '(none)'}\n\nNew exchanges:\n{transcript}"},
+    ]
+
+
+def pending_turns(chats: Dict, summary: Optional[Dict]) -> List[Dict]:
+    through = (summary or {}).get("through", 0)
+    return list(chats.values())[through:]
+
+
+class RollingSummarizer:
+    """Background worker that keeps each user's ``meta["summary"]`` current.
+
+    ``load_history(user_id)`` returns the history, and ``summarize(messages)``
+    returns the model's reply to a summary prompt.
+    """
+
+    def __init__(self, storage, load_history: Callable[[str], Dict], summarize: Callable[[List[Dict]], str],
+                 every: int = SUMMARY_EVERY, max_tokens: int = SUMMARY_MAX_TOKENS,
+                 dispatch: Optional[Callable[[List[str]], None]] = None):
+        self.storage = storage
+        self.load_history = load_history
+        self.summarize = summarize
+        self.every = every
+        self.max_tokens = max_tokens
+        # Where set, due updates are handed to ``dispatch(user_ids)`` by
+        # ``dispatch_due`` rather than run on the worker thread
+        self.dispatch = dispatch
+        # user_id -> (summarized turns, time) at the last dispatch
+        self._dispatched: Dict[str, Tuple[int, float]] = {}
+        self._queued = []
+        self._cond = threading.Condition()
+        self._worker = None
+
+    def maybe_schedule(self, user_id: str, turn_count: int, summary: Optional[Dict]):
+        """Queue a summary update once ``every`` of ``turn_count`` turns are not yet summarized."""
+        through = (summary or {}).get("through", 0)
+        if turn_count - through < self.every:
+            return
+        with self._cond:
+            if user_id in self._queued:
+                return
+            if self.dispatch is not None:
+                now = time.monotonic()
+                last = self._dispatched.get(user_id)
+                if last is not None and last[0] == through and now - last[1] < SUMMARY_REDISPATCH_AFTER:
+                    return
+                for other in [u for u, (_, at) in self._dispatched.items() if now - at >= SUMMARY_REDISPATCH_AFTER]:
+                    del self._dispatched[other]
+                self._dispatched[user_id] = (through, now)
+                self._queued.append(user_id)
+                return
+            self._queued.append(user_id)
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="rolling-summary", daemon=True)
+                self._worker.start()
+            self._cond.notify_all()
+
+    def dispatch_due(self):
+        """Hand every update queued since the last call to ``dispatch``."""
+        with self._cond:
+            user_ids, self._queued = self._queued, []
+        if user_ids:
+            try:
+                self.dispatch(user_ids)
+            except Exception:
+                # Not lost: the users' next turns queue them again
+                logger.exception("Dispatching summary updates for %s failed", user_ids)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queued:
+                    self._cond.wait()
+                user_id = self._queued[0]
+            try:
+                self.update(user_id)
+            except Exception:
+                logger.exception("Updating the conversation summary for %s failed", user_id)
+            with self._cond:
+                self._queued.remove(user_id)
+
+    def update(self, user_id: str) -> Tuple[Dict, int]:
+        """Fold every unsummarized turn into the user's summary; returns it and the turns added."""
+        chats = self.load_history(user_id)
+        summary = self.storage.load_user_meta(user_id).get("summary") or {"text": "", "through": 0}
+        through = summary["through"]
+        turns = pending_turns(chats, summary)
+        # Long histories without a summary yet are folded in a few prompts of bounded size
+        for start in range(0, len(turns), SUMMARY_CHUNK_TURNS):
+            chunk = turns[start:start + SUMMARY_CHUNK_TURNS]
+            text = self.summarize(summary_prompt(summary["text"], chunk, self.max_tokens)).strip()
+            summary = {"text": truncate_tokens(text, self.max_tokens), "through": summary["through"] + len(chunk)}
+            # Re-read just before writing so other meta fields (e.g. thread ids) are kept
+            meta = self.storage.load_user_meta(user_id)
+            meta["summary"] = summary
+            self.storage.save_user_meta(user_id, meta)
+        return summary, summary["through"] - through
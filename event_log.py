@@ -0,0 +1,220 @@
+"""Buffered, append-only storage for feedback events (ratings, contact messages).
+
+Routes call ``EventBuffer.append``, which is only a list append. The buffer
+is flushed in batches once it holds ``max_events`` events or its oldest
+event is ``max_age`` seconds old, and on ``flush`` at shutdown. A frozen
+Lambda container runs no background thread, so the handler calls
+``flush_due`` at the end of each invocation, which writes only once one of
+those thresholds is reached. Each flush writes one gzipped JSONL segment
+per stream and day:
+
+    events/{stream}/dt=YYYY-MM-DD/{timestamp}-{id}.jsonl.gz
+
+Segments are never rewritten. Readers stream them back a line at a time,
+so aggregations such as ``rating_summary`` never hold a whole day in memory.
+"""
+import gzip
+import io
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def event_day(at: float) -> str:
+    return datetime.fromtimestamp(at, timezone.utc).strftime("%Y-%m-%d")
+
+
+def encode_segment(events: List[Dict]) -> bytes:
+    return gzip.compress("".join(json.dumps(e) + "\n" for e in events).encode("utf-8"))
+
+
+def segment_name() -> str:
+    return f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.jsonl.gz"
+
+
+def days_between(start: Optional[str], end: Optional[str], known: List[str]) -> List[str]:
+    return [d for d in sorted(known) if (start is None or d >= start) and (end is None or d <= end)]
+
+
+class FileSegmentSink:
+    """Segments under a local directory."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def write(self, stream: str, day: str, events: List[Dict]):
+        directory = os.path.join(self.root, stream, f"dt={day}")
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, segment_name())
+        with open(path + ".tmp", "wb") as f:
+            f.write(encode_segment(events))
+        os.replace(path + ".tmp", path)
+
+    def days(self, stream: str) -> List[str]:
+        directory = os.path.join(self.root, stream)
+        if not os.path.isdir(directory):
+            return []
+        return [name[3:] for name in os.listdir(directory) if name.startswith("dt=")]
+
+    def read(self, stream: str, start: Optional[str] = None, end: Optional[str] = None) -> Iterator[Dict]:
+        for day in days_between(start, end, self.days(stream)):
+            directory = os.path.join(self.root, stream, f"dt={day}")
+            for name in sorted(os.listdir(directory)):
+                if name.endswith(".jsonl.gz"):
+                    with gzip.open(os.path.join(directory, name), "rt", encoding="utf-8") as f:
+                        for line in f:
+                            yield json.loads(line)
+
+
+class S3SegmentSink:
+    """Segments under a prefix of the chat history bucket."""
+
+    def __init__(self, s3, bucket: str, prefix: str = "events/"):
+        # None means the shared default client, created when first needed
+        self.client = s3
+        self.bucket = bucket
+        self.prefix = prefix
+
+    @property
+    def s3(self):
+        if self.client is not None:
+            return self.client
+        from storage import default_s3_client
+        return default_s3_client()
+
+    def write(self, stream: str, day: str, events: List[Dict]):
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=f"{self.prefix}{stream}/dt={day}/{segment_name()}",
+            Body=encode_segment(events),
+            ContentType="application/gzip",
+        )
+
+    def days(self, stream: str) -> List[str]:
+        base = f"{self.prefix}{stream}/dt="
+        days = []
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=base, Delimiter="/"):
+            days.extend(p["Prefix"][len(base):-1] for p in page.get("CommonPrefixes", []))
+        return days
+
+    def read(self, stream: str, start: Optional[str] = None, end: Optional[str] = None) -> Iterator[Dict]:
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for day in days_between(start, end, self.days(stream)):
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=f"{self.prefix}{stream}/dt={day}/"):
+                for obj in page.get("Contents", []):
+                    body = self.s3.get_object(Bucket=self.bucket, Key=obj["Key"])["Body"]
+                    with gzip.GzipFile(fileobj=body) as raw:
+                        for line in io.TextIOWrapper(raw, encoding="utf-8"):
+                            yield json.loads(line)
+
+
+def get_event_sink(storage):
+    """Put event segments next to wherever the chat histories live."""
+    from storage import FileStorage, S3Storage, SQLiteStorage
+    if isinstance(storage, S3Storage):
+        return S3SegmentSink(storage.client, storage.bucket)
+    if isinstance(storage, FileStorage):
+        return FileSegmentSink(os.path.join(storage.data_dir, "events"))
+    if isinstance(storage, SQLiteStorage):
+        return FileSegmentSink(os.path.join(os.path.dirname(os.path.abspath(storage.path)), "events"))
+    raise ValueError(f"No event sink for {type(storage).__name__}")
+
+
+class EventBuffer:
+    def __init__(self, sink, max_events: int = 100, max_age: float = 5.0):
+        self.sink = sink
+        self.max_events = max_events
+        self.max_age = max_age
+        self._events: List[Dict] = []
+        self._first_at = None
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._timer = None
+
+    def append(self, stream: str, event: Dict):
+        event = {**event, "stream": stream, "at": event.get("at", time.time())}
+        with self._cond:
+            self._events.append(event)
+            if self._first_at is None:
+                self._first_at = time.monotonic()
+            if self._timer is None or not self._timer.is_alive():
+                self._timer = threading.Thread(target=self._run, name="event-buffer", daemon=True)
+                self._timer.start()
+            if len(self._events) >= self.max_events:
+                self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._events:
+                    self._cond.wait()
+                while self._events and len(self._events) < self.max_events:
+                    remaining = self.max_age - (time.monotonic() - self._first_at)
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            self.flush()
+
+    def flush_due(self) -> bool:
+        """``flush`` if the buffer is full or its oldest event is ``max_age`` old; True if it was."""
+        with self._cond:
+            # Wall-clock time: the monotonic clock may stand still while a container is frozen
+            due = bool(self._events) and (len(self._events) >= self.max_events
+                                          or time.time() - self._events[0]["at"] >= self.max_age)
+        if due:
+            self.flush()
+        return due
+
+    def flush(self):
+        """Write everything buffered so far, one segment per stream and day."""
+        with self._flush_lock:
+            with self._cond:
+                events, self._events, self._first_at = self._events, [], None
+            if not events:
+                return
+            partitions = defaultdict(list)
+            for event in events:
+                partitions[(event["stream"], event_day(event["at"]))].append(event)
+            for (stream, day), batch in partitions.items():
+                try:
+                    self.sink.write(stream, day, batch)
+                except Exception:
+                    logger.exception("Writing %d %s event(s) failed; re-buffering", len(batch), stream)
+                    with self._cond:
+                        self._events[:0] = batch
+                        if self._first_at is None:
+                            self._first_at = time.monotonic()
+
+
+def rating_summary(sink, start: Optional[str] = None, end: Optional[str] = None, top: int = 50) -> Dict:
+    """Average rating per question, per day and per answer route, streamed from the segments.
+
+    ``start``/``end`` are inclusive ``YYYY-MM-DD`` days. Ratings sent
+    without the route their answer took count as ``unknown``.
+    """
+    by_question = defaultdict(lambda: [0, 0])
+    by_day = defaultdict(lambda: [0, 0])
+    by_route = defaultdict(lambda: [0, 0])
+    for event in sink.read("ratings", start, end):
+        rating = event["rating"]
+        buckets = (by_question[event["question"]], by_day[event_day(event["at"])],
+                   by_route[event.get("route") or "unknown"])
+        for bucket in buckets:
+            bucket[0] += 1
+            bucket[1] += rating
+    per_question = sorted(
+        ({"question": q, "count": c, "average": round(t / c, 3)} for q, (c, t) in by_question.items()),
+        key=lambda row: -row["count"],
+    )
+    per_day = [{"day": d, "count": c, "average": round(t / c, 3)} for d, (c, t) in sorted(by_day.items())]
+    per_route = [{"route": r, "count": c, "average": round(t / c, 3)} for r, (c, t) in sorted(by_route.items())]
+    return {"per_question": per_question[:top], "per_day": per_day, "per_route": per_route}
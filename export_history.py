@@ -0,0 +1,179 @@
+"""Export every stored chat history as one per-turn dataset, resumably.
+
+Users are listed a page at a time (``ChatStorage.iter_users``) and their
+histories are loaded by a bounded pool of threads, so a bucket of
+thousands of users is read with ``--workers`` requests in flight rather
+than one at a time. Each history is turned into rows as soon as it
+arrives and appended to the output (JSONL or CSV). Nothing is held in
+memory beyond the histories in flight.
+
+Progress is checkpointed in ``<output>.progress`` after each user's rows
+are written: one JSON line with the user id and the output size. A rerun
+of the same command cuts off any rows written after the last checkpoint
+and skips users already exported.
+
+    python export_history.py turns.jsonl --workers 32
+    python export_history.py turns.csv --format csv --include-answers
+    python export_history.py scan.jsonl --fake-users 2000 --fake-s3-latency 0.02
+
+Reads go through the configured storage backend (``CHAT_STORAGE``,
+``CHAT_S3_BUCKET``, ...) with ``load_chat_history_readonly``, so an export
+writes nothing back: logs are not compacted and old snapshot formats are
+left as they are.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterator, List, Set, Tuple
+
+from storage import ChatStorage, get_storage
+
+FIELDS = ("user_id", "turn", "title", "question", "question_chars", "answer_chars", "answer_words",
+          "request_id")
+
+
+def turn_rows(user_id: str, chats: Dict, include_answers: bool = False) -> Iterator[Dict]:
+    for position, (title, chat) in enumerate(chats.items()):
+        row = {
+            "user_id": user_id,
+            "turn": position,
+            "title": title,
+            "question": chat["question"],
+            "question_chars": len(chat["question"]),
+            "answer_chars": len(chat["answer"]),
+            "answer_words": len(chat["answer"].split()),
+            "request_id": chat.get("request_id"),
+        }
+        if include_answers:
+            row["answer"] = chat["answer"]
+        yield row
+
+
+def encode_rows(rows: List[Dict], fmt: str, include_answers: bool = False, header: bool = False) -> bytes:
+    if fmt == "jsonl":
+        return "".join(json.dumps(row) + "\n" for row in rows).encode("utf-8")
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=FIELDS + (("answer",) if include_answers else ()))
+    if header:
+        writer.writeheader()
+    writer.writerows(rows)
+    return buf.getvalue().encode("utf-8")
+
+
+def load_progress(output_path: str) -> Tuple[Set[str], int]:
+    """Users already exported and the output size after the last of them."""
+    done, offset = set(), 0
+    progress_path = output_path + ".progress"
+    if not os.path.exists(progress_path):
+        if os.path.exists(output_path) and os.path.getsize(output_path):
+            raise SystemExit(f"{output_path} exists without {progress_path}; remove it or pick another output")
+        return done, offset
+    with open(progress_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # a line cut short by a crash
+            done.add(entry["user_id"])
+            offset = entry["offset"]
+    return done, offset
+
+
+def run_export(storage: ChatStorage, output_path: str, workers: int = 32, fmt: str = "jsonl",
+               include_answers: bool = False, progress_every: int = 500) -> Dict:
+    done, offset = load_progress(output_path)
+    stats = {"users": 0, "turns": 0, "skipped": 0, "failed": 0}
+    started = time.monotonic()
+
+    def export_user(user_id: str) -> Tuple[bytes, int]:
+        rows = list(turn_rows(user_id, storage.load_chat_history_readonly(user_id), include_answers))
+        return encode_rows(rows, fmt, include_answers), len(rows)
+
+    with open(output_path, "ab") as out, open(output_path + ".progress", "a", encoding="utf-8") as progress:
+        # Rows written after the last checkpoint belong to a user that is exported again
+        out.truncate(offset)
+        out.seek(offset)
+        if fmt == "csv" and offset == 0:
+            out.write(encode_rows([], fmt, include_answers, header=True))
+
+        def record(user_id: str, data: bytes, turns: int):
+            out.write(data)
+            out.flush()
+            progress.write(json.dumps({"user_id": user_id, "offset": out.tell()}) + "\n")
+            progress.flush()
+            stats["users"] += 1
+            stats["turns"] += turns
+            if progress_every and stats["users"] % progress_every == 0:
+                elapsed = time.monotonic() - started
+                print(f"{stats['users']} users, {stats['users'] / elapsed:.1f}/s", file=sys.stderr)
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="export") as pool:
+            in_flight = {}
+
+            def drain(block_until: int):
+                # Write finished users until no more than ``block_until`` remain in flight
+                while len(in_flight) > block_until:
+                    finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        user_id = in_flight.pop(future)
+                        try:
+                            record(user_id, *future.result())
+                        except Exception as e:
+                            stats["failed"] += 1
+                            print(f"{user_id}: {e}", file=sys.stderr)
+
+            for user_id in storage.iter_users():
+                if user_id in done:
+                    stats["skipped"] += 1
+                    continue
+                done.add(user_id)
+                in_flight[pool.submit(export_user, user_id)] = user_id
+                # A bounded window keeps memory flat however many users there are
+                drain(2 * workers)
+            drain(0)
+
+    stats["seconds"] = round(time.monotonic() - started, 2)
+    return stats
+
+
+def fake_storage(users: int, latency: float) -> ChatStorage:
+    """S3Storage over a ``FakeS3Client`` holding ``users`` copies of navneet1.json."""
+    from fakes import FakeS3Client
+    from storage import S3Storage
+
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "navneet1.json"), "r") as f:
+        sample = json.load(f)
+    s3 = FakeS3Client()
+    storage = S3Storage("export-bucket", client=s3)
+    for user in range(users):
+        storage.write_snapshot(storage.get_key(f"user_{user}"), sample, None)
+    s3.latency = latency
+    return storage
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("output", help="Dataset file, appended to and resumed from")
+    parser.add_argument("--format", choices=("jsonl", "csv"), default=None,
+                        help="Output format (default: from the file extension)")
+    parser.add_argument("--workers", type=int, default=32, help="Histories loaded in parallel")
+    parser.add_argument("--include-answers", action="store_true", help="Also export the full answer text")
+    parser.add_argument("--fake-users", type=int, default=None,
+                        help="Scan this many generated users in a fake S3 bucket instead of real storage")
+    parser.add_argument("--fake-s3-latency", type=float, default=0.02,
+                        help="Simulated seconds per fake S3 call")
+    args = parser.parse_args()
+
+    fmt = args.format or ("csv" if args.output.endswith(".csv") else "jsonl")
+    storage = fake_storage(args.fake_users, args.fake_s3_latency) if args.fake_users else get_storage()
+    stats = run_export(storage, args.output, workers=args.workers, fmt=fmt, include_answers=args.include_answers)
+    print(json.dumps(stats))
+
+
+if __name__ == "__main__":
+    main()
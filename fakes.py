@@ -0,0 +1,321 @@
+"""In-memory stand-ins for external services, used by the benchmarks.
+
+``FakeS3Client`` implements the subset of the boto3 S3 client that the
+storage backends call, and counts calls and bytes moved so benchmarks can
+report them. ``FakeLLM`` replaces the functions in ``llm``, and
+``FakeOpenAIServer`` serves it over HTTP for tests that go through the
+OpenAI client itself.
+"""
+import asyncio
+import hashlib
+import io
+import json
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+from storage import ClientError
+
+
+def _client_error(code: str, operation: str, message: str = "") -> ClientError:
+    return ClientError({"Error": {"Code": code, "Message": message}}, operation)
+
+
+class _Paginator:
+    def __init__(self, client, operation: str):
+        self.client = client
+        self.operation = operation
+
+    def paginate(self, **kwargs):
+        method = getattr(self.client, self.operation)
+        while True:
+            page = method(**kwargs)
+            yield page
+            if not page.get("IsTruncated"):
+                return
+            kwargs["ContinuationToken"] = page["NextContinuationToken"]
+
+
+class FakeS3Client:
+    """Thread-safe in-memory S3 with optional per-call latency."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.objects: Dict[str, Dict] = {}
+        self.calls = Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._lock = threading.Lock()
+
+    def _call(self, operation: str):
+        self.calls[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def reset_counters(self):
+        self.calls.clear()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def get_object(self, Bucket: str, Key: str, IfNoneMatch: Optional[str] = None, **kwargs):
+        self._call("GetObject")
+        with self._lock:
+            obj = self.objects.get(Key)
+            if obj is None:
+                raise _client_error("NoSuchKey", "GetObject", "The specified key does not exist.")
+            if IfNoneMatch is not None and IfNoneMatch == obj["ETag"]:
+                raise _client_error("304", "GetObject", "Not Modified")
+            self.bytes_out += len(obj["Body"])
+            return {
+                "Body": io.BytesIO(obj["Body"]),
+                "ETag": obj["ETag"],
+                "ContentLength": len(obj["Body"]),
+                "LastModified": obj["LastModified"],
+                "Metadata": dict(obj["Metadata"]),
+            }
+
+    def head_object(self, Bucket: str, Key: str, **kwargs):
+        self._call("HeadObject")
+        with self._lock:
+            obj = self.objects.get(Key)
+            if obj is None:
+                raise _client_error("404", "HeadObject", "Not Found")
+            return {
+                "ETag": obj["ETag"],
+                "ContentLength": len(obj["Body"]),
+                "LastModified": obj["LastModified"],
+                "Metadata": dict(obj["Metadata"]),
+            }
+
+    def put_object(self, Bucket: str, Key: str, Body=b"", IfMatch: Optional[str] = None,
+                   IfNoneMatch: Optional[str] = None, Metadata: Optional[Dict] = None, **kwargs):
+        self._call("PutObject")
+        if isinstance(Body, str):
+            Body = Body.encode("utf-8")
+        elif hasattr(Body, "read"):
+            Body = Body.read()
+        with self._lock:
+            current = self.objects.get(Key)
+            if IfNoneMatch == "*" and current is not None:
+                raise _client_error("PreconditionFailed", "PutObject", "At least one of the pre-conditions you specified did not hold")
+            if IfMatch is not None and (current is None or current["ETag"] != IfMatch):
+                code = "NoSuchKey" if current is None else "PreconditionFailed"
+                raise _client_error(code, "PutObject", "At least one of the pre-conditions you specified did not hold")
+            etag = '"%s"' % hashlib.md5(Body).hexdigest()
+            self.objects[Key] = {
+                "Body": bytes(Body),
+                "ETag": etag,
+                "LastModified": datetime.now(timezone.utc),
+                "Metadata": dict(Metadata or {}),
+            }
+            self.bytes_in += len(Body)
+            return {"ETag": etag}
+
+    def delete_object(self, Bucket: str, Key: str, **kwargs):
+        self._call("DeleteObject")
+        with self._lock:
+            self.objects.pop(Key, None)
+        return {}
+
+    def delete_objects(self, Bucket: str, Delete: Dict, **kwargs):
+        self._call("DeleteObjects")
+        with self._lock:
+            for obj in Delete["Objects"]:
+                self.objects.pop(obj["Key"], None)
+        return {}
+
+    def list_objects_v2(self, Bucket: str, Prefix: str = "", Delimiter: Optional[str] = None,
+                        MaxKeys: int = 1000, ContinuationToken: Optional[str] = None,
+                        StartAfter: Optional[str] = None, **kwargs):
+        self._call("ListObjectsV2")
+        after = ContinuationToken or StartAfter or ""
+        with self._lock:
+            keys = sorted(k for k in self.objects if k.startswith(Prefix) and k > after)
+            contents, prefixes = [], []
+            last = None
+            for key in keys:
+                if len(contents) + len(prefixes) >= MaxKeys:
+                    break
+                if Delimiter:
+                    cut = key.find(Delimiter, len(Prefix))
+                    if cut != -1:
+                        common = key[:cut + len(Delimiter)]
+                        if not prefixes or prefixes[-1] != common:
+                            prefixes.append(common)
+                        last = key
+                        continue
+                obj = self.objects[key]
+                contents.append({
+                    "Key": key,
+                    "ETag": obj["ETag"],
+                    "Size": len(obj["Body"]),
+                    "LastModified": obj["LastModified"],
+                })
+                last = key
+            truncated = last is not None and last != keys[-1]
+        page = {
+            "KeyCount": len(contents) + len(prefixes),
+            "IsTruncated": truncated,
+            "Contents": contents,
+        }
+        if prefixes:
+            page["CommonPrefixes"] = [{"Prefix": p} for p in prefixes]
+        if truncated:
+            page["NextContinuationToken"] = last
+        return page
+
+    def get_paginator(self, operation: str) -> _Paginator:
+        return _Paginator(self, operation)
+
+
+class FakeLLM:
+    """Stand-in for ``llm`` with a fixed latency and deterministic answers.
+
+    ``error_rate`` makes that fraction of calls raise, to exercise retries.
+    ``slow_rate`` makes that fraction take ``slow_latency`` instead, for a
+    latency tail. Setting ``down`` fails every call, as in an outage.
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, tokens: int = 50, seed: int = 0,
+                 slow_rate: float = 0.0, slow_latency: float = 0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.tokens = tokens
+        self.down = False
+        self.calls = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _latency(self) -> float:
+        with self._lock:
+            slow = self._rng.random() < self.slow_rate
+        return self.slow_latency if slow else self.latency
+
+    def _answer(self, question: str) -> str:
+        with self._lock:
+            self.calls += 1
+            fail = self.down or self._rng.random() < self.error_rate
+        if fail:
+            raise RuntimeError("Fake LLM error")
+        words = [f"w{i}" for i in range(self.tokens)]
+        return f"Answer to: {question}\n" + " ".join(words)
+
+    def generate_answer(self, question: str, model: str = None, context=()) -> str:
+        time.sleep(self._latency())
+        return self._answer(question)
+
+    def stream_answer_tokens(self, question: str, model: str = None, context=()):
+        answer = self._answer(question)
+        tokens = answer.split(" ")
+        latency = self._latency()
+        for i, token in enumerate(tokens):
+            time.sleep(latency / len(tokens))
+            yield token if i == 0 else " " + token
+
+    async def agenerate_answer(self, question: str, model: str = None, context=()) -> str:
+        await asyncio.sleep(self._latency())
+        return self._answer(question)
+
+    async def astream_answer_tokens(self, question: str, model: str = None, context=()):
+        answer = self._answer(question)
+        tokens = answer.split(" ")
+        latency = self._latency()
+        for i, token in enumerate(tokens):
+            await asyncio.sleep(latency / len(tokens))
+            yield token if i == 0 else " " + token
+
+
+class _FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        fake = self.server.fake
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        question = body.get("messages", [{}])[-1].get("content", "")
+        try:
+            answer = fake.llm._answer(question)
+        except RuntimeError as e:
+            payload = json.dumps({"error": {"message": str(e), "type": "server_error"}}).encode("utf-8")
+            self.send_response(fake.error_status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        base = {"id": "chatcmpl-fake", "created": int(time.time()), "model": body.get("model", "fake")}
+        if body.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            tokens = answer.split(" ")
+            latency = fake.llm._latency()
+            for i, token in enumerate(tokens):
+                time.sleep(latency / len(tokens))
+                chunk = {**base, "object": "chat.completion.chunk", "choices": [
+                    {"index": 0, "delta": {"content": token if i == 0 else " " + token}, "finish_reason": None}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.close_connection = True
+            return
+        time.sleep(fake.llm._latency())
+        payload = json.dumps({**base, "object": "chat.completion", "choices": [
+            {"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": len(question.split()), "completion_tokens": fake.llm.tokens,
+                      "total_tokens": len(question.split()) + fake.llm.tokens}}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class FakeOpenAIServer:
+    """Local HTTP server speaking the OpenAI chat-completions API, backed by ``FakeLLM``.
+
+    Point a client at ``url`` (``openai.api_base`` or ``base_url``) to run
+    the real request path, streaming included, without network access.
+    Failed calls are answered with ``error_status``.
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, tokens: int = 50, port: int = 0,
+                 slow_rate: float = 0.0, slow_latency: float = 0.0, error_status: int = 500):
+        self.llm = FakeLLM(latency=latency, error_rate=error_rate, tokens=tokens,
+                           slow_rate=slow_rate, slow_latency=slow_latency)
+        self.error_status = error_status
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), _FakeOpenAIHandler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}/v1"
+
+    def start(self) -> "FakeOpenAIServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-openai", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
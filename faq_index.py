@@ -0,0 +1,349 @@
+"""BM25 index over stored question/answer pairs, used to suggest related FAQs.
+
+The index is built offline into one compact binary file and memory-mapped
+at startup: only the term dictionary is parsed, while postings, document
+lengths and the documents themselves are read straight from the mapping.
+Pairs saved after the file was built go into a small in-memory delta that
+is searched alongside it, and the file is rewritten in the background once
+the delta grows past ``rebuild_every`` pairs. Where the file's directory is
+read-only (the code directory on Lambda) the merged file is written to the
+temporary directory instead and mapped from there. If no file can be
+written at all, the delta keeps only the newest ``max_delta`` pairs.
+
+Build the file from every stored history with::
+
+    python faq_index.py --out faq_index.bin
+
+The build leaves out the same pairs the chat routes keep out online: turns
+stored with ``faq: False`` (template answers, and answers drawn from or
+about a user's own history), plus any turn whose question the router sends
+to a template or treats as leaning on the conversation, which covers turns
+stored before that flag existed.
+"""
+import argparse
+import array
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+import tempfile
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from answer_cache import normalize_question
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"FAQIDX1\0"
+_TOKEN = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset(
+    "a an and are as at be but by can do does for from give have how i if in into is it me my "
+    "of on or please so some tell than that the their them then there these this to was what "
+    "when where which who why will with would you your".split()
+)
+# Question terms count this many times more than answer terms
+QUESTION_WEIGHT = 3
+# Only the start of an answer is indexed; long roadmaps would swamp the scores
+ANSWER_CHARS = 600
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in _TOKEN.findall(text.lower()) if t not in STOPWORDS and len(t) > 1]
+
+
+def doc_terms(question: str, answer: str) -> Counter:
+    terms = Counter()
+    for term in tokenize(question):
+        terms[term] += QUESTION_WEIGHT
+    terms.update(tokenize(answer[:ANSWER_CHARS]))
+    return terms
+
+
+def question_hash(question: str) -> int:
+    digest = hashlib.blake2b(normalize_question(question).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def _align(buf: bytearray):
+    buf.extend(b"\0" * (-len(buf) % 8))
+
+
+def write_index(path: str, docs: Iterable[Tuple[str, str]]):
+    """Write the binary index for ``(question, answer)`` pairs to ``path``.
+
+    Later duplicates of the same normalized question replace earlier ones.
+    """
+    unique: Dict[int, Tuple[str, str]] = {}
+    for question, answer in docs:
+        unique[question_hash(question)] = (question, answer)
+    hashes = list(unique)
+
+    postings = defaultdict(list)
+    doc_lens = array.array("I")
+    doc_offsets = array.array("Q", [0])
+    blob = bytearray()
+    for doc_id, qhash in enumerate(hashes):
+        question, answer = unique[qhash]
+        terms = doc_terms(question, answer)
+        for term, tf in terms.items():
+            postings[term].append((doc_id, min(tf, 0xFFFF)))
+        doc_lens.append(sum(terms.values()))
+        blob.extend(json.dumps({"question": question, "answer": answer}).encode("utf-8"))
+        doc_offsets.append(len(blob))
+
+    term_dict = {}
+    post_docs = array.array("I")
+    post_tfs = array.array("H")
+    for term in sorted(postings):
+        term_dict[term] = [len(post_docs), len(postings[term])]
+        for doc_id, tf in postings[term]:
+            post_docs.append(doc_id)
+            post_tfs.append(tf)
+
+    sections = {
+        "terms": json.dumps(term_dict, separators=(",", ":")).encode("utf-8"),
+        "post_docs": post_docs.tobytes(),
+        "post_tfs": post_tfs.tobytes(),
+        "doc_lens": doc_lens.tobytes(),
+        "doc_offsets": doc_offsets.tobytes(),
+        "qhashes": array.array("Q", hashes).tobytes(),
+        "docs": bytes(blob),
+    }
+    body = bytearray()
+    layout = {}
+    for name, data in sections.items():
+        _align(body)
+        layout[name] = [len(body), len(data)]
+        body.extend(data)
+    header = json.dumps({
+        "n_docs": len(hashes),
+        "total_len": sum(doc_lens),
+        "byteorder": sys.byteorder,
+        "sections": layout,
+    }).encode("utf-8")
+    # Section offsets are relative to the (8-byte aligned) end of the header
+    prefix = bytearray(MAGIC + struct.pack("<I", len(header)) + header)
+    _align(prefix)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(prefix)
+        f.write(body)
+    os.replace(tmp, path)
+
+
+class _MappedIndex:
+    """Read-only view of an index file."""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:8] != MAGIC:
+            raise ValueError(f"{path} is not a FAQ index")
+        (header_len,) = struct.unpack_from("<I", self._mm, 8)
+        header = json.loads(self._mm[12:12 + header_len])
+        if header["byteorder"] != sys.byteorder:
+            raise ValueError(f"{path} was built on a {header['byteorder']}-endian machine")
+        base = 12 + header_len
+        base += -base % 8
+        view = memoryview(self._mm)
+
+        def section(name):
+            offset, length = header["sections"][name]
+            return view[base + offset:base + offset + length]
+
+        self.n_docs = header["n_docs"]
+        self.total_len = header["total_len"]
+        self.terms = json.loads(bytes(section("terms")))
+        self.post_docs = section("post_docs").cast("I")
+        self.post_tfs = section("post_tfs").cast("H")
+        self.doc_lens = section("doc_lens").cast("I")
+        self.doc_offsets = section("doc_offsets").cast("Q")
+        self.qhashes = set(section("qhashes").cast("Q"))
+        self._docs = section("docs")
+
+    def postings(self, term: str):
+        entry = self.terms.get(term)
+        if entry is None:
+            return ()
+        start, count = entry
+        return zip(self.post_docs[start:start + count], self.post_tfs[start:start + count])
+
+    def doc(self, doc_id: int) -> Dict:
+        return json.loads(bytes(self._docs[self.doc_offsets[doc_id]:self.doc_offsets[doc_id + 1]]))
+
+    def docs(self):
+        for doc_id in range(self.n_docs):
+            yield self.doc(doc_id)
+
+
+class FAQIndex:
+    """Mapped base index plus an in-memory delta of newly saved pairs."""
+
+    def __init__(self, path: str, rebuild_every: int = 200, max_delta: int = 2000,
+                 k1: float = 1.2, b: float = 0.75):
+        self.path = path
+        # Where merged files go; moves to the temporary directory if ``path`` is read-only
+        self.write_path = path
+        self.rebuild_every = rebuild_every
+        self.max_delta = max_delta
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        self._rebuilding = False
+        self._rebuild_disabled = False
+        self._base: Optional[_MappedIndex] = None
+        if os.path.exists(path):
+            try:
+                self._base = _MappedIndex(path)
+            except (ValueError, OSError):
+                logger.exception("Ignoring unreadable FAQ index %s", path)
+        self._reset_delta()
+
+    def _reset_delta(self):
+        self._delta_docs: List[Dict] = []
+        self._delta_lens: List[int] = []
+        self._delta_postings = defaultdict(list)
+        self._delta_hashes = set()
+
+    def __len__(self) -> int:
+        return (self._base.n_docs if self._base else 0) + len(self._delta_docs)
+
+    def _add_delta(self, qhash: int, doc: Dict):
+        # Called with self._lock held
+        doc_id = len(self._delta_docs)
+        terms = doc_terms(doc["question"], doc["answer"])
+        for term, tf in terms.items():
+            self._delta_postings[term].append((doc_id, tf))
+        self._delta_docs.append(doc)
+        self._delta_lens.append(sum(terms.values()))
+        self._delta_hashes.add(qhash)
+
+    def _trim_delta(self):
+        # Called with self._lock held: with nowhere to merge the delta, keep
+        # the newest half of ``max_delta`` pairs rather than grow without bound
+        keep = self._delta_docs[-(self.max_delta // 2):]
+        self._reset_delta()
+        for doc in keep:
+            self._add_delta(question_hash(doc["question"]), doc)
+
+    def add(self, question: str, answer: str):
+        """Make a newly saved pair searchable; questions already indexed are skipped."""
+        qhash = question_hash(question)
+        with self._lock:
+            if qhash in self._delta_hashes or (self._base and qhash in self._base.qhashes):
+                return
+            if len(self._delta_docs) >= self.max_delta:
+                self._trim_delta()
+            self._add_delta(qhash, {"question": question, "answer": answer})
+            start_rebuild = (len(self._delta_docs) >= self.rebuild_every
+                             and not self._rebuilding and not self._rebuild_disabled)
+            if start_rebuild:
+                self._rebuilding = True
+        if start_rebuild:
+            threading.Thread(target=self.rebuild, name="faq-rebuild", daemon=True).start()
+
+    def rebuild(self):
+        """Fold the delta into a new index file and map it."""
+        try:
+            with self._lock:
+                base = self._base
+                delta = list(self._delta_docs)
+            docs = list(base.docs()) if base else []
+            docs.extend(delta)
+            try:
+                write_index(self.write_path, ((d["question"], d["answer"]) for d in docs))
+            except OSError:
+                if self.write_path != self.path:
+                    raise
+                # Typically a read-only deployment directory
+                self.write_path = os.path.join(tempfile.gettempdir(), os.path.basename(self.path))
+                logger.warning("Cannot write FAQ index %s; merging into %s instead", self.path, self.write_path)
+                write_index(self.write_path, ((d["question"], d["answer"]) for d in docs))
+            mapped = _MappedIndex(self.write_path)
+            with self._lock:
+                # Keep pairs added while the file was being written
+                pending = self._delta_docs[len(delta):]
+                self._base = mapped
+                self._reset_delta()
+            for doc in pending:
+                self.add(doc["question"], doc["answer"])
+        except OSError:
+            # Search keeps using the delta, trimmed to ``max_delta`` pairs
+            self._rebuild_disabled = True
+            logger.exception("Rebuilding FAQ index %s failed; keeping the in-memory delta", self.write_path)
+        finally:
+            self._rebuilding = False
+
+    def search(self, query: str, k: int = 3, exclude: Iterable[str] = ()) -> List[Dict]:
+        """Top-``k`` stored pairs for ``query`` by BM25, skipping ``exclude`` questions."""
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        skip = {question_hash(q) for q in exclude}
+        with self._lock:
+            base = self._base
+            n_base = base.n_docs if base else 0
+            n_docs = n_base + len(self._delta_docs)
+            if not n_docs:
+                return []
+            avg_len = ((base.total_len if base else 0) + sum(self._delta_lens)) / n_docs
+            scores = defaultdict(float)
+            for term in terms:
+                base_postings = list(base.postings(term)) if base else []
+                delta_postings = self._delta_postings.get(term, [])
+                df = len(base_postings) + len(delta_postings)
+                if not df:
+                    continue
+                idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+                for doc_id, tf in base_postings:
+                    scores[doc_id] += self._bm25(idf, tf, base.doc_lens[doc_id], avg_len)
+                for doc_id, tf in delta_postings:
+                    scores[n_base + doc_id] += self._bm25(idf, tf, self._delta_lens[doc_id], avg_len)
+            ranked = sorted(scores.items(), key=lambda item: -item[1])
+            results = []
+            for doc_id, score in ranked:
+                doc = base.doc(doc_id) if doc_id < n_base else self._delta_docs[doc_id - n_base]
+                if question_hash(doc["question"]) in skip:
+                    continue
+                results.append({**doc, "score": round(score, 4)})
+                if len(results) == k:
+                    break
+            return results
+
+    def _bm25(self, idf: float, tf: int, doc_len: int, avg_len: float) -> float:
+        return idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * doc_len / avg_len))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the FAQ index from stored chat histories.")
+    parser.add_argument("--out", default=os.environ.get("FAQ_INDEX_PATH", "faq_index.bin"))
+    args = parser.parse_args()
+
+    import router
+    from storage import get_storage
+    storage = get_storage()
+
+    def shareable(chat: Dict) -> bool:
+        if chat.get("faq") is False:
+            return False
+        decision = router.classify(chat["question"])
+        return decision.route != router.TEMPLATE and not decision.follows_on
+
+    def pairs():
+        for user_id in storage.list_active_users():
+            for chat in storage.load_chat_history_readonly(user_id).values():
+                if shareable(chat):
+                    yield chat["question"], chat["answer"]
+
+    write_index(args.out, pairs())
+    print(f"Wrote {len(FAQIndex(args.out))} FAQs to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""Compact binary encoding for chat history snapshots.
+
+A history snapshot is the ``{title: {"question", "answer", ...}}`` dict.
+In JSON every turn spells out its keys, and long markdown answers that
+repeat across turns are stored again each time. ``dumps`` writes instead:
+
+- a 6-byte header: ``MAGIC`` (4 bytes), the format ``VERSION`` and the
+  compression (``ZLIB`` or ``ZSTD``);
+- the compressed payload: the string and turn counts, the byte length of
+  each distinct string, one row of string indexes per turn (title,
+  question, answer, and any other fields as a JSON object, or nothing),
+  then the strings themselves as UTF-8, each stored once.
+
+Counts, lengths and indexes are little-endian uint32 arrays, so decoding
+is a few bulk copies plus one slice per distinct string.
+
+``loads`` reads either format, so JSON snapshots written before this
+format existed keep working. Use ``is_binary`` to tell which one was read.
+zstd is used only when ``CHAT_HISTORY_COMPRESSION=zstd`` is set. It needs
+the optional ``zstandard`` package wherever such snapshots are read.
+"""
+import json
+import os
+import struct
+import sys
+import zlib
+from array import array
+from typing import Dict, List, Tuple
+
+MAGIC = b"IMGH"
+VERSION = 1
+ZLIB = 1
+ZSTD = 2
+COMPRESSION = {"zlib": ZLIB, "zstd": ZSTD}[os.environ.get("CHAT_HISTORY_COMPRESSION", "zlib")]
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 9
+HEADER_SIZE = len(MAGIC) + 2
+CORE_FIELDS = ("question", "answer")
+
+
+class FormatError(ValueError):
+    pass
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise FormatError("zstd-compressed history needs the zstandard package") from None
+    return zstandard
+
+
+def _u32(values) -> bytes:
+    data = array("I", values)
+    if sys.byteorder == "big":
+        data.byteswap()
+    return data.tobytes()
+
+
+def _read_u32(data: bytes, pos: int, count: int) -> Tuple[array, int]:
+    end = pos + 4 * count
+    values = array("I")
+    values.frombytes(data[pos:end])
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values, end
+
+
+def is_binary(data: bytes) -> bool:
+    return data[:len(MAGIC)] == MAGIC
+
+
+def encode_payload(chats: Dict) -> bytes:
+    strings: Dict[str, int] = {}
+    rows: List[int] = []
+
+    def ref(text: str) -> int:
+        index = strings.get(text)
+        if index is None:
+            index = strings[text] = len(strings)
+        return index
+
+    for title, turn in chats.items():
+        extra = {k: v for k, v in turn.items() if k not in CORE_FIELDS}
+        # 0 means "no extra fields"; other references are shifted by one
+        extra_ref = ref(json.dumps(extra, sort_keys=True)) + 1 if extra else 0
+        rows += (ref(title), ref(turn.get("question", "")), ref(turn.get("answer", "")), extra_ref)
+
+    encoded = [text.encode("utf-8") for text in strings]
+    return b"".join((
+        struct.pack("<II", len(encoded), len(chats)),
+        _u32(len(raw) for raw in encoded),
+        _u32(rows),
+        *encoded,
+    ))
+
+
+def decode_payload(payload: bytes) -> Dict:
+    count, turns = struct.unpack_from("<II", payload)
+    lengths, pos = _read_u32(payload, 8, count)
+    rows, pos = _read_u32(payload, pos, 4 * turns)
+    strings = []
+    for size in lengths:
+        strings.append(payload[pos:pos + size].decode("utf-8"))
+        pos += size
+    chats = {}
+    for i in range(0, len(rows), 4):
+        title, question, answer, extra = rows[i:i + 4]
+        turn = {"question": strings[question], "answer": strings[answer]}
+        if extra:
+            turn.update(json.loads(strings[extra - 1]))
+        chats[strings[title]] = turn
+    return chats
+
+
+def dumps(chats: Dict, compression: int = COMPRESSION) -> bytes:
+    payload = encode_payload(chats)
+    if compression == ZSTD:
+        body = _zstd().ZstdCompressor(level=ZSTD_LEVEL).compress(payload)
+    else:
+        body = zlib.compress(payload, ZLIB_LEVEL)
+    return MAGIC + bytes((VERSION, compression)) + body
+
+
+def loads(data: bytes) -> Dict:
+    """Decode a snapshot in either the binary format or legacy JSON."""
+    if not is_binary(data):
+        return json.loads(data.decode("utf-8")) if data else {}
+    version, compression = data[len(MAGIC)], data[len(MAGIC) + 1]
+    if version != VERSION:
+        raise FormatError(f"Unsupported history format version {version}")
+    body = data[HEADER_SIZE:]
+    if compression == ZLIB:
+        payload = zlib.decompress(body)
+    elif compression == ZSTD:
+        payload = _zstd().ZstdDecompressor().decompress(body)
+    else:
+        raise FormatError(f"Unknown history compression {compression}")
+    return decode_payload(payload)
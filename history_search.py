@@ -0,0 +1,298 @@
+"""Per-user full-text search over chat history.
+
+Each user has one ``UserIndex``: an inverted index from term to the turns
+that contain it, by title, with each turn's question and the start of its
+answer for the results. It is stored as zlib-compressed
+JSON in two parts: a base index (``ChatStorage.load_search_index`` /
+``save_search_index``) and the segments written since
+(``append_search_segment``). ``HistorySearch.index_records`` runs as a
+``WriteBehindQueue`` listener right after each batch is stored and writes
+that batch as one small segment, so a chat never rewrites the whole index.
+Once ``merge_every`` segments pile up, the writer merges them into the
+base with a conditional save and deletes them; the base records the last
+segment it holds, so a segment read twice is not applied twice.
+
+A search reads the base and the unmerged segments, ranks the turns by
+BM25, with question terms weighted like the FAQ index and newer turns
+winning ties, and builds the page's snippets from the index alone. Matches
+are wrapped in ``**`` for markdown. A user who has no base index yet
+(history saved before search existed), or one without the turns' text
+(version 2), gets one built from their history on the first search or
+merge.
+"""
+import json
+import logging
+import math
+import re
+import zlib
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from faq_index import QUESTION_WEIGHT, tokenize
+from metrics import timed
+from storage import ChatStorage, LRUCache
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 3
+SNIPPET_CHARS = 240
+# How much of each answer the index keeps for snippets; a match past this
+# shows the start of the answer instead
+ANSWER_TEXT_CHARS = 2000
+# Unmerged segments a user's index may have before the writer merges them
+MERGE_EVERY = 16
+K1 = 1.2
+B = 0.75
+
+
+def turn_terms(question: str, answer: str) -> Dict[str, int]:
+    terms = defaultdict(int)
+    for term in tokenize(question):
+        terms[term] += QUESTION_WEIGHT
+    for term in tokenize(answer):
+        terms[term] += 1
+    return terms
+
+
+def highlight(text: str, pattern) -> str:
+    return pattern.sub(lambda m: f"**{m.group(0)}**", text)
+
+
+def snippet(text: str, pattern, width: int = SNIPPET_CHARS) -> str:
+    """About ``width`` characters of ``text`` around its first match, highlighted."""
+    match = pattern.search(text)
+    start = max(0, (match.start() if match else 0) - width // 3)
+    if start:
+        # Start on a word boundary
+        space = text.find(" ", start)
+        start = space + 1 if 0 <= space < start + 20 else start
+    end = min(len(text), start + width)
+    clip = text[start:end].replace("\n", " ")
+    return ("..." if start else "") + highlight(clip, pattern) + ("..." if end < len(text) else "")
+
+
+class UserIndex:
+    def __init__(self):
+        # One title per turn; None once the title is overwritten
+        self.docs: List[Optional[str]] = []
+        # (question, start of the answer) per turn; None if not known
+        self.texts: List[Optional[Tuple[str, str]]] = []
+        self.lengths: List[int] = []
+        self.postings: Dict[str, List[int]] = {}  # term -> [doc, tf, doc, tf, ...]
+        self.titles: Dict[str, int] = {}
+        self.total_length = 0
+        self.live = 0
+        # Name of the newest segment merged into this index
+        self.through = ""
+
+    def _append(self, title: str, length: int, text: Optional[Tuple[str, str]]) -> int:
+        old = self.titles.get(title)
+        if old is not None:
+            # A turn saved under an existing title replaces it, as in the history
+            self.docs[old] = None
+            self.texts[old] = None
+            self.total_length -= self.lengths[old]
+            self.live -= 1
+        doc = len(self.docs)
+        self.docs.append(title)
+        self.texts.append(text)
+        self.lengths.append(length)
+        self.titles[title] = doc
+        self.total_length += length
+        self.live += 1
+        return doc
+
+    def add(self, title: str, question: str, answer: str):
+        terms = turn_terms(question, answer)
+        doc = self._append(title, sum(terms.values()), (question, answer[:ANSWER_TEXT_CHARS]))
+        for term, tf in terms.items():
+            self.postings.setdefault(term, []).extend((doc, tf))
+
+    def extend(self, other: "UserIndex"):
+        """Append the turns of ``other`` (e.g. a segment) after this index's own."""
+        docs = {}
+        for doc, title in enumerate(other.docs):
+            if title is not None:
+                docs[doc] = self._append(title, other.lengths[doc], other.texts[doc])
+        for term, entries in other.postings.items():
+            target = self.postings.setdefault(term, [])
+            for i in range(0, len(entries), 2):
+                if entries[i] in docs:
+                    target.extend((docs[entries[i]], entries[i + 1]))
+
+    def add_records(self, records: List[Dict]):
+        for record in records:
+            self.add(record["title"], record["question"], record["answer"])
+
+    @classmethod
+    def from_history(cls, chats: Dict) -> "UserIndex":
+        index = cls()
+        for title, turn in chats.items():
+            index.add(title, turn["question"], turn["answer"])
+        return index
+
+    def dumps(self) -> bytes:
+        # Postings of overwritten turns are dropped when the index is saved
+        postings = {}
+        for term, entries in self.postings.items():
+            kept = [v for i in range(0, len(entries), 2) if self.docs[entries[i]] is not None
+                    for v in entries[i:i + 2]]
+            if kept:
+                postings[term] = kept
+        docs = [title if title is None else [title, *(text or ())] for title, text in zip(self.docs, self.texts)]
+        data = {"v": FORMAT_VERSION, "docs": docs, "lengths": self.lengths, "postings": postings,
+                "through": self.through}
+        return zlib.compress(json.dumps(data, separators=(",", ":")).encode("utf-8"), 6)
+
+    @classmethod
+    def loads(cls, raw: bytes) -> "UserIndex":
+        data = json.loads(zlib.decompress(raw).decode("utf-8"))
+        if data.get("v") not in (1, 2, FORMAT_VERSION):
+            raise ValueError(f"Unsupported search index version {data.get('v')}")
+        index = cls()
+        # Versions 1 and 3 keep [title, question, answer] per turn, version 2 only the title
+        for doc in data["docs"]:
+            if isinstance(doc, list):
+                index.docs.append(doc[0])
+                index.texts.append((doc[1], doc[2][:ANSWER_TEXT_CHARS]) if len(doc) == 3 else None)
+            else:
+                index.docs.append(doc)
+                index.texts.append(None)
+        index.lengths = data["lengths"]
+        index.postings = data["postings"]
+        index.through = data.get("through", "")
+        for doc, title in enumerate(index.docs):
+            if title is not None:
+                index.titles[title] = doc
+                index.total_length += index.lengths[doc]
+                index.live += 1
+        return index
+
+    def missing_text(self) -> bool:
+        return any(text is None for title, text in zip(self.docs, self.texts) if title is not None)
+
+    def search(self, query: str) -> List[Tuple[float, int]]:
+        """``(score, doc)`` for every turn matching ``query``, best first."""
+        terms = set(tokenize(query))
+        if not terms or not self.live:
+            return []
+        avg_length = self.total_length / self.live
+        scores = defaultdict(float)
+        for term in terms:
+            entries = self.postings.get(term, ())
+            matches = [(entries[i], entries[i + 1]) for i in range(0, len(entries), 2)
+                       if self.docs[entries[i]] is not None]
+            if not matches:
+                continue
+            idf = math.log(1 + (self.live - len(matches) + 0.5) / (len(matches) + 0.5))
+            for doc, tf in matches:
+                norm = K1 * (1 - B + B * self.lengths[doc] / avg_length)
+                scores[doc] += idf * tf * (K1 + 1) / (tf + norm)
+        return sorted(((score, doc) for doc, score in scores.items()), key=lambda item: (-item[0], -item[1]))
+
+
+class HistorySearch:
+    """Loads, updates and queries users' search indexes in ``storage``.
+
+    ``load_history(user_id)`` returns the full history; it builds a base
+    index that does not exist yet or lacks the turns' text.
+    """
+
+    def __init__(self, storage: ChatStorage, load_history: Callable[[str], Dict], cache_size: int = 64,
+                 merge_every: int = MERGE_EVERY):
+        self.storage = storage
+        self.load_history = load_history
+        self.merge_every = merge_every
+        # Decoded indexes by user, reused while the base and segments are unchanged
+        self._cache = LRUCache(cache_size)
+        # Unmerged segments per user, as last seen by this process
+        self._segment_counts = LRUCache(cache_size * 4)
+
+    def _combine(self, user_id: str, raw: Optional[bytes],
+                 segments: List[Tuple[str, bytes]]) -> Tuple[UserIndex, bool]:
+        """The base index ``raw`` with newer ``segments`` applied, and whether it was rebuilt.
+
+        It is built from the history instead when ``raw`` is None or any
+        of its turns lack their text.
+        """
+        if raw is not None:
+            index = UserIndex.loads(raw)
+            for name, data in segments:
+                if name > index.through:
+                    index.extend(UserIndex.loads(data))
+                    index.through = name
+            if not index.missing_text():
+                return index, False
+        # The history already holds every stored segment's turns
+        index = UserIndex.from_history(self.load_history(user_id))
+        index.through = segments[-1][0] if segments else ""
+        return index, True
+
+    def load(self, user_id: str) -> UserIndex:
+        with timed("storage_read"):
+            raw, version = self.storage.load_search_index(user_id)
+            segments = self.storage.load_search_segments(user_id)
+        key = (version, tuple(name for name, _ in segments))
+        cached = self._cache.get(user_id)
+        if cached and cached[0] == key:
+            return cached[1]
+        self._segment_counts.put(user_id, len(segments))
+        index, rebuilt = self._combine(user_id, raw, segments)
+        if rebuilt:
+            # Losing this race is fine: whoever won built it from the same history
+            self.storage.save_search_index(user_id, index.dumps(), version)
+        self._cache.put(user_id, (key, index))
+        return index
+
+    def index_records(self, user_id: str, records: List[Dict]):
+        """Store turns that have just been written for ``user_id`` as one new segment."""
+        segment = UserIndex()
+        segment.add_records(records)
+        self.storage.append_search_segment(user_id, segment.dumps())
+        count = self._segment_counts.get(user_id)
+        if count is None:
+            count = len(self.storage.load_search_segments(user_id))
+        else:
+            count += 1
+        self._segment_counts.put(user_id, count)
+        if count >= self.merge_every:
+            self.merge(user_id)
+
+    def merge(self, user_id: str) -> bool:
+        """Fold the user's segments into their base index and delete them.
+
+        False if another writer replaced the base first; the segments then
+        stay for the next merge.
+        """
+        raw, version = self.storage.load_search_index(user_id)
+        segments = self.storage.load_search_segments(user_id)
+        index, _ = self._combine(user_id, raw, segments)
+        if not self.storage.save_search_index(user_id, index.dumps(), version):
+            logger.info("Search index for %s changed while merging; merging later", user_id)
+            return False
+        self.storage.delete_search_segments(user_id, [name for name, _ in segments])
+        self._segment_counts.put(user_id, 0)
+        return True
+
+    def search(self, user_id: str, query: str, cursor: Optional[str] = None, limit: int = 10) -> Dict:
+        """One page of ranked, highlighted matches and the cursor of the next page.
+
+        The cursor is the offset into the ranking, so turns written while a
+        client is paging can shift later pages.
+        """
+        index = self.load(user_id)
+        ranked = index.search(query)
+        offset = int(cursor) if cursor else 0
+        terms = sorted(set(tokenize(query)), key=len, reverse=True)
+        pattern = re.compile(r"\b(" + "|".join(map(re.escape, terms)) + r")\b", re.IGNORECASE) if terms else None
+        results = []
+        for score, doc in ranked[offset:offset + limit]:
+            question, answer = index.texts[doc]
+            results.append({
+                "title": index.docs[doc],
+                "question": highlight(question, pattern),
+                "snippet": snippet(answer, pattern),
+                "score": round(score, 4),
+            })
+        end = offset + len(results)
+        return {"results": results, "total": len(ranked), "next_cursor": str(end) if end < len(ranked) else None}
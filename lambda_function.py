@@ -1,25 +1,184 @@
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
-import boto3
-from botocore.exceptions import ClientError
-from typing import Dict
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+import asyncio
 import json
+import logging
 import os
+import signal
+import threading
+import time
 from mangum import Mangum
-import openai
+
+import llm
+import metrics
+import router
+from admission import AdmissionController, Rejected
+from answer_cache import AnswerCache, normalize_question
+from context import SUMMARY_MAX_TOKENS, RollingSummarizer, build_context
+from event_log import EventBuffer, get_event_sink, rating_summary
+from faq_index import FAQIndex
+from history_search import HistorySearch
+from metrics import MetricsMiddleware, TimedJSONResponse, timed
+from resilience import CircuitOpen
+from single_flight import SingleFlight
+from storage import call_async, find_request, get_storage, get_summary, history_version, paginate_history
+from write_behind import WriteBehindQueue
 
 # === Configuration ===
+# The Lambda runtime installs its own log handler; structured request logs are INFO
+logging.getLogger().setLevel(os.environ.get("LOG_LEVEL", "INFO"))
 S3_BUCKET = "img-chat-history"
-openai.api_key = os.environ.get("OPENAI_API_KEY")
-s3 = boto3.client("s3")
+# CHAT_STORAGE selects the backend (s3, file or sqlite); S3 stays the default here
+storage = get_storage("s3", bucket=S3_BUCKET)
+# Turns are persisted in the background; see handler() for the Lambda flush
+write_queue = WriteBehindQueue(storage)
+WRITE_FLUSH_TIMEOUT = float(os.environ.get("WRITE_FLUSH_TIMEOUT", "10"))
+ON_LAMBDA = bool(os.environ.get("AWS_LAMBDA_FUNCTION_NAME"))
+# Summary updates are LLM calls. On Lambda, where a frozen container would cut
+# them off, each runs in its own asynchronous invocation of this function
+# ("invoke"; the role needs lambda:InvokeFunction on it) rather than holding
+# up a reply; elsewhere a background thread runs them ("thread")
+SUMMARY_UPDATES = os.environ.get("SUMMARY_UPDATES", "invoke" if ON_LAMBDA else "thread")
+# Ratings and contact messages are buffered and written as batched segments,
+# flushed at the end of an invocation only once a batch is full or old enough
+event_sink = get_event_sink(storage)
+events = EventBuffer(
+    event_sink,
+    max_events=int(os.environ.get("EVENT_BATCH_SIZE", "100")),
+    max_age=float(os.environ.get("EVENT_BATCH_AGE", "60")),
+)
+# Answers to context-free prompts depend only on the question, so they can be
+# shared across users; answers that drew on a user's history are never cached
+answer_cache = AnswerCache(
+    max_entries=int(os.environ.get("ANSWER_CACHE_SIZE", "1000")),
+    ttl=float(os.environ.get("ANSWER_CACHE_TTL", str(24 * 3600))),
+)
+# Related-FAQ suggestions come from a prebuilt BM25 index, no LLM involved
+faq_index = FAQIndex(os.environ.get("FAQ_INDEX_PATH", os.path.join(os.path.dirname(__file__), "faq_index.bin")))
+FAQ_INTRO = "Here are some related FAQs:"
+# Identical chats in flight at the same time share one LLM call
+flights = SingleFlight()
+# LLM calls go through a global concurrency limit, per-user rate limits and
+# a fair queue; chats that cannot get a slot in time are answered with 429
+admission = AdmissionController()
+_lambda_client = None
+
+def invoke_summary_updates(user_ids: List[str]):
+    """Start one asynchronous invocation of this function per user; see handler()."""
+    global _lambda_client
+    if _lambda_client is None:
+        import boto3
+        _lambda_client = boto3.client("lambda")
+    for user_id in user_ids:
+        _lambda_client.invoke(
+            FunctionName=os.environ["AWS_LAMBDA_FUNCTION_NAME"],
+            InvocationType="Event",
+            Payload=json.dumps({"summarize": user_id}).encode("utf-8"),
+        )
+
+# Prompts carry a token-budgeted slice of the user's history plus a rolling
+# summary (kept in user meta), updated outside the request; see SUMMARY_UPDATES
+summarizer = RollingSummarizer(
+    storage,
+    load_history=lambda user_id: write_queue.overlay(user_id, *storage.load_versioned(user_id))[0],
+    summarize=lambda messages: llm.complete(messages, llm.SUMMARY_MODEL, 2 * SUMMARY_MAX_TOKENS),
+    dispatch=invoke_summary_updates if SUMMARY_UPDATES == "invoke" else None,
+)
+# Per-user inverted indexes behind /search-history, updated by the background
+# writer as each batch of turns is stored
+history_search = HistorySearch(
+    storage,
+    load_history=lambda user_id: write_queue.overlay(user_id, *storage.load_versioned(user_id))[0],
+)
+write_queue.add_listener(history_search.index_records)
+
+# openai and boto3 are imported, and the S3 client built, on first use so
+# cold starts for routes that need neither skip them. PREWARM_CLIENTS
+# chooses when that first use happens: "background" (a thread started
+# during init), "init" (before init finishes; suits provisioned
+# concurrency) or "off" (the first request that needs them).
+PREWARM_CLIENTS = os.environ.get("PREWARM_CLIENTS", "background")
+
+def prewarm_clients():
+    try:
+        storage.warm()
+        llm.warm()
+    except Exception:
+        logging.exception("Pre-warming clients failed; they will be created on first use")
+
+if PREWARM_CLIENTS == "init":
+    prewarm_clients()
+elif PREWARM_CLIENTS == "background":
+    threading.Thread(target=prewarm_clients, name="prewarm", daemon=True).start()
+
+app = FastAPI(default_response_class=TimedJSONResponse)
+# Server-Timing headers, one JSON log line per request and the /metrics data
+app.add_middleware(MetricsMiddleware)
+asgi_handler = Mangum(app)
+
+def handler(event, context):
+    if "summarize" in event:
+        # Sent by invoke_summary_updates: no client is waiting on this one
+        summary, added = summarizer.update(event["summarize"])
+        return {"user_id": event["summarize"], "summarized": added, "through": summary["through"]}
+    try:
+        return asgi_handler(event, context)
+    finally:
+        # Lambda may freeze the container as soon as we return, so queued
+        # turns have to reach storage before the invocation ends. Summary
+        # updates due every SUMMARY_EVERY turns are started after the writes
+        # so they see them. Events are batched across invocations and
+        # written once a batch is due.
+        write_queue.flush(WRITE_FLUSH_TIMEOUT)
+        if summarizer.dispatch is not None:
+            summarizer.dispatch_due()
+        events.flush_due()
+
+@app.on_event("shutdown")
+def flush_writes():
+    write_queue.flush(WRITE_FLUSH_TIMEOUT)
+    events.flush()
+
+def on_sigterm(signum, frame):
+    # Lambda sends SIGTERM before shutting a container down, but only when an
+    # extension is registered; without one, events still buffered in a
+    # container that is reclaimed (at most EVENT_BATCH_AGE seconds' worth)
+    # are lost
+    flush_writes()
+    raise SystemExit(0)
 
-app = FastAPI()
-handler = Mangum(app)
+if ON_LAMBDA and threading.current_thread() is threading.main_thread():
+    signal.signal(signal.SIGTERM, on_sigterm)
 
 # === Models ===
 class ChatRequest(BaseModel):
     user_id: str
     question: str
+    bypass_cache: bool = False
+    # Idempotency key (also accepted as an Idempotency-Key header): a retry
+    # with the same key gets the original answer and saves nothing new
+    request_id: Optional[str] = None
+
+class FAQRequest(BaseModel):
+    user_id: str
+    question: Optional[str] = None
+    chat_history: List[Dict] = []
+    k: int = 5
+
+class RatingRequest(BaseModel):
+    user_id: str
+    question: str
+    rating: int
+    suggestion: Optional[str] = None
+    # The "route" of the rated answer, so ratings can be compared per route
+    route: Optional[str] = None
+
+class ContactRequest(BaseModel):
+    name: str
+    email: str
+    message: str
 
 class ChangeUserRequest(BaseModel):
     current_user_id: str
@@ -30,72 +189,364 @@ class ChangeUserRequest(BaseModel):
 def get_filename(user_id: str) -> str:
     return f"{user_id}.json"
 
-def get_summary(question: str) -> str:
-    return question[:50] + "..." if len(question) > 50 else question
+async def load_history_versioned(user_id: str) -> Tuple[Dict, str]:
+    # Include turns still waiting in the write-behind queue
+    with timed("storage_read"):
+        chats, version = await call_async(storage.load_versioned, user_id)
+    return write_queue.overlay(user_id, chats, version)
 
-def load_chat_history(user_id: str) -> Dict:
-    key = get_filename(user_id)
-    try:
-        response = s3.get_object(Bucket=S3_BUCKET, Key=key)
-        content = response["Body"].read().decode("utf-8")
-        return json.loads(content)
-    except ClientError as e:
-        if e.response["Error"]["Code"] == "NoSuchKey":
-            return {}
-        raise e
-
-def save_chat(user_id: str, question: str, answer: str):
-    key = get_filename(user_id)
-    chats = load_chat_history(user_id)
-    chat_title = get_summary(question)
-    chats[chat_title] = {"question": question, "answer": answer}
-    s3.put_object(Bucket=S3_BUCKET, Key=key, Body=json.dumps(chats).encode("utf-8"))
+async def load_chat_history(user_id: str) -> Dict:
+    return (await load_history_versioned(user_id))[0]
+
+def save_chat(user_id: str, question: str, answer: str, request_id: Optional[str] = None, faq: bool = True):
+    # Template answers to greetings, cache hits and private answers are kept
+    # out of the FAQ index, and marked so an offline rebuild leaves them out too
+    write_queue.submit(user_id, get_summary(question), question, answer, request_id, faq)
+    if faq:
+        faq_index.add(question, answer)
+
+async def load_prompt_context(user_id: str, question: str,
+                              decision: router.Decision) -> Tuple[List[Dict], Dict, Optional[Dict]]:
+    """Context messages for a new question, the user's history and their summary.
+
+    The context is empty when the question does not depend on the
+    conversation; see ``context.build_context``.
+    """
+    (chats, _), meta = await asyncio.gather(
+        load_history_versioned(user_id),
+        call_async(storage.load_user_meta, user_id),
+    )
+    summary = meta.get("summary")
+    return build_context(chats, summary, question, follow_up=decision.follows_on), chats, summary
+
+def save_answer(user_id: str, question: str, answer: str, context: List[Dict], turns: int,
+                summary: Optional[Dict], request_id: Optional[str] = None,
+                decision: Optional[router.Decision] = None):
+    # Answers drawn from the user's own history, or about it, are theirs
+    # alone: they are neither cached nor suggested to others as FAQs
+    private = bool(context) or (decision is not None and decision.reason == "recall")
+    if not private:
+        answer_cache.put(question, answer)
+    save_chat(user_id, question, answer, request_id, faq=not private)
+    summarizer.maybe_schedule(user_id, turns + 1, summary)
+
+def flight_key(user_id: str, request_id: Optional[str], question: str, context: List[Dict]) -> Tuple:
+    # A retry joins its original request; otherwise the same question asked
+    # with the same context (e.g. none) by anyone shares the call
+    if request_id:
+        return ("request", user_id, request_id)
+    fingerprint = history_version(json.dumps(context, sort_keys=True)) if context else ""
+    return ("question", normalize_question(question), fingerprint)
+
+def related_faqs(question: str, k: int = 3) -> List[Dict]:
+    with timed("faq_search"):
+        return faq_index.search(question, k=k, exclude=[question])
 
 def list_active_users():
-    response = s3.list_objects_v2(Bucket=S3_BUCKET)
-    files = response.get("Contents", [])
-    return [file["Key"].replace(".json", "") for file in files]
+    return storage.list_active_users()
+
+def sse_event(event: str, data: Dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def too_many_requests(e: Rejected) -> JSONResponse:
+    return JSONResponse(status_code=429, content={"error": str(e), "reason": e.reason}, headers=e.headers())
+
+def service_unavailable(e: CircuitOpen) -> JSONResponse:
+    """The model's circuit breaker is open: fail fast rather than wait on it."""
+    return JSONResponse(status_code=503, content={"error": str(e)}, headers=e.headers())
+
+async def prepare_chat(user_id: str, question: str, request_id: Optional[str], bypass_cache: bool):
+    """Everything /chat and /chat/stream do before the model is called.
+
+    Returns the response fields when the chat is answered without the
+    model (a replayed request, a template or a cached answer; None
+    otherwise), the routing decision, the prompt context, the history and
+    the summary. Nothing here takes an admission slot.
+    """
+    # Greetings get a template answer and simple questions a cheaper model
+    decision = router.route(question, user_id)
+    context = chats = summary = None
+    if request_id:
+        # A retry of a request that already completed gets the saved answer
+        context, chats, summary = await load_prompt_context(user_id, question, decision)
+        previous = find_request(chats, request_id)
+        if previous is not None:
+            return {"answer": previous["answer"], "replayed": True}, decision, context, chats, summary
+
+    if decision.route == router.TEMPLATE:
+        save_chat(user_id, question, decision.answer, request_id, faq=False)
+        return {"answer": decision.answer, "route": decision.route}, decision, context, chats, summary
+
+    # The user's history, fitted to the token budget
+    if context is None:
+        context, chats, summary = await load_prompt_context(user_id, question, decision)
+
+    # Serve repeated questions from the shared cache unless asked not to.
+    # Cached answers were generated without context, so they only stand
+    # in for a question that does not depend on the conversation either.
+    if not bypass_cache and not context:
+        cached = answer_cache.get(question)
+        if cached is not None:
+            # The cached answer is already indexed under the question it was generated for
+            save_chat(user_id, question, cached, request_id, faq=False)
+            return {"answer": cached, "cached": True}, decision, context, chats, summary
+    return None, decision, context, chats, summary
+
+def check_starter(key: Tuple, user_id: str):
+    """Apply ``user_id``'s own admission limits if its chat would start the LLM call behind ``key``.
+
+    A chat that joins a call already in flight takes no slot and is not
+    counted against its user; the call itself waits for a slot (see
+    ``admitted``), so chats that queue together still share it.
+    """
+    if not flights.in_flight(key):
+        admission.check_user(user_id)
+
+def admitted(user_id: str, call: Callable[[], Awaitable]) -> Callable[[], Awaitable]:
+    async def run():
+        async with admission.admit(user_id, user_limits=False):
+            return await call()
+    return run
+
+async def admitted_tokens(user_id: str, tokens: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+    # The slot is held until the upstream stream ends, whether or not any
+    # client is still reading
+    async with admission.admit(user_id, user_limits=False):
+        async for token in tokens():
+            yield token
+
+async def starting_with(head: List[str], tokens: AsyncIterator[str]) -> AsyncIterator[str]:
+    for token in head:
+        yield token
+    async for token in tokens:
+        yield token
+
+def event_stream(events: AsyncIterator[str]) -> StreamingResponse:
+    # Behind API Gateway + Mangum the body is buffered until the stream ends;
+    # tokens reach the client incrementally when served by uvicorn or a
+    # response-streaming Lambda function URL.
+    return StreamingResponse(events, media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+async def ready_events(question: str, fields: Dict) -> AsyncIterator[str]:
+    """SSE events for an answer that was ready without the model."""
+    yield sse_event("token", {"token": fields["answer"]})
+    yield sse_event("done", {**fields, "faqs": related_faqs(question), "faq_intro": FAQ_INTRO})
+
+async def stream_answer(user_id: str, question: str, decision: router.Decision, tokens: AsyncIterator[str],
+                        first: bool, context: List[Dict], chats: Dict, summary: Optional[Dict],
+                        request_id: Optional[str] = None) -> AsyncIterator[str]:
+    """Yield SSE events for each token, then save the turn and send it whole.
+
+    ``tokens`` replays the shared upstream stream, and ``first`` is False
+    for a double-submitted request, which must not save the turn again.
+    """
+    try:
+        parts = []
+        started = time.perf_counter()
+        async for token in tokens:
+            parts.append(token)
+            yield sse_event("token", {"token": token})
+        metrics.observe(f"route_{decision.route}", time.perf_counter() - started)
+        answer = "".join(parts)
+
+        # Persist only once the full answer exists, and once per user
+        if first:
+            save_answer(user_id, question, answer, context, len(chats), summary, request_id, decision)
+
+        yield sse_event("done", {"answer": answer, "route": decision.route,
+                                 "faqs": related_faqs(question), "faq_intro": FAQ_INTRO})
+
+    except Exception as e:
+        metrics.record_error(e)
+        yield sse_event("error", {"error": str(e)})
+
+async def error_events(e: Exception) -> AsyncIterator[str]:
+    yield sse_event("error", {"error": str(e)})
 
 # === Routes ===
+# Every route is async: LLM calls await the pooled async client and storage
+# calls run on the storage threadpool, so in-flight chats are not capped by
+# the server's threadpool size.
 
 @app.post("/chat")
-def chat(request: ChatRequest):
+async def chat(request: ChatRequest, http_request: Request):
+    request_id = request.request_id or http_request.headers.get("idempotency-key")
+    try:
+        ready, decision, context, chats, summary = await prepare_chat(
+            request.user_id, request.question, request_id, request.bypass_cache)
+        if ready is not None:
+            return {**ready, "faqs": related_faqs(request.question), "faq_intro": FAQ_INTRO}
+
+        # Concurrent identical requests share one upstream call, which alone
+        # takes an admission slot; a rejection is only ever this user's own
+        # or the server's
+        key = flight_key(request.user_id, request_id, request.question, context)
+        check_starter(key, request.user_id)
+
+        async def generate():
+            with timed(f"route_{decision.route}"):
+                return await llm.agenerate_answer(request.question, decision.model, context=context)
+
+        answer, first = await flights.do(key, admitted(request.user_id, generate), request.user_id)
+
+        # Queue the chat for storage; the answer does not wait for the write.
+        # A double-submitted request shares the answer but saves it only once.
+        if first:
+            save_answer(request.user_id, request.question, answer, context, len(chats), summary, request_id,
+                        decision)
+
+        return {"answer": answer, "route": decision.route,
+                "faqs": related_faqs(request.question), "faq_intro": FAQ_INTRO}
+
+    except Rejected as e:
+        return too_many_requests(e)
+    except CircuitOpen as e:
+        return service_unavailable(e)
+    except Exception as e:
+        metrics.record_error(e)
+        return {"error": str(e)}
+
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest, http_request: Request):
+    request_id = request.request_id or http_request.headers.get("idempotency-key")
     try:
-        # Generate answer using OpenAI
-        completion = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=[{"role": "user", "content": request.question}]
+        ready, decision, context, chats, summary = await prepare_chat(
+            request.user_id, request.question, request_id, request.bypass_cache)
+        if ready is not None:
+            return event_stream(ready_events(request.question, ready))
+
+        # Identical streams in flight replay one upstream stream's tokens.
+        # The response starts once the first token is in, so a full server
+        # or an open circuit still answers 429 or 503.
+        key = flight_key(request.user_id, request_id, request.question, context)
+        check_starter(key, request.user_id)
+        tokens, first = flights.stream(
+            key,
+            lambda: admitted_tokens(request.user_id, lambda: llm.astream_answer_tokens(
+                request.question, decision.model, context=context)),
+            request.user_id,
         )
-        answer = completion.choices[0].message["content"]
+        head = []
+        async for token in tokens:
+            head.append(token)
+            break
+        return event_stream(stream_answer(request.user_id, request.question, decision,
+                                          starting_with(head, tokens), first, context, chats, summary,
+                                          request_id))
 
-        # Save chat to S3
-        save_chat(request.user_id, request.question, answer)
+    except Rejected as e:
+        return too_many_requests(e)
+    except CircuitOpen as e:
+        return service_unavailable(e)
+    except Exception as e:
+        metrics.record_error(e)
+        return event_stream(error_events(e))
+
+@app.post("/faqs")
+async def faqs(req: FAQRequest):
+    try:
+        # Query with the question if given, else the user's recent questions
+        recent = req.chat_history or list((await load_chat_history(req.user_id)).values())[-5:]
+        asked = [entry["question"] for entry in recent if "question" in entry]
+        query = req.question or " ".join(asked)
+        exclude = asked + ([req.question] if req.question else [])
+        with timed("faq_search"):
+            results = faq_index.search(query, k=max(1, min(req.k, 20)), exclude=exclude)
+        return {"faqs": results, "faq_intro": FAQ_INTRO}
+    except Exception as e:
+        metrics.record_error(e)
+        return {"error": str(e)}
 
-        return {"answer": answer}
+@app.post("/rate-answer")
+async def rate_answer(req: RatingRequest):
+    try:
+        if not 0 <= req.rating <= 5:
+            return {"error": "Rating must be between 0 and 5"}
+        events.append("ratings", req.dict())
+        return {"message": "Thanks for rating this answer"}
+    except Exception as e:
+        metrics.record_error(e)
+        return {"error": str(e)}
 
+@app.post("/contact-us")
+async def contact_us(req: ContactRequest):
+    try:
+        events.append("contacts", req.dict())
+        return {"message": "Message received"}
     except Exception as e:
+        metrics.record_error(e)
+        return {"error": str(e)}
+
+@app.get("/ratings/summary")
+async def ratings_summary(start: Optional[str] = None, end: Optional[str] = None):
+    try:
+        await call_async(events.flush)
+        with timed("storage_read"):
+            return await call_async(rating_summary, event_sink, start, end)
+    except Exception as e:
+        metrics.record_error(e)
         return {"error": str(e)}
 
 @app.get("/get-history/{user_id}")
-def get_history(user_id: str):
+async def get_history(user_id: str, request: Request, response: Response,
+                      cursor: Optional[str] = None, limit: Optional[int] = None):
     try:
-        chats = load_chat_history(user_id)
-        return {"chats": chats}
+        chats, version = await load_history_versioned(user_id)
+        etag = f'"{version}"'
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        response.headers["ETag"] = etag
+        # Without a limit, keep returning the whole history oldest-first
+        if limit is None:
+            return {"chats": chats}
+        page, next_cursor = paginate_history(chats, cursor, max(1, min(limit, 100)))
+        return {"chats": page, "next_cursor": next_cursor, "total": len(chats)}
     except Exception as e:
+        metrics.record_error(e)
+        return {"error": str(e)}
+
+@app.get("/search-history/{user_id}")
+async def search_history(user_id: str, q: str, cursor: Optional[str] = None, limit: int = 10):
+    """Ranked, highlighted turns matching ``q``, answered from the user's search index."""
+    try:
+        with timed("history_search"):
+            return await call_async(history_search.search, user_id, q, cursor, max(1, min(limit, 50)))
+    except Exception as e:
+        metrics.record_error(e)
         return {"error": str(e)}
 
 @app.post("/change-user")
-def change_user(req: ChangeUserRequest):
+async def change_user(req: ChangeUserRequest):
     try:
         # Just log or acknowledge user switch
         return {"message": f"Switched from {req.current_user_id} to {req.new_user_id}"}
     except Exception as e:
+        metrics.record_error(e)
         return {"error": str(e)}
 
 @app.get("/get-active-users")
-def get_users():
+async def get_users(active_within_minutes: Optional[float] = None, cursor: Optional[str] = None,
+                    limit: Optional[int] = None):
     try:
-        users = list_active_users()
-        return {"active_users": users}
+        # Answered from the user index maintained by save_chat, not a bucket listing
+        active_since = time.time() - active_within_minutes * 60 if active_within_minutes else None
+        with timed("storage_read"):
+            users, next_cursor = await call_async(storage.list_users, active_since, cursor, limit)
+        return {
+            "active_users": [user["user_id"] for user in users],
+            "users": users,
+            "next_cursor": next_cursor,
+        }
     except Exception as e:
+        metrics.record_error(e)
         return {"error": str(e)}
+
+@app.get("/cache-stats")
+async def cache_stats():
+    return {**answer_cache.stats(), "write_behind": write_queue.stats(), "single_flight": flights.stats(),
+            "admission": admission.stats(), "llm": llm.caller.stats()}
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
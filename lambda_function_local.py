@@ -1,21 +1,108 @@
 import os
-import json
-from fastapi import FastAPI
+import time
+import asyncio
+import logging
+from collections import defaultdict
+from contextlib import suppress
+from typing import Dict, List, Optional
+from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
-from openai import OpenAI
+from openai import AsyncOpenAI, NotFoundError
 
-# Initialize OpenAI client
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY", "sk-..."))
+import llm
+import metrics
+import router
+from admission import AdmissionController, Rejected
+from answer_cache import normalize_question
+from context import SUMMARY_MAX_TOKENS, RollingSummarizer, build_context
+from event_log import EventBuffer, get_event_sink, rating_summary
+from faq_index import FAQIndex
+from history_search import HistorySearch
+from metrics import MetricsMiddleware, TimedJSONResponse, timed
+from resilience import CircuitBreaker, CircuitOpen, ResilientCaller
+from single_flight import SingleFlight
+from storage import call_async, find_request, get_storage, paginate_history
+from write_behind import WriteBehindQueue
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"), format="%(message)s")
+logger = logging.getLogger(__name__)
+
+# Initialize OpenAI client (async, so waiting on a run never blocks the event loop),
+# over a sized keep-alive connection pool shared by every in-flight chat
+client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY", "sk-..."), http_client=llm.async_http_client(),
+                     max_retries=0)
+# Assistants API calls get the same timeouts, retries and circuit breaker as
+# chat completions (see llm), but no hedging: a second run on a thread would
+# be rejected while the first is active. Calls that create messages or runs
+# are not retried, so a timed-out request cannot add a question twice.
+assistants = ResilientCaller(
+    "assistants",
+    deadline=llm.LLM_DEADLINE,
+    attempt_timeout=llm.LLM_ATTEMPT_TIMEOUT,
+    max_attempts=llm.LLM_MAX_ATTEMPTS,
+    breaker=CircuitBreaker("assistants", llm.LLM_BREAKER_FAILURES, llm.LLM_BREAKER_RESET),
+)
 
 # Assistant ID
 ASSISTANT_ID = "asst_FR7EG2xOUCZmMnVHjaggxlAd"
 
+# Run polling starts fast and backs off to RUN_POLL_MAX seconds between checks
+RUN_POLL_INITIAL = 0.25
+RUN_POLL_MAX = 2.0
+RUN_TIMEOUT = float(os.environ.get("ASSISTANT_RUN_TIMEOUT", "60"))
+RUN_TERMINAL_STATES = {"completed", "failed", "cancelled", "expired", "incomplete", "requires_action"}
+
+# A user's assistant thread is reused until it sits idle this long
+THREAD_TTL = float(os.environ.get("ASSISTANT_THREAD_TTL", str(7 * 24 * 3600)))
+# One run at a time per user: the API rejects messages while a run is active
+_thread_locks = defaultdict(asyncio.Lock)
+# Turns answered without the assistant that are being added to users' threads
+_thread_appends = set()
+# Runs on a reused thread only send the assistant this many recent messages;
+# the rolling summary stands in for everything older
+THREAD_CONTEXT_MESSAGES = int(os.environ.get("ASSISTANT_THREAD_CONTEXT_MESSAGES", "6"))
+# A double-submitted chat joins the run already in flight instead of queueing
+# behind it on the user's lock and running (and saving) a second time
+flights = SingleFlight()
+# Assistant runs go through a global concurrency limit, per-user rate limits
+# and a fair queue; chats that cannot get a slot in time are answered with 429
+admission = AdmissionController()
+
 # Path to local chat storage
 DATA_DIR = r"C:\Users\tungn\Downloads\IMGs\Prototype\local"
-os.makedirs(DATA_DIR, exist_ok=True)
 
-app = FastAPI()
+# CHAT_STORAGE selects the backend (s3, file or sqlite); local files are the default here
+storage = get_storage("file", data_dir=DATA_DIR)
+# Turns are persisted (and compacted) by a background writer
+write_queue = WriteBehindQueue(storage)
+# Ratings and contact messages are buffered and written as batched segments
+event_sink = get_event_sink(storage)
+events = EventBuffer(event_sink)
+
+# Related-FAQ suggestions come from a prebuilt BM25 index, no LLM involved
+faq_index = FAQIndex(os.environ.get("FAQ_INDEX_PATH", os.path.join(DATA_DIR, "faq_index.bin")))
+FAQ_INTRO = "Here are some related FAQs:"
+
+# Each user's rolling conversation summary is kept in their meta record
+summarizer = RollingSummarizer(
+    storage,
+    load_history=lambda user_id: write_queue.overlay(user_id, *storage.load_versioned(user_id))[0],
+    summarize=lambda messages: llm.complete(messages, llm.SUMMARY_MODEL, 2 * SUMMARY_MAX_TOKENS),
+)
+# Per-user inverted indexes behind /search-history, updated by the background
+# writer as each batch of turns is stored
+history_search = HistorySearch(
+    storage,
+    load_history=lambda user_id: write_queue.overlay(user_id, *storage.load_versioned(user_id))[0],
+)
+write_queue.add_listener(history_search.index_records)
+
+app = FastAPI(default_response_class=TimedJSONResponse)
+
+# Server-Timing headers, one JSON log line per request and the /metrics data
+app.add_middleware(MetricsMiddleware)
 
 # CORS for Streamlit
 app.add_middleware(
@@ -30,88 +117,333 @@ app.add_middleware(
 class ChatRequest(BaseModel):
     user_id: str
     question: str
+    # Idempotency key (also accepted as an Idempotency-Key header): a retry
+    # with the same key gets the original answer and saves nothing new
+    request_id: Optional[str] = None
 
-# --------- Helper Functions ---------
-def get_filename(user_id):
-    """Return the path to the JSON file for a given user."""
-    return os.path.join(DATA_DIR, f"{user_id}.json")
+class RatingRequest(BaseModel):
+    user_id: str
+    question: str
+    rating: int
+    suggestion: Optional[str] = None
+    # The "route" of the rated answer, so ratings can be compared per route
+    route: Optional[str] = None
+
+class ContactRequest(BaseModel):
+    name: str
+    email: str
+    message: str
 
+class FAQRequest(BaseModel):
+    user_id: str
+    question: Optional[str] = None
+    chat_history: List[Dict] = []
+    k: int = 5
+
+@app.on_event("shutdown")
+def flush_writes():
+    """Write any queued turns and events before the server exits."""
+    write_queue.flush()
+    events.flush()
+
+# --------- Helper Functions ---------
 def get_summary(text, length=5):
     """Generate a short title from question."""
     return "_".join(text.strip().split()[:length]).replace("?", "").replace(".", "")
 
-def load_chat_history(user_id):
-    """Load chat history from user's JSON file."""
-    filepath = get_filename(user_id)
-    if os.path.exists(filepath):
-        with open(filepath, "r") as f:
-            return json.load(f)
-    return {}
-
-def save_chat(user_id, question, answer):
-    """Save new chat entry to user's JSON file."""
-    filename = get_filename(user_id)
-    chat_title = get_summary(question)
-    chats = load_chat_history(user_id)
-    chats[chat_title] = {"question": question, "answer": answer}
-    with open(filename, "w") as f:
-        json.dump(chats, f, indent=2)
+async def load_history_versioned(user_id):
+    """Load chat history and its version, including turns not yet written."""
+    with timed("storage_read"):
+        chats, version = await call_async(storage.load_versioned, user_id)
+    return write_queue.overlay(user_id, chats, version)
+
+async def load_chat_history(user_id):
+    """Load chat history for a user from the configured storage."""
+    return (await load_history_versioned(user_id))[0]
+
+def save_chat(user_id, question, answer, request_id=None, faq=True):
+    """Queue a new chat entry for a user; it is written in the background.
+
+    ``faq=False`` keeps the pair out of the FAQ index (template answers to
+    greetings, and answers drawn from or about the user's own history), and
+    marks the stored turn so ``python faq_index.py`` leaves it out as well.
+    """
+    write_queue.submit(user_id, get_summary(question), question, answer, request_id, faq)
+    if faq:
+        faq_index.add(question, answer)
+
+def list_active_users():
+    """List every user with stored chats."""
+    return storage.list_active_users()
+
+async def wait_for_run(thread_id, run, timeout=RUN_TIMEOUT):
+    """Poll a run with exponential backoff until it finishes or times out."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    delay = RUN_POLL_INITIAL
+    while run.status not in RUN_TERMINAL_STATES:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            with suppress(Exception):
+                await client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run.id)
+            raise TimeoutError(f"Assistant run {run.id} did not finish within {timeout:g}s")
+        await asyncio.sleep(min(delay, remaining))
+        delay = min(delay * 2, RUN_POLL_MAX)
+        run = await assistants.acall(
+            lambda t: client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id, timeout=t),
+            deadline=max(remaining, RUN_POLL_MAX),
+        )
+    if run.status != "completed":
+        # The assistant has no tools, so requires_action is as final as failed
+        detail = run.last_error.message if getattr(run, "last_error", None) else "no details"
+        raise RuntimeError(f"Assistant run {run.id} ended with status '{run.status}': {detail}")
+    return run
+
+def get_cached_thread_id(meta):
+    """Return the thread id stored in a user's meta, or None if missing or expired."""
+    entry = meta.get("thread")
+    if entry and time.time() - entry["last_used"] < THREAD_TTL:
+        return entry["id"]
+    return None
+
+def remember_thread(user_id, thread_id):
+    """Persist the user's thread id and refresh its expiry (blocking; see call_async)."""
+    meta = storage.load_user_meta(user_id)
+    meta["thread"] = {"id": thread_id, "last_used": time.time()}
+    storage.save_user_meta(user_id, meta)
+
+async def start_run_on_new_thread(chats, summary, question):
+    """Rebuild a thread from the token-budgeted history and start a run in one call."""
+    messages = []
+    # The thread carries on into later questions, so it keeps the latest
+    # turns whether or not they bear on this one
+    for message in build_context(chats, summary, question, follow_up=True):
+        # Thread messages can only come from the user or the assistant
+        if message["role"] == "system":
+            message = {"role": "user", "content": message["content"]}
+        messages.append(message)
+    messages.append({"role": "user", "content": question})
+    return await assistants.acall(lambda t: client.beta.threads.create_and_run(
+        assistant_id=ASSISTANT_ID,
+        thread={"messages": messages},
+        timeout=t,
+    ), max_attempts=1)
+
+async def start_run(user_id, question, chats, meta):
+    """Continue the user's cached thread, rebuilding it on a miss."""
+    thread_id = get_cached_thread_id(meta)
+    summary = meta.get("summary")
+    if thread_id:
+        try:
+            await assistants.acall(lambda t: client.beta.threads.messages.create(
+                thread_id=thread_id,
+                role="user",
+                content=question,
+                timeout=t,
+            ), max_attempts=1)
+            # Bound the prompt: recent messages verbatim, older ones via the summary
+            extra = {"truncation_strategy": {"type": "last_messages", "last_messages": THREAD_CONTEXT_MESSAGES}}
+            if summary and summary.get("text"):
+                extra["additional_instructions"] = f"Summary of the conversation so far: {summary['text']}"
+            return await assistants.acall(lambda t: client.beta.threads.runs.create(
+                thread_id=thread_id,
+                assistant_id=ASSISTANT_ID,
+                timeout=t,
+                **extra
+            ), max_attempts=1)
+        except NotFoundError:
+            pass  # thread deleted upstream; fall through and rebuild it
+    return await start_run_on_new_thread(chats, summary, question)
+
+async def append_to_thread(user_id, thread_id, question, answer):
+    """Add a turn answered without the assistant to the user's thread, without a run."""
+    try:
+        async with _thread_locks[user_id]:
+            for role, content in (("user", question), ("assistant", answer)):
+                await assistants.acall(lambda t, role=role, content=content: client.beta.threads.messages.create(
+                    thread_id=thread_id,
+                    role=role,
+                    content=content,
+                    timeout=t,
+                ), max_attempts=1)
+    except NotFoundError:
+        pass  # thread deleted upstream; the next run rebuilds it from the history
+    except Exception:
+        logger.exception("Adding a turn to the assistant thread of %s failed", user_id)
+
+def keep_thread_current(user_id, meta, question, answer):
+    """Add a template or cheap-model turn to the user's cached thread, off the response path.
+
+    The next assistant run then sees it among its recent messages. A
+    thread rebuilt on a miss comes from the history, which has it already.
+    """
+    thread_id = get_cached_thread_id(meta)
+    if thread_id:
+        task = asyncio.ensure_future(append_to_thread(user_id, thread_id, question, answer))
+        _thread_appends.add(task)
+        task.add_done_callback(_thread_appends.discard)
 
 # --------- Chat Endpoint ---------
+async def run_chat(user_id, question, request_id=None):
+    """Answer one question on the user's thread and queue the turn; returns the result fields."""
+    chats, meta = await asyncio.gather(
+        load_chat_history(user_id),
+        call_async(storage.load_user_meta, user_id),
+    )
+    # A retry of a request that already completed gets the saved answer
+    previous = find_request(chats, request_id) if request_id else None
+    if previous is not None:
+        return {"answer": previous["answer"], "replayed": True}
+
+    # Greetings get a template answer without taking an admission slot, as
+    # in lambda_function; only model calls are admitted
+    decision = router.route(question, user_id)
+    if decision.route == router.TEMPLATE:
+        save_chat(user_id, question, decision.answer, request_id, faq=False)
+        keep_thread_current(user_id, meta, question, decision.answer)
+        summarizer.maybe_schedule(user_id, len(chats) + 1, meta.get("summary"))
+        return {"answer": decision.answer, "route": decision.route}
+
+    async with admission.admit(user_id):
+        # Simple questions go to a cheaper chat model and do not need the
+        # assistant. Their turns are added to the user's thread afterwards,
+        # so a later run still sees them.
+        if decision.route != router.FULL:
+            with timed(f"route_{decision.route}"):
+                context = build_context(chats, meta.get("summary"), question, follow_up=decision.follows_on)
+                answer = await llm.agenerate_answer(question, decision.model, context=context)
+            private = bool(context) or decision.reason == "recall"
+            save_chat(user_id, question, answer, request_id, faq=not private)
+            keep_thread_current(user_id, meta, question, answer)
+            summarizer.maybe_schedule(user_id, len(chats) + 1, meta.get("summary"))
+            return {"answer": answer, "route": decision.route}
+
+        async with _thread_locks[user_id]:
+            # ✅ Step 1: Reuse the user's thread (rebuilt from history on a miss) and run the assistant
+            with timed("llm"):
+                run = await start_run(user_id, question, chats, meta)
+            with timed("run_polling"):
+                await wait_for_run(run.thread_id, run)
+            with timed("storage_write"):
+                await call_async(remember_thread, user_id, run.thread_id)
+
+            # ✅ Step 2: Get latest assistant message
+            with timed("llm"):
+                messages = await assistants.acall(lambda t: client.beta.threads.messages.list(
+                    thread_id=run.thread_id, order="desc", limit=1, timeout=t))
+            answer = messages.data[0].content[0].text.value
+
+            # ✅ Step 3: Queue new question and answer for the user's file; the
+            # thread carries the user's history, so only a first question's
+            # answer can be a FAQ
+            save_chat(user_id, question, answer, request_id, faq=not chats)
+    summarizer.maybe_schedule(user_id, len(chats) + 1, meta.get("summary"))
+    return {"answer": answer, "thread_id": run.thread_id, "route": decision.route}
+
 @app.post("/chat")
-async def chat(req: ChatRequest):
+async def chat(req: ChatRequest, request: Request):
+    request_id = req.request_id or request.headers.get("idempotency-key")
+    key = ("request", req.user_id, request_id) if request_id else ("chat", req.user_id, normalize_question(req.question))
     try:
-        # ✅ Step 1: Load the specific user's chat history (from JSON file)
-        chat_history = load_chat_history(req.user_id)
-
-        # ✅ Step 2: Create a thread for the conversation
-        thread = client.beta.threads.create()
-
-        # ✅ Step 3: Add past messages (up to last 5 for brevity)
-        past_entries = list(chat_history.items())[-5:]
-        for _, entry in past_entries:
-            q = entry["question"]
-            a = entry["answer"]
-            client.beta.threads.messages.create(
-                thread_id=thread.id,
-                role="user",
-                content=f"Previously, I asked: '{q}' and you answered: '{a}'"
-            )
-
-        # ✅ Step 4: Add current user question
-        client.beta.threads.messages.create(
-            thread_id=thread.id,
-            role="user",
-            content=req.question
-        )
+        # Saving happens inside the shared run, so joined callers never save twice
+        result, _ = await flights.do(key, lambda: run_chat(req.user_id, req.question, request_id), req.user_id)
 
-        # ✅ Step 5: Run assistant
-        run = client.beta.threads.runs.create(
-            thread_id=thread.id,
-            assistant_id=ASSISTANT_ID
-        )
+        with timed("faq_search"):
+            faqs = faq_index.search(req.question, k=3, exclude=[req.question])
+        return {**result, "faqs": faqs, "faq_intro": FAQ_INTRO}
+
+    except Rejected as e:
+        return JSONResponse(status_code=429, content={"error": str(e), "reason": e.reason}, headers=e.headers())
+
+    except CircuitOpen as e:
+        return JSONResponse(status_code=503, content={"error": str(e)}, headers=e.headers())
 
-        while run.status != "completed":
-            run = client.beta.threads.runs.retrieve(
-                thread_id=thread.id,
-                run_id=run.id
-            )
+    except Exception as e:
+        metrics.record_error(e)
+        return {"error": str(e)}
 
-        # ✅ Step 6: Get latest assistant message
-        messages = client.beta.threads.messages.list(thread_id=thread.id)
-        answer = messages.data[0].content[0].text.value
+# --------- FAQ Endpoint ---------
+@app.post("/faqs")
+async def faqs(req: FAQRequest):
+    try:
+        # Query with the question if given, else the user's recent questions
+        recent = req.chat_history or list((await load_chat_history(req.user_id)).values())[-5:]
+        asked = [entry["question"] for entry in recent if "question" in entry]
+        query = req.question or " ".join(asked)
+        exclude = asked + ([req.question] if req.question else [])
+        with timed("faq_search"):
+            results = faq_index.search(query, k=max(1, min(req.k, 20)), exclude=exclude)
+        return {"faqs": results, "faq_intro": FAQ_INTRO}
+    except Exception as e:
+        metrics.record_error(e)
+        return {"error": str(e)}
 
-        # ✅ Step 7: Save new question and answer to user's file
-        save_chat(req.user_id, req.question, answer)
+# --------- Feedback Endpoints ---------
+@app.post("/rate-answer")
+async def rate_answer(req: RatingRequest):
+    if not 0 <= req.rating <= 5:
+        return {"error": "Rating must be between 0 and 5"}
+    events.append("ratings", req.dict())
+    return {"message": "Thanks for rating this answer"}
 
-        return {"answer": answer, "thread_id": thread.id}
+@app.post("/contact-us")
+async def contact_us(req: ContactRequest):
+    events.append("contacts", req.dict())
+    return {"message": "Message received"}
 
+@app.get("/ratings/summary")
+async def ratings_summary(start: Optional[str] = None, end: Optional[str] = None):
+    try:
+        await call_async(events.flush)
+        with timed("storage_read"):
+            return await call_async(rating_summary, event_sink, start, end)
     except Exception as e:
-        print(f"Error: {str(e)}")
+        metrics.record_error(e)
         return {"error": str(e)}
 
 # --------- History Endpoint ---------
 @app.get("/get-history/{user_id}")
-async def get_history(user_id: str):
-    chats = load_chat_history(user_id)
-    return {"chats": chats}
+async def get_history(user_id: str, request: Request, response: Response,
+                      cursor: Optional[str] = None, limit: Optional[int] = None):
+    chats, version = await load_history_versioned(user_id)
+    etag = f'"{version}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    if limit is None:
+        return {"chats": chats}
+    page, next_cursor = paginate_history(chats, cursor, max(1, min(limit, 100)))
+    return {"chats": page, "next_cursor": next_cursor, "total": len(chats)}
+
+# --------- History Search Endpoint ---------
+@app.get("/search-history/{user_id}")
+async def search_history(user_id: str, q: str, cursor: Optional[str] = None, limit: int = 10):
+    """Ranked, highlighted turns matching ``q``, answered from the user's search index."""
+    try:
+        with timed("history_search"):
+            return await call_async(history_search.search, user_id, q, cursor, max(1, min(limit, 50)))
+    except Exception as e:
+        metrics.record_error(e)
+        return {"error": str(e)}
+
+# --------- Active Users Endpoint ---------
+@app.get("/get-active-users")
+async def get_users(active_within_minutes: Optional[float] = None, cursor: Optional[str] = None,
+                    limit: Optional[int] = None):
+    try:
+        active_since = time.time() - active_within_minutes * 60 if active_within_minutes else None
+        with timed("storage_read"):
+            users, next_cursor = await call_async(storage.list_users, active_since, cursor, limit)
+        return {
+            "active_users": [user["user_id"] for user in users],
+            "users": users,
+            "next_cursor": next_cursor,
+        }
+    except Exception as e:
+        metrics.record_error(e)
+        return {"error": str(e)}
+
+# --------- Metrics Endpoint ---------
+@app.get("/metrics")
+async def get_metrics():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
@@ -0,0 +1,223 @@
+"""OpenAI chat-completion calls shared by the API and the batch tools.
+
+The sync and async clients are created on first use and then shared. Each
+has a keep-alive pool of ``LLM_MAX_CONNECTIONS`` connections, so one
+process can keep that many completions in flight. Async clients are kept
+per event loop, since their connections belong to one.
+
+Every call goes through ``caller``, a ``resilience.ResilientCaller``: it
+has ``LLM_DEADLINE`` seconds in all, each attempt at most
+``LLM_ATTEMPT_TIMEOUT``, and timeouts, 429s and 5xx are retried with
+jittered backoff (the clients' own retries are off). ``LLM_HEDGE=1`` also
+sends a second request when the first is slower than the
+``LLM_HEDGE_PERCENTILE`` of recent calls. After ``LLM_BREAKER_FAILURES``
+failures in a row calls fail fast with ``CircuitOpen`` for
+``LLM_BREAKER_RESET`` seconds. A streamed answer is retried or hedged only
+until its first token arrives; after that the rest of it must arrive
+before the deadline.
+
+Calls are timed as the ``llm`` stage (see ``metrics``); streamed answers
+also record time to first token and total stream time.
+"""
+import asyncio
+import os
+import threading
+import time
+import weakref
+from typing import AsyncIterator, Dict, Iterator, List
+
+from metrics import observe, timed
+from resilience import CircuitBreaker, DeadlineExceeded, ResilientCaller
+
+MODEL = os.environ.get("OPENAI_MODEL", "gpt-4")
+# Rolling conversation summaries don't need the answering model
+SUMMARY_MODEL = os.environ.get("OPENAI_SUMMARY_MODEL", MODEL)
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", "200"))
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "120"))
+LLM_DEADLINE = float(os.environ.get("LLM_DEADLINE", "60"))
+LLM_ATTEMPT_TIMEOUT = float(os.environ.get("LLM_ATTEMPT_TIMEOUT", "30"))
+LLM_MAX_ATTEMPTS = int(os.environ.get("LLM_MAX_ATTEMPTS", "3"))
+LLM_HEDGE = os.environ.get("LLM_HEDGE", "0") == "1"
+LLM_HEDGE_PERCENTILE = float(os.environ.get("LLM_HEDGE_PERCENTILE", "95"))
+LLM_HEDGE_MIN_DELAY = float(os.environ.get("LLM_HEDGE_MIN_DELAY", "1"))
+LLM_BREAKER_FAILURES = int(os.environ.get("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET = float(os.environ.get("LLM_BREAKER_RESET", "30"))
+
+caller = ResilientCaller(
+    "openai",
+    deadline=LLM_DEADLINE,
+    attempt_timeout=LLM_ATTEMPT_TIMEOUT,
+    max_attempts=LLM_MAX_ATTEMPTS,
+    hedge=LLM_HEDGE,
+    hedge_percentile=LLM_HEDGE_PERCENTILE,
+    hedge_min_delay=LLM_HEDGE_MIN_DELAY,
+    breaker=CircuitBreaker("openai", LLM_BREAKER_FAILURES, LLM_BREAKER_RESET),
+)
+
+_client = None
+_async_clients = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def get_openai():
+    """The ``openai`` module, imported on first use.
+
+    Importing it is a large share of a Lambda cold start, and most routes
+    never call the model.
+    """
+    import openai
+    return openai
+
+
+def warm():
+    get_openai()
+
+
+def _limits():
+    import httpx
+    return httpx.Limits(max_connections=LLM_MAX_CONNECTIONS,
+                        max_keepalive_connections=LLM_MAX_CONNECTIONS, keepalive_expiry=60)
+
+
+def async_http_client():
+    """A pooled keep-alive ``httpx.AsyncClient`` for an ``AsyncOpenAI`` client."""
+    import httpx
+    return httpx.AsyncClient(limits=_limits(), timeout=LLM_TIMEOUT)
+
+
+def get_client():
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                import httpx
+                _client = get_openai().OpenAI(http_client=httpx.Client(limits=_limits(), timeout=LLM_TIMEOUT),
+                                              max_retries=0)
+    return _client
+
+
+def get_async_client():
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = get_openai().AsyncOpenAI(http_client=async_http_client(), max_retries=0)
+    return client
+
+
+def build_messages(question: str, context: List[Dict] = ()) -> List[Dict]:
+    """``context`` holds earlier messages, e.g. from ``context.build_context``."""
+    return [*context, {"role": "user", "content": question}]
+
+
+def _token(chunk) -> str:
+    return chunk.choices[0].delta.content if chunk.choices else None
+
+
+def complete(messages: List[Dict], model: str = MODEL, max_tokens: int = None) -> str:
+    completion = caller.call(lambda timeout: get_client().chat.completions.create(
+        model=model, messages=messages, max_tokens=max_tokens, timeout=timeout))
+    return completion.choices[0].message.content
+
+
+def generate_answer(question: str, model: str = MODEL, context: List[Dict] = ()) -> str:
+    with timed("llm"):
+        completion = caller.call(lambda timeout: get_client().chat.completions.create(
+            model=model,
+            messages=build_messages(question, context),
+            timeout=timeout,
+        ))
+    return completion.choices[0].message.content
+
+
+def stream_answer_tokens(question: str, model: str = MODEL, context: List[Dict] = ()) -> Iterator[str]:
+    start = time.perf_counter()
+
+    def open_stream(timeout: float):
+        chunks = get_client().chat.completions.create(
+            model=model,
+            messages=build_messages(question, context),
+            stream=True,
+            timeout=timeout,
+        )
+        iterator = iter(chunks)
+        try:
+            for chunk in iterator:
+                token = _token(chunk)
+                if token:
+                    return token, chunks, iterator
+        except BaseException:
+            chunks.close()
+            raise
+        return None, chunks, iterator
+
+    with timed("llm"):
+        first, chunks, iterator = caller.call(open_stream)
+    if first is None:
+        return
+    observe("llm_first_token", time.perf_counter() - start)
+    yield first
+    # Later chunks are bounded by the client's read timeout
+    try:
+        for chunk in iterator:
+            token = _token(chunk)
+            if token:
+                yield token
+    finally:
+        chunks.close()
+    observe("llm_stream", time.perf_counter() - start)
+
+
+async def agenerate_answer(question: str, model: str = MODEL, context: List[Dict] = ()) -> str:
+    with timed("llm"):
+        completion = await caller.acall(lambda timeout: get_async_client().chat.completions.create(
+            model=model,
+            messages=build_messages(question, context),
+            timeout=timeout,
+        ))
+    return completion.choices[0].message.content
+
+
+async def astream_answer_tokens(question: str, model: str = MODEL,
+                                context: List[Dict] = ()) -> AsyncIterator[str]:
+    start = time.perf_counter()
+    deadline_at = time.monotonic() + caller.deadline
+
+    async def open_stream(timeout: float):
+        chunks = await get_async_client().chat.completions.create(
+            model=model,
+            messages=build_messages(question, context),
+            stream=True,
+            timeout=timeout,
+        )
+        iterator = chunks.__aiter__()
+        try:
+            async for chunk in iterator:
+                token = _token(chunk)
+                if token:
+                    return token, chunks, iterator
+        except BaseException:
+            # Timed out, or lost a hedge: drop the connection
+            await chunks.close()
+            raise
+        return None, chunks, iterator
+
+    with timed("llm"):
+        first, chunks, iterator = await caller.acall(open_stream)
+    if first is None:
+        return
+    observe("llm_first_token", time.perf_counter() - start)
+    yield first
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(iterator.__anext__(), max(0.0, deadline_at - time.monotonic()))
+            except StopAsyncIteration:
+                break
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded("openai stream did not finish within its deadline") from None
+            token = _token(chunk)
+            if token:
+                yield token
+    finally:
+        await chunks.close()
+    observe("llm_stream", time.perf_counter() - start)
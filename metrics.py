@@ -0,0 +1,226 @@
+"""Per-stage request timing, structured request logs and Prometheus metrics.
+
+Code wraps each stage of a request in ``timed("stage")``. The stage names
+in use are ``llm``, ``run_polling``, ``storage_read``, ``storage_write``,
+``storage_compact``, ``faq_search``, ``history_search``, ``serialize`` and
+``admission_wait``.
+Each duration is recorded in the ``chat_stage_seconds`` histogram,
+labelled with the stage and route. It is also added to the current
+request, if there is one.
+``MetricsMiddleware`` starts that per-request record. It sends the stages
+back as a ``Server-Timing`` header and logs one JSON line per request.
+Stage and handler failures are counted by ``record_error``. ``render``
+produces the text served on ``/metrics``.
+"""
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional, Tuple
+
+try:
+    from fastapi.responses import JSONResponse
+except ImportError:  # metrics are also used by the batch tools, which have no web app
+    JSONResponse = None
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Work done outside any request, e.g. by the write-behind thread
+BACKGROUND = "background"
+
+_current: ContextVar[Optional[Dict]] = ContextVar("request_timing", default=None)
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...], buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series: Dict[Tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # Per-bucket counts, then sum and count
+                series = self._series[label_values] = [0] * len(self.buckets) + [0.0, 0]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        for label_values, series in items:
+            labels = _labels(self.labels, label_values)
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                yield f'{self.name}_bucket{{{labels},le="{bound:g}"}} {cumulative}'
+            yield f'{self.name}_bucket{{{labels},le="+Inf"}} {series[-1]}'
+            yield f"{self.name}_sum{{{labels}}} {series[-2]:.6f}"
+            yield f"{self.name}_count{{{labels}}} {series[-1]}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...]):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values: str):
+        with self._lock:
+            self._values[label_values] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            items = sorted(self._values.items())
+        for label_values, value in items:
+            yield f"{self.name}{{{_labels(self.labels, label_values)}}} {value}"
+
+
+def _labels(names, values) -> str:
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return ",".join(f'{n}="{v}"' for n, v in zip(names, escaped))
+
+
+stage_seconds = Histogram("chat_stage_seconds", "Time spent in each stage of a request.", ("stage", "route"))
+request_seconds = Histogram("chat_request_seconds", "Request latency until the response starts.",
+                            ("route", "method", "status"))
+errors_total = Counter("chat_errors_total", "Failures by the stage they happened in.", ("stage", "route"))
+admission_rejected_total = Counter("chat_admission_rejected_total", "Chats turned away by admission control.",
+                                   ("reason", "route"))
+upstream_events_total = Counter("chat_upstream_events_total",
+                                "Retries, hedges, timeouts and breaker trips by upstream.", ("upstream", "event"))
+routes_total = Counter("chat_routes_total", "Chats by the route the classifier chose and why.", ("route", "reason"))
+METRICS = (stage_seconds, request_seconds, errors_total, admission_rejected_total, upstream_events_total,
+           routes_total)
+
+
+def render() -> str:
+    return "\n".join(line for metric in METRICS for line in metric.render()) + "\n"
+
+
+def route_label(scope: Dict) -> str:
+    """The matched route's path template, so ``/get-history/{user_id}`` is one series."""
+    route = scope.get("route")
+    if route is not None and hasattr(route, "path"):
+        return route.path
+    endpoint = scope.get("endpoint")
+    return endpoint.__name__ if endpoint is not None else "unmatched"
+
+
+def current_route() -> str:
+    request = _current.get()
+    return route_label(request["scope"]) if request is not None else BACKGROUND
+
+
+def observe(stage: str, seconds: float):
+    stage_seconds.observe(seconds, stage, current_route())
+    request = _current.get()
+    if request is not None:
+        request["stages"][stage] = request["stages"].get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timed(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        request = _current.get()
+        if request is not None and request["failed_stage"] is None:
+            request["failed_stage"] = stage
+        errors_total.inc(stage, current_route())
+        raise
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def record_error(exc: BaseException):
+    """Count and log an error a handler turned into an ``{"error": ...}`` response."""
+    request = _current.get()
+    stage = request["failed_stage"] if request is not None else None
+    if stage is None:
+        # Failures inside a timed stage were counted when they were raised
+        errors_total.inc("handler", current_route())
+    if request is not None:
+        request["error"] = str(exc)
+    logger.error(json.dumps({"event": "error", "route": current_route(), "stage": stage or "handler",
+                             "error": str(exc), "type": type(exc).__name__}), exc_info=exc)
+
+
+def server_timing(stages: Dict[str, float], total: float) -> str:
+    parts = [f"{stage};dur={1000 * seconds:.1f}" for stage, seconds in stages.items()]
+    parts.append(f"total;dur={1000 * total:.1f}")
+    return ", ".join(parts)
+
+
+class MetricsMiddleware:
+    """ASGI middleware that times each request and reports its stages."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request = {"scope": scope, "stages": {}, "failed_stage": None, "error": None}
+        token = _current.set(request)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                elapsed = time.perf_counter() - start
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", server_timing(request["stages"], elapsed).encode("latin-1")))
+                message = {**message, "headers": headers}
+                route = route_label(scope)
+                request_seconds.observe(elapsed, route, scope["method"], str(status))
+                logger.info(json.dumps({
+                    "event": "request",
+                    "route": route,
+                    "method": scope["method"],
+                    "status": status,
+                    "duration_ms": round(1000 * elapsed, 1),
+                    "stages_ms": {k: round(1000 * v, 1) for k, v in request["stages"].items()},
+                    "error": request["error"],
+                }))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        except Exception as exc:
+            record_error(exc)
+            raise
+        finally:
+            _current.reset(token)
+
+
+if JSONResponse is not None:
+    class TimedJSONResponse(JSONResponse):
+        """JSON response whose encoding is recorded as the ``serialize`` stage."""
+
+        def render(self, content) -> bytes:
+            with timed("serialize"):
+                return super().render(content)
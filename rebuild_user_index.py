@@ -0,0 +1,33 @@
+"""Build the S3 user index from the stored histories, outside any request.
+
+A bucket that already holds histories when the user index is introduced
+has none to list from. Building it scans every history, which does not
+fit in an API Gateway request, so run this once as part of the deploy:
+
+    CHAT_S3_BUCKET=img-chat-history python rebuild_user_index.py
+
+Each user's ``last_active`` is the time their newest turn was written.
+Histories are only read. Running it again replaces the index with a
+fresh scan.
+"""
+import argparse
+import json
+import time
+
+from storage import S3Storage, get_storage
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.parse_args()
+
+    storage = get_storage()
+    if not isinstance(storage, S3Storage):
+        raise SystemExit("Only the S3 backend keeps a separate user index; CHAT_STORAGE must be s3")
+    start = time.perf_counter()
+    index = storage.rebuild_user_index()
+    print(json.dumps({"users": len(index), "seconds": round(time.perf_counter() - start, 2)}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+"""Deadlines, retries, hedging and a circuit breaker for upstream calls.
+
+``ResilientCaller`` runs a call (``fn(timeout)``, one attempt that must
+finish within ``timeout`` seconds) inside a total ``deadline``:
+
+- each attempt gets at most ``attempt_timeout``, and never more than the
+  time left before the deadline;
+- attempts that fail with a retryable error (timeouts, connection errors,
+  429 and 5xx responses) are retried with jittered exponential backoff.
+  A ``Retry-After`` from the upstream is honoured when it fits the
+  deadline. Other errors are raised at once;
+- with hedging on, an attempt still running after the ``hedge_percentile``
+  latency of recent successful calls gets a second, identical request. The
+  first success wins and the other request is cancelled;
+- a ``CircuitBreaker`` opens after ``failure_threshold`` consecutive
+  retryable failures. While open, calls fail at once with ``CircuitOpen``
+  instead of waiting on a degraded upstream. After ``reset_timeout`` one
+  trial call is let through, and its outcome closes or reopens the breaker.
+
+Hedging is only offered to async calls; sync calls get the rest.
+"""
+import asyncio
+import math
+import random
+import threading
+import time
+from bisect import insort
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+from metrics import upstream_events_total
+
+T = TypeVar("T")
+
+RETRYABLE_STATUS = frozenset({408, 409, 429, 500, 502, 503, 504})
+# Exception types from the openai package, matched by name so it is not imported here
+RETRYABLE_NAMES = frozenset({"APITimeoutError", "APIConnectionError"})
+
+
+class CircuitOpen(Exception):
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name} is unavailable; retry in {max(1, math.ceil(retry_after))}s")
+        self.retry_after = retry_after
+
+    def headers(self) -> Dict[str, str]:
+        return {"Retry-After": str(max(1, math.ceil(self.retry_after)))}
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+def is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, (asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return True
+    status = getattr(exc, "status_code", None)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    return type(exc).__name__ in RETRYABLE_NAMES
+
+
+def retry_after(exc: BaseException) -> Optional[float]:
+    headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial = False
+        self._lock = threading.Lock()
+        self.trips = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+    def before_call(self):
+        """Raise ``CircuitOpen`` unless a call may go upstream now."""
+        with self._lock:
+            if self.opened_at is None:
+                return
+            waited = time.monotonic() - self.opened_at
+            if waited >= self.reset_timeout and not self._trial:
+                self._trial = True
+                return
+        upstream_events_total.inc(self.name, "short_circuit")
+        raise CircuitOpen(self.name, max(0.0, self.reset_timeout - waited))
+
+    def abandon(self):
+        """A call let through by ``before_call`` ended without an outcome."""
+        with self._lock:
+            self._trial = False
+
+    def record(self, ok: bool):
+        with self._lock:
+            self._trial = False
+            if ok:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    self.trips += 1
+                    upstream_events_total.inc(self.name, "circuit_open")
+                self.opened_at = time.monotonic()
+
+
+class LatencyWindow:
+    """The last ``size`` latencies, for percentile estimates."""
+
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self.size = size
+        self.min_samples = min_samples
+        self._recent = deque()
+        self._sorted = []
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self._lock:
+            self._recent.append(seconds)
+            insort(self._sorted, seconds)
+            if len(self._recent) > self.size:
+                self._sorted.remove(self._recent.popleft())
+
+    def percentile(self, pct: float) -> Optional[float]:
+        with self._lock:
+            if len(self._sorted) < self.min_samples:
+                return None
+            return self._sorted[min(len(self._sorted) - 1, int(pct / 100 * len(self._sorted)))]
+
+
+class ResilientCaller:
+    def __init__(self, name: str, deadline: float = 60.0, attempt_timeout: float = 30.0, max_attempts: int = 3,
+                 base_delay: float = 0.25, max_delay: float = 4.0, hedge: bool = False,
+                 hedge_percentile: float = 95.0, hedge_min_delay: float = 1.0,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.name = name
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.breaker = breaker or CircuitBreaker(name)
+        self.latencies = LatencyWindow()
+        self.counts: Dict[str, int] = {}
+
+    def _count(self, event: str):
+        self.counts[event] = self.counts.get(event, 0) + 1
+        upstream_events_total.inc(self.name, event)
+
+    def hedge_delay(self) -> Optional[float]:
+        latency = self.latencies.percentile(self.hedge_percentile)
+        return None if latency is None else max(self.hedge_min_delay, latency)
+
+    def _backoff(self, attempt: int, exc: BaseException) -> float:
+        hinted = retry_after(exc)
+        if hinted is not None:
+            return hinted
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _failed(self, exc: BaseException, attempt: int, max_attempts: int, deadline_at: float) -> float:
+        """Record a failed attempt; return the delay before retrying, or re-raise."""
+        if not is_retryable(exc):
+            # The upstream answered; a bad request says nothing about its health
+            self.breaker.record(True)
+            raise exc
+        self.breaker.record(False)
+        self._count("timeout" if isinstance(exc, (asyncio.TimeoutError, TimeoutError)) else "error")
+        delay = self._backoff(attempt, exc)
+        if attempt + 1 >= max_attempts or time.monotonic() + delay >= deadline_at:
+            if isinstance(exc, (asyncio.TimeoutError, TimeoutError)):
+                raise DeadlineExceeded(f"{self.name} did not answer within its deadline") from exc
+            raise exc
+        self._count("retry")
+        return delay
+
+    def _attempt_timeout(self, deadline_at: float) -> float:
+        remaining = deadline_at - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"{self.name} did not answer within its deadline")
+        return min(remaining, self.attempt_timeout)
+
+    def call(self, fn: Callable[[float], T], deadline: Optional[float] = None,
+             max_attempts: Optional[int] = None) -> T:
+        """Run ``fn(timeout)`` until it succeeds, fails for good or the deadline passes.
+
+        Pass ``max_attempts=1`` for calls that are not safe to repeat; they
+        still get the timeout and the breaker.
+        """
+        deadline_at = time.monotonic() + (deadline or self.deadline)
+        max_attempts = max_attempts or self.max_attempts
+        attempt = 0
+        while True:
+            # Before the breaker, so a spent deadline never takes its trial call
+            timeout = self._attempt_timeout(deadline_at)
+            self.breaker.before_call()
+            start = time.monotonic()
+            try:
+                result = fn(timeout)
+            except Exception as e:
+                time.sleep(self._failed(e, attempt, max_attempts, deadline_at))
+                attempt += 1
+                continue
+            self.breaker.record(True)
+            self.latencies.add(time.monotonic() - start)
+            return result
+
+    async def acall(self, fn: Callable[[float], Awaitable[T]], deadline: Optional[float] = None,
+                    hedge: Optional[bool] = None, max_attempts: Optional[int] = None) -> T:
+        """Async ``call``; ``hedge`` overrides the caller's hedging setting."""
+        deadline_at = time.monotonic() + (deadline or self.deadline)
+        max_attempts = max_attempts or self.max_attempts
+        hedge = self.hedge if hedge is None else hedge
+        attempt = 0
+        while True:
+            timeout = self._attempt_timeout(deadline_at)
+            self.breaker.before_call()
+            start = time.monotonic()
+            try:
+                result = await self._attempt(fn, timeout, deadline_at, hedge)
+            except asyncio.CancelledError:
+                self.breaker.abandon()
+                raise
+            except Exception as e:
+                await asyncio.sleep(self._failed(e, attempt, max_attempts, deadline_at))
+                attempt += 1
+                continue
+            self.breaker.record(True)
+            self.latencies.add(time.monotonic() - start)
+            return result
+
+    async def _attempt(self, fn: Callable[[float], Awaitable[T]], timeout: float, deadline_at: float,
+                       hedge: bool) -> T:
+        primary = asyncio.ensure_future(asyncio.wait_for(fn(timeout), timeout))
+        delay = self.hedge_delay() if hedge else None
+        if delay is None or delay >= timeout:
+            return await primary
+        started = [primary]
+        try:
+            done, _ = await asyncio.wait(started, timeout=delay)
+            if not done:
+                self._count("hedge")
+                backup_timeout = min(self.attempt_timeout, deadline_at - time.monotonic())
+                started.append(asyncio.ensure_future(asyncio.wait_for(fn(backup_timeout), backup_timeout)))
+            error = None
+            tasks = set(started)
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self._count("hedge_win")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # Cancel the losing (or abandoned) request and wait for it to
+            # unwind, so its connection is freed and its error retrieved
+            for task in started:
+                task.cancel()
+            await asyncio.gather(*started, return_exceptions=True)
+
+    def stats(self) -> Dict:
+        return {"breaker": self.breaker.state, "breaker_trips": self.breaker.trips,
+                "hedge_after": self.hedge_delay() if self.hedge else None, **self.counts}
@@ -0,0 +1,176 @@
+"""Route each chat to the cheapest way of answering it well.
+
+``classify`` is a local, rule-based classifier; nothing is sent anywhere.
+It puts each question on one of three routes:
+
+- ``template``: the whole message is a greeting, thanks, goodbye or
+  "who are you", so a canned answer goes back without a model call;
+- ``cheap``: a question about the conversation itself ("do you remember
+  my last question?", "what was my age?"), small talk, or a short message
+  with no admissions vocabulary ("I am from india", "what is 2+2"). These go to
+  ``CHEAP_MODEL`` with the usual context;
+- ``full``: everything else, including any short follow-up that asks for
+  more ("yes", "give me a general list"). These go to ``llm.MODEL``.
+
+When in doubt the classifier picks ``full``, so a misrouted question costs
+money rather than answer quality.
+
+``CHAT_ROUTING`` selects the mode: ``on`` (the default) routes as above.
+``shadow`` classifies and records every decision but always uses the full
+model, which lets the rules be checked on live traffic first. ``off``
+skips the classifier.
+
+Each decision is counted in ``chat_routes_total`` and logged. Answer time
+per route is the ``route_<route>`` stage. Chat responses include the
+route, and ratings sent back with it are averaged per route by
+``event_log.rating_summary``.
+"""
+import json
+import logging
+import os
+import re
+from typing import Optional
+
+import llm
+from metrics import routes_total
+
+logger = logging.getLogger(__name__)
+
+ROUTING = os.environ.get("CHAT_ROUTING", "on")
+CHEAP_MODEL = os.environ.get("OPENAI_CHEAP_MODEL", "gpt-4o-mini")
+# Messages with at most this many words (and no admissions terms) are "short"
+SHORT_WORDS = int(os.environ.get("CHAT_ROUTING_SHORT_WORDS", "6"))
+
+TEMPLATE = "template"
+CHEAP = "cheap"
+FULL = "full"
+
+_WORD = re.compile(r"[a-z0-9]+")
+
+# A message is a pure greeting, thanks, ... when every word is in the
+# intent's vocabulary and at least one is a keyword
+INTENTS = (
+    ("greeting",
+     {"hi", "hii", "hiii", "hey", "heya", "hello", "helo", "hallo", "hola", "namaste", "greetings", "yo", "sup",
+      "morning", "afternoon", "evening"},
+     {"good", "again", "there", "all", "everyone", "sir", "maam", "mam", "doctor", "dr", "bot", "counselor"}),
+    ("thanks",
+     {"thanks", "thank", "thx", "ty", "tysm", "appreciated", "appreciate"},
+     {"you", "so", "much", "very", "a", "lot", "ok", "okay", "great", "that", "s", "helpful", "it", "i", "really",
+      "again", "for", "the", "help", "info", "information", "sir", "maam", "cool", "nice"}),
+    ("goodbye",
+     {"bye", "goodbye", "byee", "cya", "goodnight", "later"},
+     {"ok", "okay", "see", "you", "good", "night", "take", "care", "for", "now", "then", "thanks", "thank"}),
+)
+SMALL_TALK = re.compile(r"^((hi|hey|hello) )*(how are (you|u)|how r u|how s it going|whats up|what s up)"
+                        r"( doing)?( today)?$")
+ABOUT = re.compile(r"^(who are (you|u)|who r u|what are you|what can you do|what is your name|what s your name"
+                   r"|what is this)$")
+
+TEMPLATES = {
+    "greeting": ("Hello! I'm your admissions counselor for international medical graduates. Ask me about "
+                 "USMLE steps, residency applications, choosing programs or anything else on your way to "
+                 "training in the US."),
+    "thanks": "You're welcome! Let me know if there's anything else about your application I can help with.",
+    "goodbye": "Good luck with your preparation! Come back any time you have more questions.",
+    "about": ("I'm an AI admissions counselor for international medical graduates. I can explain USMLE "
+              "steps, ECFMG certification and the residency match, suggest programs and institutes, and "
+              "help you plan your application based on what you tell me about yourself."),
+}
+
+# Questions about the conversation itself, which the history answers
+RECALL = re.compile(
+    r"\b(remember|recall|mentioned|meantioned|mentiond|told you|i said|i asked|i told)\b"
+    r"|\b(last|previous|earlier|first) (question|message|answer|chat)\b"
+    r"|\bmy (age|name|country|course|year|stage|background|degree|city|state)\b"
+    r"|\b(what|which) (year|country|course|stage|age|semester|city|state) (am i|i am|i m|i belong|i beong"
+    r"|i come|i study|i live|do i)\b"
+    r"|\bwho am i\b"
+)
+
+# Admissions vocabulary: any of these makes a message substantive
+DOMAIN = frozenset("""
+    usmle step steps ck cs plab mcat toefl ielts oet exam exams score scores
+    residency residencies resident match nrmp eras ecfmg img imgs visa j1 h1b green card
+    program programs apply applying application applications applicant eligible eligibility requirement
+    requirements deadline deadlines interview interviews lor lors recommendation letter letters statement
+    cv usce observership observerships externship externships clerkship clerkships elective electives
+    rotation rotations fellowship research publication publications
+    institute institutes institution institutions college colleges university universities school schools
+    hospital hospitals medical medicine mbbs md premed doctor doctors physician license licence licensing
+    specialty specialties speciality dermatology dermo derm cardiology cardio neurology neuro surgery surgical
+    pediatrics psychiatry radiology oncology anesthesia anesthesiology orthopedics ortho gynecology obgyn
+    internal family emergency pathology clinical
+    fee fees cost costs tuition scholarship funding salary roadmap pathway timeline
+""".split())
+
+# Short follow-ups asking for more are answered by the full model: they
+# continue a substantive answer
+FOLLOW_UP = frozenset("""
+    yes yeah yep yup sure please continue go ahead more elaborate detail details detailed explain
+    give list tell suggest recommend how why help guide plan compare which best top
+""".split())
+
+
+# Reasons whose questions lean on the latest turns whatever their words:
+# recall, small talk and short statements or follow-ups to the last answer
+FOLLOWS_ON = frozenset({"recall", "small_talk", "short", "follow_up"})
+
+
+class Decision:
+    def __init__(self, route: str, reason: str, model: Optional[str] = None, answer: Optional[str] = None,
+                 follows_on: Optional[bool] = None):
+        self.route = route
+        self.reason = reason
+        self.model = model
+        self.answer = answer
+        # Whether the answer depends on the conversation so far, whatever the
+        # question's words; see context.build_context
+        self.follows_on = reason in FOLLOWS_ON if follows_on is None else follows_on
+
+    def __repr__(self):
+        return f"Decision({self.route!r}, {self.reason!r}, model={self.model!r})"
+
+
+def words(text: str):
+    # Underscores and punctuation separate words ("in_which_year_i_am")
+    return _WORD.findall(text.lower().replace("'", ""))
+
+
+def classify(question: str) -> Decision:
+    tokens = words(question)
+    text = " ".join(tokens)
+    if not tokens:
+        return Decision(FULL, "empty", llm.MODEL)
+
+    vocabulary = set(tokens)
+    if ABOUT.match(text):
+        return Decision(TEMPLATE, "about", answer=TEMPLATES["about"])
+    for intent, keywords, fillers in INTENTS:
+        if vocabulary & keywords and vocabulary <= keywords | fillers:
+            return Decision(TEMPLATE, intent, answer=TEMPLATES[intent])
+
+    if SMALL_TALK.match(text):
+        return Decision(CHEAP, "small_talk", CHEAP_MODEL)
+    domain = vocabulary & DOMAIN
+    if RECALL.search(text) and not domain - {"mbbs", "md", "medical", "medicine", "doctor"}:
+        # Recalling what the user said needs the history, not the big model;
+        # their degree is part of what they said
+        return Decision(CHEAP, "recall", CHEAP_MODEL)
+    if not domain and len(tokens) <= SHORT_WORDS and not vocabulary & FOLLOW_UP:
+        return Decision(CHEAP, "short", CHEAP_MODEL)
+    return Decision(FULL, "substantive" if domain else "follow_up" if vocabulary & FOLLOW_UP else "long", llm.MODEL)
+
+
+def route(question: str, user_id: Optional[str] = None) -> Decision:
+    """Classify ``question`` under ``CHAT_ROUTING`` and record the decision."""
+    if ROUTING == "off":
+        return Decision(FULL, "routing_off", llm.MODEL)
+    decision = classify(question)
+    routes_total.inc(decision.route, decision.reason)
+    logger.info(json.dumps({"event": "route", "user_id": user_id, "route": decision.route,
+                            "reason": decision.reason, "model": decision.model, "mode": ROUTING,
+                            "chars": len(question)}))
+    if ROUTING == "shadow":
+        return Decision(FULL, f"shadow_{decision.route}", llm.MODEL, follows_on=decision.follows_on)
+    return decision
@@ -0,0 +1,107 @@
+"""Coalescing of identical in-flight requests.
+
+``SingleFlight.do(key, fn, member)`` runs ``fn()`` once for any number of
+concurrent callers passing the same ``key``, and hands every caller the
+shared result. ``SingleFlight.stream`` does the same for async token
+streams: each caller replays the tokens from the start while one upstream
+stream produces them. The shared work runs in its own task, so a caller
+that disconnects does not cancel it for the others.
+
+``member`` identifies who the caller acts for (a user id). The second
+return value is True only for the first caller per member in a flight,
+which lets a double-submitted request skip saving the same turn twice while
+different users asking the same question each keep their own copy.
+"""
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, Optional, Set, Tuple
+
+
+class _Flight:
+    def __init__(self):
+        self.members: Set[Hashable] = set()
+        self.task: Optional[asyncio.Task] = None
+        # Stream flights only
+        self.tokens = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.changed = asyncio.Event()
+
+    def join(self, member: Hashable) -> bool:
+        first = member not in self.members
+        self.members.add(member)
+        return first
+
+    def publish(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def replay(self) -> AsyncIterator[str]:
+        i = 0
+        while True:
+            while i < len(self.tokens):
+                yield self.tokens[i]
+                i += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self.changed.wait()
+
+
+class SingleFlight:
+    def __init__(self):
+        self._flights: Dict[Tuple, _Flight] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    def _key(self, key: Hashable) -> Tuple:
+        # Tasks and events belong to one event loop
+        return id(asyncio.get_running_loop()), key
+
+    def _join(self, key: Hashable, member: Hashable) -> Tuple[_Flight, bool, bool]:
+        full_key = self._key(key)
+        flight = self._flights.get(full_key)
+        leader = flight is None
+        if leader:
+            flight = self._flights[full_key] = _Flight()
+            self.started += 1
+        else:
+            self.coalesced += 1
+        return flight, leader, flight.join(member)
+
+    def _finish(self, key: Hashable, flight: _Flight):
+        full_key = self._key(key)
+        if self._flights.get(full_key) is flight:
+            del self._flights[full_key]
+
+    def in_flight(self, key: Hashable) -> bool:
+        """Whether a call for ``key`` is running that a caller would join."""
+        return self._key(key) in self._flights
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]], member: Hashable = None) -> Tuple[Any, bool]:
+        flight, leader, first = self._join(key, member)
+        if leader:
+            flight.task = asyncio.ensure_future(fn())
+            flight.task.add_done_callback(lambda _: self._finish(key, flight))
+        return await asyncio.shield(flight.task), first
+
+    def stream(self, key: Hashable, source: Callable[[], AsyncIterator[str]],
+               member: Hashable = None) -> Tuple[AsyncIterator[str], bool]:
+        flight, leader, first = self._join(key, member)
+        if leader:
+            async def pump():
+                try:
+                    async for token in source():
+                        flight.tokens.append(token)
+                        flight.publish()
+                except BaseException as e:
+                    flight.error = e
+                finally:
+                    flight.done = True
+                    flight.publish()
+                    self._finish(key, flight)
+            flight.task = asyncio.ensure_future(pump())
+        return flight.replay(), first
+
+    def stats(self) -> Dict:
+        return {"in_flight": len(self._flights), "started": self.started, "coalesced": self.coalesced}
@@ -0,0 +1,1104 @@
+"""Chat history storage backends shared by both API backends.
+
+Every backend keeps the same contract: ``load_chat_history`` returns the
+``{title: {"question", "answer"}}`` dict the routes have always returned,
+``save_chat`` records one turn, and ``list_active_users`` lists user ids.
+``get_storage`` picks the implementation from the ``CHAT_STORAGE``
+environment variable (``s3``, ``file`` or ``sqlite``).
+"""
+import asyncio
+import contextvars
+import functools
+import hashlib
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import history_codec
+
+try:
+    from botocore.exceptions import ClientError
+except ImportError:  # only S3Storage needs boto3
+
+    class ClientError(Exception):
+        def __init__(self, error_response, operation_name):
+            code = error_response["Error"]["Code"]
+            super().__init__(f"An error occurred ({code}) when calling the {operation_name} operation")
+            self.response = error_response
+            self.operation_name = operation_name
+
+
+# Blocking storage calls from async routes run on this many threads; the S3
+# connection pool is sized to match, with headroom for the background writers
+STORAGE_MAX_WORKERS = int(os.environ.get("STORAGE_MAX_WORKERS", "32"))
+# Log records of one history are fetched this many at a time
+S3_LOG_FETCH_WORKERS = int(os.environ.get("S3_LOG_FETCH_WORKERS", "8"))
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get("S3_MAX_POOL_CONNECTIONS",
+                                             str(STORAGE_MAX_WORKERS + S3_LOG_FETCH_WORKERS + 8)))
+# History snapshots are written in the compact binary format (see
+# history_codec) unless set to "json"; either format is always readable
+CHAT_HISTORY_FORMAT = os.environ.get("CHAT_HISTORY_FORMAT", "binary")
+
+logger = logging.getLogger(__name__)
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+_executor = None
+_fetch_executor = None
+
+
+def default_s3_client():
+    """The process-wide boto3 S3 client, built on first use.
+
+    boto3 is imported here rather than at module load so a cold start only
+    pays for it once something touches S3; a warm container keeps reusing
+    the same client (and its connection pool) across invocations.
+    """
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                import boto3
+                from botocore.config import Config
+                _s3_client = boto3.client("s3", config=Config(
+                    max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                    tcp_keepalive=True,
+                ))
+    return _s3_client
+
+
+def call_async(fn, *args, **kwargs):
+    """Await a blocking storage call without blocking the event loop.
+
+    Calls share one pool of ``STORAGE_MAX_WORKERS`` threads, separate from
+    the server's default threadpool, and keep the caller's context so
+    stage timings still reach the current request.
+    """
+    global _executor
+    if _executor is None:
+        with _s3_client_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(STORAGE_MAX_WORKERS, thread_name_prefix="storage")
+    call = functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+    return asyncio.get_running_loop().run_in_executor(_executor, call)
+
+
+def fetch_executor() -> ThreadPoolExecutor:
+    """Threads for fetching many small objects at once from inside a storage call.
+
+    Separate from ``call_async``'s pool, which may be the caller's own.
+    """
+    global _fetch_executor
+    if _fetch_executor is None:
+        with _s3_client_lock:
+            if _fetch_executor is None:
+                _fetch_executor = ThreadPoolExecutor(S3_LOG_FETCH_WORKERS, thread_name_prefix="s3-fetch")
+    return _fetch_executor
+
+
+def get_summary(question: str) -> str:
+    """The title a turn is stored under: the question, cut to 50 characters."""
+    return question[:50] + "..." if len(question) > 50 else question
+
+
+def make_record(title: str, question: str, answer: str, request_id: Optional[str] = None,
+                faq: bool = True) -> Dict:
+    record = {"title": title, "question": question, "answer": answer}
+    if request_id:
+        # The client's idempotency key, so a retried request can find its turn
+        record["request_id"] = request_id
+    if not faq:
+        # A template answer, or one drawn from or about the user's own
+        # history: never suggested to others (see faq_index)
+        record["faq"] = False
+    return record
+
+
+def apply_record(chats: Dict, record: Dict):
+    entry = {"question": record["question"], "answer": record["answer"]}
+    if record.get("request_id"):
+        entry["request_id"] = record["request_id"]
+    if record.get("faq") is False:
+        entry["faq"] = False
+    chats[record["title"]] = entry
+
+
+def find_request(chats: Dict, request_id: str) -> Optional[Dict]:
+    """The turn saved for ``request_id``, if any."""
+    for entry in reversed(list(chats.values())):
+        if entry.get("request_id") == request_id:
+            return entry
+    return None
+
+
+def encode_history(chats: Dict) -> bytes:
+    if CHAT_HISTORY_FORMAT == "json":
+        return json.dumps(chats).encode("utf-8")
+    return history_codec.dumps(chats)
+
+
+def needs_upgrade(data: bytes) -> bool:
+    """Whether a stored snapshot is in a format other than the one being written."""
+    return bool(data) and history_codec.is_binary(data) != (CHAT_HISTORY_FORMAT != "json")
+
+
+def apply_batch(chats: Dict, batch: Dict):
+    # A log object holds either one record or {"records": [...]} written together
+    for record in batch.get("records", [batch]):
+        apply_record(chats, record)
+
+
+def error_code(e: ClientError) -> str:
+    return e.response["Error"]["Code"]
+
+
+def make_index_record(user_id: str, count: int = 1) -> Dict:
+    return {"user_id": user_id, "at": time.time(), "count": count}
+
+
+def apply_index_record(index: Dict, record: Dict):
+    # Copy the entry: snapshots handed out by the caches must stay untouched
+    entry = dict(index.get(record["user_id"]) or {"last_active": 0, "message_count": 0})
+    entry["last_active"] = max(entry["last_active"], record["at"])
+    entry["message_count"] += record.get("count", 1)
+    index[record["user_id"]] = entry
+
+
+def encode_user_cursor(user: Dict) -> str:
+    return f"{user['last_active']!r}|{user['user_id']}"
+
+
+def query_user_index(index: Dict, active_since: Optional[float] = None, cursor: Optional[str] = None,
+                     limit: Optional[int] = None) -> Tuple[List[Dict], Optional[str]]:
+    """Page through an in-memory user index, most recently active first."""
+    users = sorted(
+        ({"user_id": user_id, **entry} for user_id, entry in index.items()
+         if active_since is None or entry["last_active"] >= active_since),
+        key=lambda u: (-u["last_active"], u["user_id"]),
+    )
+    if cursor:
+        last_active, user_id = cursor.split("|", 1)
+        after = (-float(last_active), user_id)
+        users = [u for u in users if (-u["last_active"], u["user_id"]) > after]
+    if limit is None or len(users) <= limit:
+        return users, None
+    page = users[:limit]
+    return page, encode_user_cursor(page[-1])
+
+
+def history_version(*parts) -> str:
+    return hashlib.sha1("\n".join(str(p) for p in parts).encode("utf-8")).hexdigest()[:20]
+
+
+def paginate_history(chats: Dict, cursor: Optional[str] = None, limit: int = 20) -> Tuple[Dict, Optional[str]]:
+    """Return one newest-first page of ``chats`` and the cursor of the next page.
+
+    The cursor is the insertion position the next page starts below, so
+    turns added while a client is paging do not shift later pages.
+    """
+    items = list(chats.items())
+    end = min(int(cursor), len(items)) if cursor else len(items)
+    start = max(end - limit, 0)
+    page = dict(reversed(items[start:end]))
+    return page, (str(start) if start > 0 else None)
+
+
+class LRUCache:
+    """Small thread-safe LRU map for parsed objects kept in a warm process."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class ChatStorage:
+    """Interface implemented by every storage backend."""
+
+    def load_chat_history(self, user_id: str) -> Dict:
+        raise NotImplementedError
+
+    def load_versioned(self, user_id: str) -> Tuple[Dict, str]:
+        """Return the history and a token that changes whenever it does."""
+        chats = self.load_chat_history(user_id)
+        return chats, history_version(json.dumps(chats))
+
+    def load_chat_history_readonly(self, user_id: str) -> Dict:
+        """The history, without writing anything (no compaction or format upgrade); for bulk reads."""
+        return self.load_chat_history(user_id)
+
+    def save_chat(self, user_id: str, title: str, question: str, answer: str):
+        self.save_chats(user_id, [make_record(title, question, answer)])
+
+    def save_chats(self, user_id: str, records: List[Dict]):
+        """Store several turns for one user in a single write."""
+        raise NotImplementedError
+
+    def list_users(self, active_since: Optional[float] = None, cursor: Optional[str] = None,
+                   limit: Optional[int] = None) -> Tuple[List[Dict], Optional[str]]:
+        """Page of ``{"user_id", "last_active", "message_count"}`` from the user index.
+
+        Users are ordered most recently active first; ``active_since`` is a
+        Unix timestamp and ``cursor`` comes from the previous page.
+        """
+        raise NotImplementedError
+
+    def list_active_users(self) -> List[str]:
+        return [user["user_id"] for user in self.list_users()[0]]
+
+    def iter_users(self) -> Iterator[str]:
+        """Every stored user id, for bulk jobs; backends may read the store itself."""
+        return iter(self.list_active_users())
+
+    def load_user_meta(self, user_id: str) -> Dict:
+        """Small per-user state kept next to the history (e.g. thread ids)."""
+        raise NotImplementedError
+
+    def save_user_meta(self, user_id: str, meta: Dict):
+        raise NotImplementedError
+
+    def load_search_index(self, user_id: str) -> Tuple[Optional[bytes], Optional[str]]:
+        """The user's encoded search index and its version, or ``(None, None)``."""
+        raise NotImplementedError
+
+    def save_search_index(self, user_id: str, data: bytes, version: Optional[str]) -> bool:
+        """Replace the search index only if it is still at ``version`` (None: absent).
+
+        Returns False, without writing, if someone else changed it first.
+        """
+        raise NotImplementedError
+
+    def append_search_segment(self, user_id: str, data: bytes):
+        """Store one more encoded segment of the user's search index; segments never change."""
+        raise NotImplementedError
+
+    def load_search_segments(self, user_id: str) -> List[Tuple[str, bytes]]:
+        """The user's stored search segments as ``(name, data)``, oldest (lowest name) first."""
+        raise NotImplementedError
+
+    def delete_search_segments(self, user_id: str, names: List[str]):
+        raise NotImplementedError
+
+    def needs_compaction(self, user_id: str) -> bool:
+        """Whether ``compact`` should be scheduled after a write."""
+        return False
+
+    def compact(self, user_id: str):
+        """Fold pending log records into the user's snapshot."""
+
+    def warm(self):
+        """Create clients ahead of the first request that needs them."""
+
+
+# --------- S3 ---------
+class S3Storage(ChatStorage):
+    """``{user_id}.json`` snapshots plus one small log object per turn.
+
+    Log records live under ``log/{user_id}/``. Once ``compact_threshold`` of
+    them pile up, ``compact`` (run by the write-behind worker after a write,
+    never by a read) folds them into the snapshot. The user index uses the
+    same layout: ``index/users.json`` plus one record per turn under
+    ``index/log/``, compacted the same way. On a bucket that has histories
+    but no index yet, run ``python rebuild_user_index.py`` once; otherwise
+    the first listing starts the scan in the background and only shows
+    users active since then until it finishes. Parsed snapshots are kept in an
+    LRU and revalidated with a conditional GET on the ETag; log objects
+    never change once written, so parsed records are reused as-is, and the
+    ones not cached yet are fetched concurrently.
+
+    Each user's search index (see ``history_search``) is one object under
+    ``search/``, replaced with conditional puts when segments are merged
+    into it, plus the segments written since under ``search/log/``.
+
+    History snapshots are stored with ``encode_history`` under the same
+    ``.json`` keys. A snapshot found in the old JSON format is rewritten in
+    place (conditionally on its ETag) the first time it is read.
+    """
+
+    LOG_PREFIX = "log/"
+    META_PREFIX = "meta/"
+    SEARCH_PREFIX = "search/"
+    SEARCH_LOG_PREFIX = "search/log/"
+    INDEX_KEY = "index/users.json"
+    INDEX_LOG_PREFIX = "index/log/"
+
+    def __init__(self, bucket: str, client=None, compact_threshold: int = 20, cache_size: int = 128):
+        self.bucket = bucket
+        # None means the shared default client, created when first needed
+        self.client = client
+        self.compact_threshold = compact_threshold
+        self._snapshots = LRUCache(cache_size)
+        self._records = LRUCache(cache_size * compact_threshold)
+        self._search_segments = LRUCache(cache_size * compact_threshold)
+        # Snapshot keys last read in a format that should be upgraded
+        self._stale_format = set()
+        # Log records seen under each prefix at the last read, plus those written since
+        self._log_counts: Dict[str, int] = {}
+        self._index_rebuild: Optional[threading.Thread] = None
+        self._index_rebuild_lock = threading.Lock()
+
+    @property
+    def s3(self):
+        return self.client if self.client is not None else default_s3_client()
+
+    def warm(self):
+        self.s3
+
+    def get_key(self, user_id: str) -> str:
+        return f"{user_id}.json"
+
+    def get_log_prefix(self, user_id: str) -> str:
+        return f"{self.LOG_PREFIX}{user_id}/"
+
+    def get_meta_key(self, user_id: str) -> str:
+        return f"{self.META_PREFIX}{user_id}.json"
+
+    def get_search_key(self, user_id: str) -> str:
+        return f"{self.SEARCH_PREFIX}{user_id}.bin"
+
+    def get_search_log_prefix(self, user_id: str) -> str:
+        return f"{self.SEARCH_LOG_PREFIX}{user_id}/"
+
+    def new_log_key(self, prefix: str) -> str:
+        # Zero-padded nanosecond timestamps keep keys in write order when listed
+        return f"{prefix}{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.json"
+
+    @staticmethod
+    def log_key_time(key: str) -> float:
+        """When the log record at ``key`` was written, from its name."""
+        return int(key.rsplit("/", 1)[-1][:20]) / 1e9
+
+    def load_snapshot(self, key: str) -> Tuple[Dict, Optional[str]]:
+        cached = self._snapshots.get(key)
+        condition = {"IfNoneMatch": cached[0]} if cached else {}
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=key, **condition)
+        except ClientError as e:
+            if error_code(e) in ("304", "NotModified") and cached:
+                return dict(cached[1]), cached[0]
+            if error_code(e) == "NoSuchKey":
+                self._snapshots.pop(key)
+                return {}, None
+            raise e
+        body = response["Body"].read()
+        state = history_codec.loads(body)
+        if key != self.INDEX_KEY and needs_upgrade(body):
+            self._stale_format.add(key)
+        else:
+            self._stale_format.discard(key)
+        self._snapshots.put(key, (response["ETag"], state))
+        return dict(state), response["ETag"]
+
+    def load_record(self, key: str) -> Dict:
+        record = self._records.get(key)
+        if record is None:
+            response = self.s3.get_object(Bucket=self.bucket, Key=key)
+            record = json.loads(response["Body"].read().decode("utf-8"))
+            self._records.put(key, record)
+        return record
+
+    def load_records(self, keys: List[str]) -> List[Dict]:
+        """Records for ``keys``, in order; the uncached ones are fetched concurrently."""
+        if len(keys) <= 1:
+            return [self.load_record(key) for key in keys]
+        return list(fetch_executor().map(self.load_record, keys))
+
+    def list_log_keys(self, prefix: str) -> List[str]:
+        keys = []
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            keys.extend(obj["Key"] for obj in page.get("Contents", []))
+        return sorted(keys)
+
+    def write_snapshot(self, key: str, state: Dict, etag: Optional[str]) -> bool:
+        """Replace a snapshot only if it is still at ``etag``; False if we lost the race."""
+        # The user index is small and stays JSON
+        body = json.dumps(state).encode("utf-8") if key == self.INDEX_KEY else encode_history(state)
+        condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+        try:
+            response = self.s3.put_object(Bucket=self.bucket, Key=key, Body=body, **condition)
+        except ClientError as e:
+            if error_code(e) in ("PreconditionFailed", "ConditionalRequestConflict"):
+                return False
+            raise e
+        self._snapshots.put(key, (response["ETag"], dict(state)))
+        self._stale_format.discard(key)
+        return True
+
+    def delete_keys(self, keys: List[str]):
+        for i in range(0, len(keys), 1000):
+            self.s3.delete_objects(
+                Bucket=self.bucket,
+                Delete={"Objects": [{"Key": k} for k in keys[i:i + 1000]], "Quiet": True},
+            )
+
+    def compact_log(self, key: str, state: Dict, etag: Optional[str], log_keys: List[str]):
+        """Write the replayed view as the new snapshot and drop its log records."""
+        # Conditional put: a concurrent compaction that already replaced the
+        # snapshot wins, and our records stay in the log for the next pass.
+        if self.write_snapshot(key, state, etag):
+            self.delete_keys(log_keys)
+
+    def replay_log(self, key: str, log_prefix: str, apply) -> Tuple[Dict, str, Optional[str], List[str]]:
+        """Return snapshot ``key`` with every record under ``log_prefix`` applied.
+
+        Also returns a version token, the snapshot's ETag (None when the
+        snapshot does not exist yet) and the log keys applied. Nothing is
+        written; see ``compact``.
+        """
+        # A record can vanish between listing and reading when another request
+        # compacts it into the snapshot; start over from the newer snapshot then.
+        for _ in range(3):
+            state, etag = self.load_snapshot(key)
+            log_keys = self.list_log_keys(log_prefix)
+            try:
+                records = self.load_records(log_keys)
+            except ClientError as e:
+                if error_code(e) == "NoSuchKey":
+                    continue
+                raise e
+            for record in records:
+                apply(state, record)
+            self._log_counts[log_prefix] = len(log_keys)
+            return state, history_version(etag, *log_keys), etag, log_keys
+        raise RuntimeError(f"Log under {log_prefix} kept changing while loading")
+
+    def load_versioned(self, user_id: str) -> Tuple[Dict, str]:
+        key = self.get_key(user_id)
+        chats, version, etag, _ = self.replay_log(key, self.get_log_prefix(user_id), apply_batch)
+        cached = self._snapshots.get(key)
+        if key in self._stale_format and cached:
+            # Upgrade the snapshot alone; its log records stay where they are
+            self.write_snapshot(key, dict(cached[1]), etag)
+        return chats, version
+
+    def load_chat_history(self, user_id: str) -> Dict:
+        return self.load_versioned(user_id)[0]
+
+    def load_chat_history_readonly(self, user_id: str) -> Dict:
+        return self.replay_log(self.get_key(user_id), self.get_log_prefix(user_id), apply_batch)[0]
+
+    def save_chats(self, user_id: str, records: List[Dict]):
+        # Each batch of turns is one small object (plus one for the user
+        # index), so the write cost does not grow with the length of the history.
+        log_prefix = self.get_log_prefix(user_id)
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=self.new_log_key(log_prefix),
+            Body=json.dumps({"records": records}).encode("utf-8"),
+        )
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=self.new_log_key(self.INDEX_LOG_PREFIX),
+            Body=json.dumps(make_index_record(user_id, len(records))).encode("utf-8"),
+        )
+        for prefix in (log_prefix, self.INDEX_LOG_PREFIX):
+            if prefix in self._log_counts:
+                self._log_counts[prefix] += 1
+
+    def _log_count(self, prefix: str) -> int:
+        count = self._log_counts.get(prefix)
+        if count is None:
+            count = self._log_counts[prefix] = len(self.list_log_keys(prefix))
+        return count
+
+    def needs_compaction(self, user_id: str) -> bool:
+        # Counted from the last read plus this process's writes; other
+        # writers' records are noticed at the next read or compaction
+        return (self._log_count(self.get_log_prefix(user_id)) >= self.compact_threshold
+                or self._log_count(self.INDEX_LOG_PREFIX) >= self.compact_threshold
+                or self.get_key(user_id) in self._stale_format)
+
+    def _compact(self, key: str, log_prefix: str, apply):
+        state, _, etag, log_keys = self.replay_log(key, log_prefix, apply)
+        if len(log_keys) >= self.compact_threshold or key in self._stale_format:
+            self.compact_log(key, state, etag, log_keys)
+            self._log_counts.pop(log_prefix, None)
+
+    def compact(self, user_id: str):
+        self._compact(self.get_key(user_id), self.get_log_prefix(user_id), apply_batch)
+        if self._log_count(self.INDEX_LOG_PREFIX) >= self.compact_threshold:
+            self._compact(self.INDEX_KEY, self.INDEX_LOG_PREFIX, apply_index_record)
+
+    def load_user_meta(self, user_id: str) -> Dict:
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=self.get_meta_key(user_id))
+            return json.loads(response["Body"].read().decode("utf-8"))
+        except ClientError as e:
+            if error_code(e) == "NoSuchKey":
+                return {}
+            raise e
+
+    def save_user_meta(self, user_id: str, meta: Dict):
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=self.get_meta_key(user_id),
+            Body=json.dumps(meta).encode("utf-8"),
+        )
+
+    def load_search_index(self, user_id: str) -> Tuple[Optional[bytes], Optional[str]]:
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=self.get_search_key(user_id))
+        except ClientError as e:
+            if error_code(e) == "NoSuchKey":
+                return None, None
+            raise e
+        return response["Body"].read(), response["ETag"]
+
+    def save_search_index(self, user_id: str, data: bytes, version: Optional[str]) -> bool:
+        condition = {"IfMatch": version} if version else {"IfNoneMatch": "*"}
+        try:
+            self.s3.put_object(Bucket=self.bucket, Key=self.get_search_key(user_id), Body=data, **condition)
+        except ClientError as e:
+            if error_code(e) in ("PreconditionFailed", "ConditionalRequestConflict", "NoSuchKey"):
+                return False
+            raise e
+        return True
+
+    def append_search_segment(self, user_id: str, data: bytes):
+        key = f"{self.get_search_log_prefix(user_id)}{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.bin"
+        self.s3.put_object(Bucket=self.bucket, Key=key, Body=data)
+        self._search_segments.put(key, data)
+
+    def _load_search_segment(self, key: str) -> Optional[bytes]:
+        data = self._search_segments.get(key)
+        if data is None:
+            try:
+                data = self.s3.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+            except ClientError as e:
+                # Merged and deleted since the listing; the index it went into is newer
+                if error_code(e) == "NoSuchKey":
+                    return None
+                raise e
+            self._search_segments.put(key, data)
+        return data
+
+    def load_search_segments(self, user_id: str) -> List[Tuple[str, bytes]]:
+        prefix = self.get_search_log_prefix(user_id)
+        keys = self.list_log_keys(prefix)
+        if len(keys) <= 1:
+            blobs = [self._load_search_segment(key) for key in keys]
+        else:
+            blobs = list(fetch_executor().map(self._load_search_segment, keys))
+        return [(key[len(prefix):], data) for key, data in zip(keys, blobs) if data is not None]
+
+    def delete_search_segments(self, user_id: str, names: List[str]):
+        prefix = self.get_search_log_prefix(user_id)
+        keys = [prefix + name for name in names]
+        self.delete_keys(keys)
+        for key in keys:
+            self._search_segments.pop(key)
+
+    def iter_users(self) -> Iterator[str]:
+        """Walk the bucket a listing page at a time, yielding each user id once."""
+        seen = set()
+        paginator = self.s3.get_paginator("list_objects_v2")
+        # Delimiter keeps the log, meta, search and index prefixes out of the listing
+        for page in paginator.paginate(Bucket=self.bucket, Delimiter="/"):
+            for obj in page.get("Contents", []):
+                if obj["Key"].endswith(".json"):
+                    user_id = obj["Key"][:-len(".json")]
+                    seen.add(user_id)
+                    yield user_id
+        # Users whose turns have not been compacted yet only exist under the log prefix
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.LOG_PREFIX, Delimiter="/"):
+            for prefix in page.get("CommonPrefixes", []):
+                user_id = prefix["Prefix"][len(self.LOG_PREFIX):-1]
+                if user_id not in seen:
+                    seen.add(user_id)
+                    yield user_id
+
+    def scan_users(self) -> Dict[str, float]:
+        """Map each user id to its snapshot's LastModified (0 without one); only used to build the index."""
+        users = {}
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Delimiter="/"):
+            for obj in page.get("Contents", []):
+                if obj["Key"].endswith(".json"):
+                    users[obj["Key"][:-len(".json")]] = obj["LastModified"].timestamp()
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.LOG_PREFIX, Delimiter="/"):
+            for prefix in page.get("CommonPrefixes", []):
+                users.setdefault(prefix["Prefix"][len(self.LOG_PREFIX):-1], 0.0)
+        return users
+
+    def rebuild_user_index(self) -> Dict:
+        """Build the user index from stored histories (one full scan).
+
+        A user was last active when their newest log record or, once
+        compacted, their snapshot was written. Histories are only read.
+        """
+        stale = self.list_log_keys(self.INDEX_LOG_PREFIX)
+        index = {}
+        for user_id, modified in self.scan_users().items():
+            chats, _, _, log_keys = self.replay_log(self.get_key(user_id), self.get_log_prefix(user_id), apply_batch)
+            last_active = max([modified] + [self.log_key_time(k) for k in log_keys])
+            index[user_id] = {"last_active": last_active, "message_count": len(chats)}
+        if self.write_snapshot(self.INDEX_KEY, index, None):
+            self.delete_keys(stale)
+        return index
+
+    def _rebuild_user_index_quietly(self):
+        try:
+            self.rebuild_user_index()
+        except Exception:
+            logger.exception("Rebuilding the user index failed; the next listing retries")
+
+    def start_user_index_rebuild(self):
+        """Rebuild the user index on a background thread unless one is running."""
+        with self._index_rebuild_lock:
+            if self._index_rebuild is None or not self._index_rebuild.is_alive():
+                self._index_rebuild = threading.Thread(target=self._rebuild_user_index_quietly,
+                                                       name="user-index-rebuild", daemon=True)
+                self._index_rebuild.start()
+
+    def load_user_index(self) -> Dict:
+        if self.load_snapshot(self.INDEX_KEY)[1] is None:
+            # First use on an existing bucket: a full scan would not fit in a
+            # request, so it runs in the background (or ahead of time, see
+            # rebuild_user_index.py) and users active since are listed meanwhile
+            self.start_user_index_rebuild()
+        return self.replay_log(self.INDEX_KEY, self.INDEX_LOG_PREFIX, apply_index_record)[0]
+
+    def list_users(self, active_since: Optional[float] = None, cursor: Optional[str] = None,
+                   limit: Optional[int] = None) -> Tuple[List[Dict], Optional[str]]:
+        return query_user_index(self.load_user_index(), active_since, cursor, limit)
+
+
+# --------- Local filesystem ---------
+class FileStorage(ChatStorage):
+    """``{user_id}.json`` snapshots plus an append-only ``{user_id}.log``.
+
+    Snapshots are written with ``encode_history``; one still in the old
+    (pretty-printed) JSON format is rewritten the first time it is read.
+    The user index is held in memory and mirrored to ``index/users.json``.
+    """
+
+    def __init__(self, data_dir: str, compact_bytes: int = 64 * 1024, cache_size: int = 128):
+        self.data_dir = data_dir
+        self.compact_bytes = compact_bytes
+        self._lock = threading.Lock()
+        self._cache = LRUCache(cache_size)
+        self._index = None
+        os.makedirs(os.path.join(data_dir, "meta"), exist_ok=True)
+        os.makedirs(os.path.join(data_dir, "index"), exist_ok=True)
+        os.makedirs(os.path.join(data_dir, "search"), exist_ok=True)
+
+    def get_filename(self, user_id: str) -> str:
+        return os.path.join(self.data_dir, f"{user_id}.json")
+
+    def get_log_filename(self, user_id: str) -> str:
+        return os.path.join(self.data_dir, f"{user_id}.log")
+
+    def get_meta_filename(self, user_id: str) -> str:
+        return os.path.join(self.data_dir, "meta", f"{user_id}.json")
+
+    def get_index_filename(self) -> str:
+        return os.path.join(self.data_dir, "index", "users.json")
+
+    def get_search_filename(self, user_id: str) -> str:
+        return os.path.join(self.data_dir, "search", f"{user_id}.bin")
+
+    def get_search_segment_dir(self, user_id: str) -> str:
+        return os.path.join(self.data_dir, "search", user_id)
+
+    def _file_version(self, filepath: str) -> Optional[str]:
+        try:
+            st = os.stat(filepath)
+        except FileNotFoundError:
+            return None
+        return history_version(st.st_mtime_ns, st.st_size)
+
+    def _write_snapshot(self, user_id: str, chats: Dict):
+        filename = self.get_filename(user_id)
+        tmp = filename + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(encode_history(chats))
+        os.replace(tmp, filename)
+
+    def _read_chats(self, user_id: str, upgrade: bool = False) -> Dict:
+        # Called with self._lock held
+        chats = {}
+        filepath = self.get_filename(user_id)
+        if os.path.exists(filepath):
+            with open(filepath, "rb") as f:
+                data = f.read()
+            chats = history_codec.loads(data)
+            if upgrade and needs_upgrade(data):
+                self._write_snapshot(user_id, chats)
+        log_path = self.get_log_filename(user_id)
+        if os.path.exists(log_path):
+            with open(log_path, "r") as f:
+                for line in f:
+                    if line.strip():
+                        apply_record(chats, json.loads(line))
+        return chats
+
+    def _stat_version(self, user_id: str) -> str:
+        stats = []
+        for path in (self.get_filename(user_id), self.get_log_filename(user_id)):
+            try:
+                st = os.stat(path)
+                stats.append(f"{st.st_mtime_ns}:{st.st_size}")
+            except FileNotFoundError:
+                stats.append("-")
+        return history_version(*stats)
+
+    def load_versioned(self, user_id: str) -> Tuple[Dict, str]:
+        # Parsed histories are reused until either file's mtime or size changes
+        with self._lock:
+            version = self._stat_version(user_id)
+            cached = self._cache.get(user_id)
+            if cached and cached[0] == version:
+                return dict(cached[1]), version
+            chats = self._read_chats(user_id, upgrade=True)
+            # An upgraded snapshot has a new mtime and size
+            version = self._stat_version(user_id)
+        self._cache.put(user_id, (version, chats))
+        return dict(chats), version
+
+    def load_chat_history(self, user_id: str) -> Dict:
+        return self.load_versioned(user_id)[0]
+
+    def load_chat_history_readonly(self, user_id: str) -> Dict:
+        with self._lock:
+            return self._read_chats(user_id)
+
+    def save_chats(self, user_id: str, records: List[Dict]):
+        lines = "".join(json.dumps(record) + "\n" for record in records)
+        with self._lock:
+            index = self._load_index()
+            with open(self.get_log_filename(user_id), "a") as f:
+                f.write(lines)
+            apply_index_record(index, make_index_record(user_id, len(records)))
+            self._write_json(self.get_index_filename(), index)
+
+    def load_user_meta(self, user_id: str) -> Dict:
+        filepath = self.get_meta_filename(user_id)
+        if os.path.exists(filepath):
+            with open(filepath, "r") as f:
+                return json.load(f)
+        return {}
+
+    def _write_json(self, filepath: str, data: Dict):
+        tmp = filepath + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, filepath)
+
+    def save_user_meta(self, user_id: str, meta: Dict):
+        self._write_json(self.get_meta_filename(user_id), meta)
+
+    def load_search_index(self, user_id: str) -> Tuple[Optional[bytes], Optional[str]]:
+        filepath = self.get_search_filename(user_id)
+        with self._lock:
+            version = self._file_version(filepath)
+            if version is None:
+                return None, None
+            with open(filepath, "rb") as f:
+                return f.read(), version
+
+    def save_search_index(self, user_id: str, data: bytes, version: Optional[str]) -> bool:
+        filepath = self.get_search_filename(user_id)
+        with self._lock:
+            if self._file_version(filepath) != version:
+                return False
+            tmp = filepath + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, filepath)
+        return True
+
+    def append_search_segment(self, user_id: str, data: bytes):
+        directory = self.get_search_segment_dir(user_id)
+        os.makedirs(directory, exist_ok=True)
+        filepath = os.path.join(directory, f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.bin")
+        with open(filepath + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(filepath + ".tmp", filepath)
+
+    def load_search_segments(self, user_id: str) -> List[Tuple[str, bytes]]:
+        directory = self.get_search_segment_dir(user_id)
+        segments = []
+        for name in sorted(os.listdir(directory)) if os.path.isdir(directory) else ():
+            if not name.endswith(".bin"):
+                continue
+            try:
+                with open(os.path.join(directory, name), "rb") as f:
+                    segments.append((name, f.read()))
+            except FileNotFoundError:
+                continue  # merged and deleted since the listing
+        return segments
+
+    def delete_search_segments(self, user_id: str, names: List[str]):
+        directory = self.get_search_segment_dir(user_id)
+        for name in names:
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+
+    def _load_index(self) -> Dict:
+        # Called with self._lock held
+        if self._index is None:
+            filepath = self.get_index_filename()
+            if os.path.exists(filepath):
+                with open(filepath, "r") as f:
+                    self._index = json.load(f)
+            else:
+                # First run on an existing data dir: index the stored histories once
+                self._index = {}
+                for name in sorted(os.listdir(self.data_dir)):
+                    user_id, ext = os.path.splitext(name)
+                    if ext in (".json", ".log") and user_id not in self._index:
+                        chats = self._read_chats(user_id)
+                        last_active = max(os.path.getmtime(os.path.join(self.data_dir, name)), 0)
+                        self._index[user_id] = {"last_active": last_active, "message_count": len(chats)}
+                self._write_json(filepath, self._index)
+        return self._index
+
+    def list_users(self, active_since: Optional[float] = None, cursor: Optional[str] = None,
+                   limit: Optional[int] = None) -> Tuple[List[Dict], Optional[str]]:
+        with self._lock:
+            index = dict(self._load_index())
+        return query_user_index(index, active_since, cursor, limit)
+
+    def needs_compaction(self, user_id: str) -> bool:
+        log_path = self.get_log_filename(user_id)
+        return os.path.exists(log_path) and os.path.getsize(log_path) >= self.compact_bytes
+
+    def compact(self, user_id: str):
+        with self._lock:
+            chats = self._read_chats(user_id)
+            self._write_snapshot(user_id, chats)
+            open(self.get_log_filename(user_id), "w").close()
+
+
+# --------- SQLite ---------
+class SQLiteStorage(ChatStorage):
+    """One indexed row per turn in a WAL-mode SQLite database.
+
+    Connections are pooled so concurrent requests in the same process do not
+    pay for opening the database on every call.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS chat_turns (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            title TEXT NOT NULL,
+            question TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            request_id TEXT,
+            faq INTEGER NOT NULL DEFAULT 1
+        );
+        CREATE INDEX IF NOT EXISTS idx_chat_turns_user ON chat_turns (user_id, id);
+        CREATE TABLE IF NOT EXISTS user_index (
+            user_id TEXT PRIMARY KEY,
+            last_active REAL NOT NULL,
+            message_count INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_user_index_active ON user_index (last_active DESC, user_id);
+        CREATE TABLE IF NOT EXISTS user_meta (
+            user_id TEXT PRIMARY KEY,
+            meta TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS search_index (
+            user_id TEXT PRIMARY KEY,
+            data BLOB NOT NULL,
+            version INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS search_segments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            data BLOB NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_search_segments_user ON search_segments (user_id, id);
+    """
+
+    def __init__(self, path: str, pool_size: int = 4):
+        self.path = path
+        self._pool = queue.Queue()
+        for _ in range(pool_size):
+            self._pool.put(self._connect())
+        with self._connection() as conn:
+            conn.executescript(self.SCHEMA)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(chat_turns)")}
+            if "request_id" not in columns:
+                conn.execute("ALTER TABLE chat_turns ADD COLUMN request_id TEXT")
+            if "faq" not in columns:
+                conn.execute("ALTER TABLE chat_turns ADD COLUMN faq INTEGER NOT NULL DEFAULT 1")
+            # Databases created before the user index existed get it backfilled once
+            if conn.execute("SELECT 1 FROM user_index LIMIT 1").fetchone() is None:
+                conn.execute(
+                    "INSERT INTO user_index (user_id, last_active, message_count) "
+                    "SELECT user_id, MAX(created_at), COUNT(*) FROM chat_turns GROUP BY user_id"
+                )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        conn = self._pool.get()
+        try:
+            with conn:
+                yield conn
+        finally:
+            self._pool.put(conn)
+
+    def load_chat_history(self, user_id: str) -> Dict:
+        with self._connection() as conn:
+            rows = conn.execute(
+                "SELECT title, question, answer, request_id, faq FROM chat_turns WHERE user_id = ? ORDER BY id",
+                (user_id,),
+            ).fetchall()
+        chats = {}
+        for title, question, answer, request_id, faq in rows:
+            apply_record(chats, make_record(title, question, answer, request_id, bool(faq)))
+        return chats
+
+    def save_chats(self, user_id: str, records: List[Dict]):
+        now = time.time()
+        with self._connection() as conn:
+            conn.executemany(
+                "INSERT INTO chat_turns (user_id, title, question, answer, created_at, request_id, faq) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(user_id, r["title"], r["question"], r["answer"], now, r.get("request_id"), r.get("faq", True))
+                 for r in records],
+            )
+            conn.execute(
+                "INSERT INTO user_index (user_id, last_active, message_count) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET last_active = excluded.last_active, "
+                "message_count = message_count + excluded.message_count",
+                (user_id, now, len(records)),
+            )
+
+    def load_user_meta(self, user_id: str) -> Dict:
+        with self._connection() as conn:
+            row = conn.execute("SELECT meta FROM user_meta WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def save_user_meta(self, user_id: str, meta: Dict):
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO user_meta (user_id, meta) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET meta = excluded.meta",
+                (user_id, json.dumps(meta)),
+            )
+
+    def load_search_index(self, user_id: str) -> Tuple[Optional[bytes], Optional[str]]:
+        with self._connection() as conn:
+            row = conn.execute("SELECT data, version FROM search_index WHERE user_id = ?", (user_id,)).fetchone()
+        return (bytes(row[0]), str(row[1])) if row else (None, None)
+
+    def save_search_index(self, user_id: str, data: bytes, version: Optional[str]) -> bool:
+        with self._connection() as conn:
+            if version is None:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO search_index (user_id, data, version) VALUES (?, ?, 1)",
+                    (user_id, data),
+                )
+            else:
+                cursor = conn.execute(
+                    "UPDATE search_index SET data = ?, version = version + 1 WHERE user_id = ? AND version = ?",
+                    (data, user_id, int(version)),
+                )
+        return cursor.rowcount == 1
+
+    def append_search_segment(self, user_id: str, data: bytes):
+        with self._connection() as conn:
+            conn.execute("INSERT INTO search_segments (user_id, data) VALUES (?, ?)", (user_id, data))
+
+    def load_search_segments(self, user_id: str) -> List[Tuple[str, bytes]]:
+        with self._connection() as conn:
+            rows = conn.execute("SELECT id, data FROM search_segments WHERE user_id = ? ORDER BY id",
+                                (user_id,)).fetchall()
+        # Zero-padded so names sort like the ids
+        return [(f"{row_id:020d}", bytes(data)) for row_id, data in rows]
+
+    def delete_search_segments(self, user_id: str, names: List[str]):
+        with self._connection() as conn:
+            conn.executemany("DELETE FROM search_segments WHERE user_id = ? AND id = ?",
+                             [(user_id, int(name)) for name in names])
+
+    def list_users(self, active_since: Optional[float] = None, cursor: Optional[str] = None,
+                   limit: Optional[int] = None) -> Tuple[List[Dict], Optional[str]]:
+        sql = "SELECT user_id, last_active, message_count FROM user_index WHERE last_active >= ?"
+        params = [active_since if active_since is not None else float("-inf")]
+        if cursor:
+            last_active, user_id = cursor.split("|", 1)
+            sql += " AND (last_active < ? OR (last_active = ? AND user_id > ?))"
+            params += [float(last_active), float(last_active), user_id]
+        sql += " ORDER BY last_active DESC, user_id"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit + 1)
+        with self._connection() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        users = [{"user_id": u, "last_active": t, "message_count": n} for u, t, n in rows]
+        if limit is None or len(users) <= limit:
+            return users, None
+        return users[:limit], encode_user_cursor(users[limit - 1])
+
+    def close(self):
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
+
+
+def get_storage(default: str = "s3", **defaults) -> ChatStorage:
+    """Build the backend named by ``CHAT_STORAGE`` (falling back to ``default``).
+
+    ``defaults`` supplies per-backend settings (``bucket``, ``data_dir``,
+    ``sqlite_path``) that the matching environment variables override.
+    """
+    backend = os.environ.get("CHAT_STORAGE", default)
+    cache_size = int(os.environ.get("HISTORY_CACHE_SIZE", "128"))
+    if backend == "s3":
+        return S3Storage(
+            os.environ.get("CHAT_S3_BUCKET", defaults.get("bucket", "img-chat-history")),
+            compact_threshold=int(os.environ.get("CHAT_COMPACT_THRESHOLD", "20")),
+            cache_size=cache_size,
+        )
+    if backend == "file":
+        return FileStorage(
+            os.environ.get("CHAT_DATA_DIR", defaults.get("data_dir", "chat_data")),
+            compact_bytes=int(os.environ.get("CHAT_COMPACT_BYTES", str(64 * 1024))),
+            cache_size=cache_size,
+        )
+    if backend == "sqlite":
+        return SQLiteStorage(
+            os.environ.get("CHAT_SQLITE_PATH", defaults.get("sqlite_path", "chat_history.db")),
+            pool_size=int(os.environ.get("CHAT_SQLITE_POOL_SIZE", "4")),
+        )
+    raise ValueError(f"Unknown CHAT_STORAGE backend: {backend}")
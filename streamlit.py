@@ -1,6 +1,9 @@
 import streamlit as st
 import requests
 import json
+import uuid
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Set page config with light red background
 st.set_page_config(
@@ -38,6 +41,10 @@ st.markdown(
 
 # API configuration
 API_BASE_URL = "https://xzi0jposzj.execute-api.ap-south-1.amazonaws.com/development"
+HISTORY_PAGE_SIZE = 10
+# Seconds that fetched history and user lists are reused across reruns
+HISTORY_CACHE_TTL = 120
+ACTIVE_USERS_CACHE_TTL = 30
 
 # Initialize session state
 if 'current_user' not in st.session_state:
@@ -48,13 +55,39 @@ if 'rating_submitted' not in st.session_state:
     st.session_state.rating_submitted = False
 if 'last_response' not in st.session_state:
     st.session_state.last_response = None
+if 'history_chats' not in st.session_state:
+    st.session_state.history_chats = None
+    st.session_state.history_cursor = None
+# ((user, question), request_id) of a Send that has not succeeded yet; sending the
+# same question again reuses the id so the backend answers and saves it once
+if 'pending_request' not in st.session_state:
+    st.session_state.pending_request = None
+if 'search_results' not in st.session_state:
+    st.session_state.search_results = None
+    st.session_state.search_cursor = None
 
 # ======================
 # API Connection Handler
 # ======================
+@st.cache_resource
+def get_session():
+    # One pooled keep-alive session for the whole app, so reruns reuse TLS connections.
+    # Only idempotent GETs are retried on 5xx; chats and ratings are never re-sent.
+    session = requests.Session()
+    retry = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(429, 502, 503, 504),
+        allowed_methods=frozenset({"GET"}),
+        respect_retry_after_header=True,
+    )
+    session.mount("https://", HTTPAdapter(max_retries=retry, pool_connections=4, pool_maxsize=10))
+    session.mount("http://", HTTPAdapter(max_retries=retry, pool_connections=4, pool_maxsize=10))
+    return session
+
 def test_api_connection():
     try:
-        response = requests.get(f"{API_BASE_URL}/get-active-users", timeout=5)
+        response = get_session().get(f"{API_BASE_URL}/get-active-users", params={"limit": 1}, timeout=5)
         if response.status_code == 200:
             st.session_state.api_connected = True
             return True
@@ -65,27 +98,77 @@ def test_api_connection():
 # ================
 # API Functions
 # ================
-def chat_with_assistant(user_id, question):
+# Yields (event, data) pairs parsed from the /chat/stream Server-Sent Events
+def stream_chat_with_assistant(user_id, question, request_id=None):
     try:
-        response = requests.post(f"{API_BASE_URL}/chat", json={"user_id": user_id, "question": question}, timeout=30)
-        response.raise_for_status()
-        return response.json()
+        with get_session().post(
+            f"{API_BASE_URL}/chat/stream",
+            json={"user_id": user_id, "question": question, "request_id": request_id},
+            stream=True,
+            timeout=(5, 60),
+        ) as response:
+            if response.status_code == 429:
+                # Sending again reuses the pending request id, so nothing is duplicated
+                retry_after = response.headers.get("Retry-After", "a few")
+                yield "error", {"error": f"The counselor is busy right now. Please send again in {retry_after} seconds."}
+                return
+            response.raise_for_status()
+            event, data = None, []
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    data.append(line[len("data:"):].strip())
+                elif not line and data:
+                    yield event, json.loads("\n".join(data))
+                    event, data = None, []
+    except requests.exceptions.RequestException as e:
+        yield "error", {"error": f"API Error: {str(e)}"}
+
+# Failures raise instead of returning, so they are never cached
+def get_json(url, params=None):
+    response = get_session().get(url, params=params, timeout=10)
+    response.raise_for_status()
+    data = response.json()
+    if "error" in data:
+        raise requests.exceptions.RequestException(data["error"])
+    return data
+
+@st.cache_data(ttl=HISTORY_CACHE_TTL, show_spinner=False)
+def fetch_chat_history(user_id, cursor=None, limit=None):
+    return get_json(f"{API_BASE_URL}/get-history/{user_id}", {"cursor": cursor, "limit": limit})
+
+@st.cache_data(ttl=HISTORY_CACHE_TTL, show_spinner=False)
+def fetch_search_results(user_id, query, cursor=None):
+    return get_json(f"{API_BASE_URL}/search-history/{user_id}", {"q": query, "cursor": cursor, "limit": HISTORY_PAGE_SIZE})
+
+@st.cache_data(ttl=ACTIVE_USERS_CACHE_TTL, show_spinner=False)
+def fetch_active_users():
+    return get_json(f"{API_BASE_URL}/get-active-users")
+
+def invalidate_cached_data():
+    # A new chat changes the user's history and the active-user list
+    fetch_chat_history.clear()
+    fetch_search_results.clear()
+    fetch_active_users.clear()
+
+def get_chat_history(user_id, cursor=None, limit=None):
+    try:
+        return fetch_chat_history(user_id, cursor, limit)
     except requests.exceptions.RequestException as e:
         st.error(f"API Error: {str(e)}")
         return None
 
-def get_chat_history(user_id):
+def search_chat_history(user_id, query, cursor=None):
     try:
-        response = requests.get(f"{API_BASE_URL}/get-history/{user_id}", timeout=10)
-        response.raise_for_status()
-        return response.json()
+        return fetch_search_results(user_id, query, cursor)
     except requests.exceptions.RequestException as e:
         st.error(f"API Error: {str(e)}")
         return None
 
 def get_faqs_from_history(user_id, last_5_qas):
     try:
-        response = requests.post(
+        response = get_session().post(
             f"{API_BASE_URL}/faqs",
             json={
                 "user_id": user_id,
@@ -101,7 +184,7 @@ def get_faqs_from_history(user_id, last_5_qas):
 
 def change_user(current, new):
     try:
-        response = requests.post(f"{API_BASE_URL}/change-user", json={"current_user_id": current, "new_user_id": new}, timeout=10)
+        response = get_session().post(f"{API_BASE_URL}/change-user", json={"current_user_id": current, "new_user_id": new}, timeout=10)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
@@ -110,16 +193,14 @@ def change_user(current, new):
 
 def get_active_users():
     try:
-        response = requests.get(f"{API_BASE_URL}/get-active-users", timeout=10)
-        response.raise_for_status()
-        return response.json()
+        return fetch_active_users()
     except requests.exceptions.RequestException as e:
         st.error(f"API Error: {str(e)}")
         return None
 
 def submit_contact_message(name, email, message):
     try:
-        response = requests.post(
+        response = get_session().post(
             f"{API_BASE_URL}/contact-us",
             json={
                 "name": name,
@@ -134,12 +215,14 @@ def submit_contact_message(name, email, message):
         return {"error": str(e)}
 
 
-def rate_answer(user_id, question, rating, suggestion=None):
+def rate_answer(user_id, question, rating, suggestion=None, route=None):
     try:
         payload = {"user_id": user_id, "question": question, "rating": rating}
         if suggestion:
             payload["suggestion"] = suggestion
-        response = requests.post(f"{API_BASE_URL}/rate-answer", json=payload, timeout=10)
+        if route:
+            payload["route"] = route
+        response = get_session().post(f"{API_BASE_URL}/rate-answer", json=payload, timeout=10)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
@@ -190,10 +273,27 @@ with tab1:
             if not question.strip():
                 st.warning("Please enter a question.")
             else:
-                with st.spinner("Thinking..."):
-                    result = chat_with_assistant(st.session_state.current_user, question)
+                pending = st.session_state.pending_request
+                if not pending or pending[0] != (st.session_state.current_user, question):
+                    pending = ((st.session_state.current_user, question), uuid.uuid4().hex)
+                    st.session_state.pending_request = pending
+
+                # Render the answer as tokens arrive instead of behind a spinner
+                placeholder = st.empty()
+                placeholder.markdown("_Thinking..._")
+                partial = ""
+                result = None
+                for event, data in stream_chat_with_assistant(st.session_state.current_user, question, pending[1]):
+                    if event == "token":
+                        partial += data["token"]
+                        placeholder.markdown(partial + "▌")
+                    else:
+                        result = data
+                placeholder.empty()
+                invalidate_cached_data()
 
                 if result and "answer" in result:
+                    st.session_state.pending_request = None
                     st.success("### Here's the info:")
 
                     # Remove duplicate lines
@@ -219,6 +319,7 @@ with tab1:
                     # Store for feedback
                     st.session_state.last_question = question
                     st.session_state.last_response = cleaned_answer
+                    st.session_state.last_route = result.get("route")
                     st.session_state.rating_submitted = False
                     st.session_state.suggestion_submitted = False
 
@@ -243,7 +344,8 @@ with tab1:
                         st.session_state.current_user,
                         st.session_state.last_question,
                         rating,
-                        suggestion.strip() if suggestion.strip() else None
+                        suggestion.strip() if suggestion.strip() else None,
+                        st.session_state.get("last_route"),
                     )
 
                     if response and "message" in response:
@@ -264,6 +366,10 @@ with tab2:
             result = change_user(st.session_state.current_user, new_user)
             if result and "message" in result:
                 st.session_state.current_user = new_user
+                st.session_state.history_chats = None
+                st.session_state.history_cursor = None
+                st.session_state.search_results = None
+                st.session_state.search_cursor = None
                 st.success(f"Successfully switched to: {new_user}")
                 st.rerun()
             elif result and "error" in result:
@@ -285,19 +391,65 @@ with tab2:
 with tab3:
     st.header("Chat History Review")
     st.caption(f"Viewing history for: {st.session_state.current_user}")
+
+    # Search runs on the server's index, so nothing is downloaded up front
+    search_query = st.text_input("Search your chats:", key="history_search")
+    if st.button("Search") and search_query.strip():
+        result = search_chat_history(st.session_state.current_user, search_query)
+        if result and "results" in result:
+            st.session_state.search_results = result["results"]
+            st.session_state.search_cursor = result.get("next_cursor")
+            st.session_state.search_total = result.get("total", 0)
+
+    if st.session_state.search_cursor and st.button("More results"):
+        result = search_chat_history(st.session_state.current_user, search_query, st.session_state.search_cursor)
+        if result and "results" in result:
+            st.session_state.search_results.extend(result["results"])
+            st.session_state.search_cursor = result.get("next_cursor")
+            st.rerun()
+
+    if st.session_state.search_results:
+        st.markdown(f"**{st.session_state.search_total} matching chats**")
+        for match in st.session_state.search_results:
+            with st.expander(f" {match['title']}"):
+                st.markdown(f"**Question:**  \n{match['question']}")
+                st.markdown(f"**Answer:**  \n{match['snippet']}")
+    elif st.session_state.search_results is not None:
+        st.info("No chats match your search")
+
+    st.markdown("---")
+    # History is fetched a page at a time, newest first
     if st.button("Load My History"):
-        result = get_chat_history(st.session_state.current_user)
+        st.session_state.history_chats = {}
+        st.session_state.history_cursor = None
+        result = get_chat_history(st.session_state.current_user, limit=HISTORY_PAGE_SIZE)
         if result and "chats" in result:
-            if result["chats"]:
-                for title, chat in result["chats"].items():
-                    with st.expander(f" {title}"):
-                        st.markdown(f"**Question:**  \n{chat['question']}")
-                        st.markdown(f"**Answer:**  \n{chat['answer']}")
-            else:
-                st.info("No chat history found for this user")
+            st.session_state.history_chats = result["chats"]
+            st.session_state.history_cursor = result.get("next_cursor")
+        elif result and "error" in result:
+            st.error(result["error"])
+
+    if st.session_state.history_cursor and st.button("Load older chats"):
+        result = get_chat_history(
+            st.session_state.current_user,
+            cursor=st.session_state.history_cursor,
+            limit=HISTORY_PAGE_SIZE
+        )
+        if result and "chats" in result:
+            st.session_state.history_chats.update(result["chats"])
+            st.session_state.history_cursor = result.get("next_cursor")
+            st.rerun()
         elif result and "error" in result:
             st.error(result["error"])
 
+    if st.session_state.history_chats:
+        for title, chat in st.session_state.history_chats.items():
+            with st.expander(f" {title}"):
+                st.markdown(f"**Question:**  \n{chat['question']}")
+                st.markdown(f"**Answer:**  \n{chat['answer']}")
+    elif st.session_state.history_chats is not None:
+        st.info("No chat history found for this user")
+
 with tab5:
     st.header("Contact Us")
 
@@ -1,9 +1,14 @@
 import streamlit as st
 import requests
 import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Backend API URL
 API_URL = "http://localhost:8000"  # Update if your backend is hosted elsewhere
+# Seconds that fetched history and user lists are reused across reruns
+HISTORY_CACHE_TTL = 120
+ACTIVE_USERS_CACHE_TTL = 30
 
 # Initialize session state
 if 'user_id' not in st.session_state:
@@ -11,30 +16,52 @@ if 'user_id' not in st.session_state:
 if 'viewing_history' not in st.session_state:
     st.session_state.viewing_history = False
 
+# Shared keep-alive session; only idempotent GETs are retried
+@st.cache_resource
+def get_session():
+    session = requests.Session()
+    retry = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(429, 502, 503, 504),
+        allowed_methods=frozenset({"GET"}),
+        respect_retry_after_header=True,
+    )
+    session.mount("http://", HTTPAdapter(max_retries=retry, pool_connections=4, pool_maxsize=10))
+    session.mount("https://", HTTPAdapter(max_retries=retry, pool_connections=4, pool_maxsize=10))
+    return session
+
 # Function to call the backend API
 def chat_with_assistant(user_id, question):
-    response = requests.post(
+    response = get_session().post(
         f"{API_URL}/chat",
         json={"user_id": user_id, "question": question}
     )
+    # The new turn changes this user's history and the active-user list
+    get_chat_history.clear()
+    get_active_users.clear()
     return response.json()
 
-# Function to get chat history
+# Function to get chat history (cached across reruns; errors are not cached)
+@st.cache_data(ttl=HISTORY_CACHE_TTL, show_spinner=False)
 def get_chat_history(user_id):
-    response = requests.get(f"{API_URL}/get-history/{user_id}")
+    response = get_session().get(f"{API_URL}/get-history/{user_id}")
+    response.raise_for_status()
     return response.json()
 
 # Function to change user
 def change_user(current_user_id, new_user_id):
-    response = requests.post(
+    response = get_session().post(
         f"{API_URL}/change-user",
         json={"current_user_id": current_user_id, "new_user_id": new_user_id}
     )
     return response.json()
 
-# Function to get active users
+# Function to get active users (the sidebar asks on every rerun, so it is cached)
+@st.cache_data(ttl=ACTIVE_USERS_CACHE_TTL, show_spinner=False)
 def get_active_users():
-    response = requests.get(f"{API_URL}/get-active-users")
+    response = get_session().get(f"{API_URL}/get-active-users")
+    response.raise_for_status()
     return response.json()
 
 # Main app layout
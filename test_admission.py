@@ -0,0 +1,115 @@
+import asyncio
+
+import pytest
+
+from admission import AdmissionController, Rejected
+
+
+def controller(**kwargs):
+    options = {"max_concurrent": 1, "max_wait": 5, "user_rate": 1000, "user_burst": 1000}
+    options.update(kwargs)
+    return AdmissionController(**options)
+
+
+def test_slots_go_round_robin_across_users():
+    admission = controller()
+    order = []
+
+    async def chat(user_id, label):
+        async with admission.admit(user_id):
+            order.append(label)
+            await asyncio.sleep(0.01)
+
+    async def main():
+        release = await admission.acquire("holder")
+        tasks = []
+        for user_id, label in (("a", "a1"), ("a", "a2"), ("b", "b1")):
+            tasks.append(asyncio.ensure_future(chat(user_id, label)))
+            await asyncio.sleep(0)
+        assert admission.stats()["queued"] == 3
+        release()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+    assert order == ["a1", "b1", "a2"]
+    stats = admission.stats()
+    assert stats["active"] == 0 and stats["queued"] == 0
+    assert stats["admitted"] == 4 and stats["waited"] == 3
+
+
+def test_queue_timeout_rejects_and_leaves_the_queue():
+    admission = controller(max_wait=0.02)
+
+    async def main():
+        release = await admission.acquire("holder")
+        with pytest.raises(Rejected) as rejected:
+            await admission.acquire("a")
+        assert rejected.value.reason == "queue_timeout"
+        assert admission.stats()["queued"] == 0
+        release()
+
+    asyncio.run(main())
+    assert admission.stats()["active"] == 0
+
+
+def test_per_user_queue_limit():
+    admission = controller(max_queue_per_user=1)
+
+    async def main():
+        release = await admission.acquire("holder")
+        waiting = asyncio.ensure_future(admission.acquire("a"))
+        await asyncio.sleep(0)
+        with pytest.raises(Rejected) as rejected:
+            await admission.acquire("a")
+        assert rejected.value.reason == "queue_full"
+        # Another user still gets in line
+        other = asyncio.ensure_future(admission.acquire("b"))
+        await asyncio.sleep(0)
+        assert admission.stats()["queued"] == 2
+        release()
+        (await waiting)()
+        (await other)()
+
+    asyncio.run(main())
+    assert admission.stats()["active"] == 0
+
+
+def test_user_rate_limit():
+    admission = controller(user_rate=0.001, user_burst=1)
+
+    async def main():
+        (await admission.acquire("a"))()
+        with pytest.raises(Rejected) as rejected:
+            await admission.acquire("a")
+        assert rejected.value.reason == "user_rate"
+        assert int(rejected.value.headers()["Retry-After"]) > 1
+        (await admission.acquire("b"))()
+
+    asyncio.run(main())
+
+
+def test_check_user_charges_the_user_but_not_the_shared_slot():
+    admission = controller(user_rate=0.001, user_burst=1)
+
+    async def main():
+        admission.check_user("a")
+        with pytest.raises(Rejected) as rejected:
+            admission.check_user("a")
+        assert rejected.value.reason == "user_rate"
+        # The call the check was made for still gets its slot
+        (await admission.acquire("a", user_limits=False))()
+
+    asyncio.run(main())
+    assert admission.stats()["admitted"] == 1
+
+
+def test_release_is_idempotent():
+    admission = controller(max_concurrent=2)
+
+    async def main():
+        release = await admission.acquire("a")
+        release()
+        release()
+        assert admission.stats()["active"] == 0
+
+    asyncio.run(main())
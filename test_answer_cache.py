@@ -0,0 +1,52 @@
+import pytest
+
+from answer_cache import AnswerCache, same_meaning
+
+
+# Questions whose character shingles overlap enough to pass the MinHash
+# threshold but that ask different things
+DIFFERENT = [
+    ("What is the USMLE step 1 passing score?", "What is the USMLE step 2 passing score?"),
+    ("Which are the best institutes in the USA?", "Which are the best institutes in the UK?"),
+    ("How can I apply for residency as a doctor from India?",
+     "How can I apply for residency as a doctor from Nepal?"),
+    ("Why should I apply for residency as a doctor from India?",
+     "How should I apply for residency as a doctor from India?"),
+    ("When is the USMLE step 1 result released?", "Where is the USMLE step 1 result released?"),
+    ("Which is better for residency, J1 vs H1B visa?", "Which is better for residency, H1B vs J1 visa?"),
+]
+
+SAME = [
+    ("What is the USMLE step 1 passing score?", "what is the usmle step 1 pasing score"),
+    ("Which are the best institutes in the USA?", "Which are the best institutes in the USA"),
+    ("How can I apply for residency as a doctor from India?",
+     "How could I apply for residency as a doctor from India?"),
+    ("Can you tell me how to apply for residency as a doctor from India?",
+     "Please tell me how to apply for residency as a doctor from India?"),
+]
+
+
+@pytest.mark.parametrize("cached, asked", DIFFERENT)
+def test_near_duplicates_with_different_key_terms_miss(cached, asked):
+    cache = AnswerCache()
+    cache.put(cached, "answer")
+    assert cache.get(asked) is None
+    assert cache.near_hits == 0
+
+
+@pytest.mark.parametrize("cached, asked", SAME)
+def test_rewordings_still_hit(cached, asked):
+    cache = AnswerCache()
+    cache.put(cached, "answer")
+    assert cache.get(asked) == "answer"
+
+
+def test_same_meaning_requires_key_terms_in_order():
+    assert same_meaning("j1 vs h1b".split(), "j1 vs h1b".split())
+    assert not same_meaning("j1 vs h1b".split(), "h1b vs j1".split())
+    assert not same_meaning("top 10 programs".split(), "top 20 programs".split())
+    # A different ordinary word is not a misspelling
+    assert not same_meaning("best surgery programs".split(), "worst surgery programs".split())
+    # Question words are kept; only politeness may differ
+    assert not same_meaning("why apply early".split(), "how apply early".split())
+    assert same_meaning("please how apply early".split(), "how apply early".split())
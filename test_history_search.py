@@ -0,0 +1,53 @@
+import json
+import zlib
+
+from fakes import FakeS3Client
+from history_search import HistorySearch, UserIndex
+from storage import S3Storage, make_record
+
+
+def make_search(storage):
+    loads = []
+
+    def load_history(user_id):
+        loads.append(user_id)
+        return storage.load_chat_history(user_id)
+    return HistorySearch(storage, load_history, merge_every=2), loads
+
+
+def save(storage, search, user_id, title, question, answer):
+    records = [make_record(title, question, answer)]
+    storage.save_chats(user_id, records)
+    search.index_records(user_id, records)
+
+
+def test_search_builds_snippets_without_loading_the_history():
+    storage = S3Storage("bucket", client=FakeS3Client())
+    search, loads = make_search(storage)
+    search.search("u1", "visa")  # no base index yet: built from the (empty) history
+    loads.clear()
+    save(storage, search, "u1", "t1", "Which visa do I need?", "Most residents train on a J-1 visa.")
+    save(storage, search, "u1", "t2", "When is the match?", "Match day is in March.")
+    save(storage, search, "u1", "t3", "What about H-1B?", "An H-1B visa needs Step 3.")
+
+    page = search.search("u1", "visa", limit=1)
+    assert loads == []
+    assert page["total"] == 2 and page["next_cursor"] == "1"
+    assert page["results"][0]["title"] == "t1"
+    assert page["results"][0]["question"] == "Which **visa** do I need?"
+    assert "**visa**" in page["results"][0]["snippet"]
+
+
+def test_index_without_text_is_rebuilt_from_the_history():
+    storage = S3Storage("bucket", client=FakeS3Client())
+    storage.save_chats("u1", [make_record("t1", "Which visa do I need?", "A J-1 visa.")])
+    index = UserIndex.from_history(storage.load_chat_history("u1"))
+    data = json.loads(zlib.decompress(index.dumps()))
+    data.update(v=2, docs=["t1"])
+    storage.save_search_index("u1", zlib.compress(json.dumps(data).encode("utf-8")), None)
+
+    search, loads = make_search(storage)
+    assert search.search("u1", "visa")["results"][0]["snippet"] == "A J-1 **visa**."
+    assert loads == ["u1"]
+    raw, _ = storage.load_search_index("u1")
+    assert not UserIndex.loads(raw).missing_text()
@@ -0,0 +1,62 @@
+import asyncio
+import time
+
+import pytest
+
+from resilience import CircuitBreaker, CircuitOpen, DeadlineExceeded, ResilientCaller
+
+
+def open_breaker():
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=0.01)
+    breaker.record(False)
+    time.sleep(0.02)
+    assert breaker.state == "half_open"
+    return breaker
+
+
+def test_spent_deadline_does_not_take_the_trial_call():
+    breaker = open_breaker()
+    caller = ResilientCaller("test", breaker=breaker)
+    with pytest.raises(DeadlineExceeded):
+        caller.call(lambda timeout: "ok", deadline=-1)
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(caller.acall(lambda timeout: asyncio.sleep(0, "ok"), deadline=-1))
+    # The trial is still there for the next call
+    assert caller.call(lambda timeout: "ok") == "ok"
+    assert breaker.state == "closed"
+
+
+def test_trial_call_is_taken_once():
+    breaker = open_breaker()
+    breaker.before_call()
+    with pytest.raises(CircuitOpen):
+        breaker.before_call()
+    breaker.abandon()
+    breaker.before_call()
+
+
+def test_hedge_loser_is_cancelled_and_drained():
+    caller = ResilientCaller("test", hedge=True, hedge_min_delay=0.01)
+    for _ in range(caller.latencies.min_samples):
+        caller.latencies.add(0.01)
+    calls = []
+
+    async def fn(timeout):
+        call = len(calls)
+        calls.append("running")
+        try:
+            await asyncio.sleep(1 if call == 0 else 0.01)
+        except asyncio.CancelledError:
+            calls[call] = "cancelled"
+            raise
+        calls[call] = "done"
+        return call
+
+    async def main():
+        result = await caller.acall(fn)
+        # The loser has unwound by the time the winner is returned
+        assert calls == ["cancelled", "done"]
+        return result
+
+    assert asyncio.run(main()) == 1
+    assert caller.counts["hedge"] == 1 and caller.counts["hedge_win"] == 1
@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+
+from single_flight import SingleFlight
+
+
+def test_concurrent_callers_share_one_call():
+    flights = SingleFlight()
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "answer"
+
+    async def main():
+        return await asyncio.gather(
+            flights.do("q", fn, "u1"),
+            flights.do("q", fn, "u1"),
+            flights.do("q", fn, "u2"),
+        )
+
+    results = asyncio.run(main())
+    assert calls == [1]
+    # Each member saves once; a double submit from u1 does not
+    assert results == [("answer", True), ("answer", False), ("answer", True)]
+    assert flights.stats() == {"in_flight": 0, "started": 1, "coalesced": 2}
+
+
+def test_failure_reaches_every_caller_and_ends_the_flight():
+    flights = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream failed")
+
+    async def main():
+        results = await asyncio.gather(flights.do("q", fail, "u1"), flights.do("q", fail, "u2"),
+                                       return_exceptions=True)
+        assert all(isinstance(r, ValueError) for r in results)
+        # The next caller starts a new flight
+        assert await flights.do("q", lambda: asyncio.sleep(0, "retried"), "u1") == ("retried", True)
+
+    asyncio.run(main())
+
+
+def test_cancelled_caller_does_not_cancel_the_shared_call():
+    flights = SingleFlight()
+
+    async def fn():
+        await asyncio.sleep(0.05)
+        return "answer"
+
+    async def main():
+        first = asyncio.ensure_future(flights.do("q", fn, "u1"))
+        second = asyncio.ensure_future(flights.do("q", fn, "u2"))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(main()) == ("answer", True)
+
+
+def test_stream_replays_every_token_to_late_joiners():
+    flights = SingleFlight()
+    sources = []
+
+    async def source():
+        sources.append(1)
+        for token in ("a", "b", "c"):
+            await asyncio.sleep(0.01)
+            yield token
+
+    async def consume(member, delay=0.0):
+        await asyncio.sleep(delay)
+        tokens, first = flights.stream("q", source, member)
+        return [t async for t in tokens], first
+
+    async def main():
+        return await asyncio.gather(consume("u1"), consume("u2", 0.015))
+
+    assert asyncio.run(main()) == [(["a", "b", "c"], True), (["a", "b", "c"], True)]
+    assert sources == [1]
@@ -0,0 +1,59 @@
+from fakes import FakeS3Client
+from storage import S3Storage, apply_batch, make_record
+
+
+def s3_storage(client, **kwargs):
+    return S3Storage("bucket", client=client, compact_threshold=3, **kwargs)
+
+
+def save(storage, user_id, *titles):
+    for title in titles:
+        storage.save_chats(user_id, [make_record(title, f"q {title}", f"a {title}")])
+
+
+def log_keys(client, user_id):
+    return [key for key in client.objects if key.startswith(f"log/{user_id}/")]
+
+
+def test_compaction_folds_the_log_into_the_snapshot():
+    client = FakeS3Client()
+    storage = s3_storage(client)
+    save(storage, "u1", "t1", "t2")
+    assert not storage.needs_compaction("u1")
+    save(storage, "u1", "t3")
+    assert storage.needs_compaction("u1")
+
+    storage.compact("u1")
+    assert log_keys(client, "u1") == []
+    assert "u1.json" in client.objects
+    assert list(s3_storage(client).load_chat_history("u1")) == ["t1", "t2", "t3"]
+
+
+def test_compaction_that_lost_the_race_keeps_newer_turns():
+    client = FakeS3Client()
+    ours, theirs = s3_storage(client), s3_storage(client)
+    save(ours, "u1", "t1", "t2", "t3")
+    ours.compact("u1")
+    save(ours, "u1", "t4", "t5", "t6")
+    key, prefix = ours.get_key("u1"), ours.get_log_prefix("u1")
+    state, _, etag, keys = ours.replay_log(key, prefix, apply_batch)
+
+    # Another container stores a newer turn and compacts it into the
+    # snapshot first; replacing that snapshot with ours would lose t7
+    save(theirs, "u1", "t7")
+    theirs.compact("u1")
+    assert ours.write_snapshot(key, state, etag) is False
+    ours.compact_log(key, state, etag, keys)
+
+    assert list(s3_storage(client).load_chat_history("u1")) == ["t1", "t2", "t3", "t4", "t5", "t6", "t7"]
+    assert log_keys(client, "u1") == []
+
+
+def test_readonly_load_writes_nothing():
+    client = FakeS3Client()
+    storage = s3_storage(client)
+    save(storage, "u1", "t1", "t2", "t3")
+    client.reset_counters()
+
+    assert list(s3_storage(client).load_chat_history_readonly("u1")) == ["t1", "t2", "t3"]
+    assert client.calls["PutObject"] == 0 and client.calls["DeleteObjects"] == 0
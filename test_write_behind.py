@@ -0,0 +1,113 @@
+import threading
+
+from storage import ChatStorage
+from write_behind import WriteBehindQueue
+
+
+class GatedStorage(ChatStorage):
+    """Stores batches in memory; each write waits for ``gate`` and the first ``failures`` raise."""
+
+    def __init__(self, failures: int = 0, compact_error: bool = False):
+        self.batches = []
+        self.failures = failures
+        self.compact_error = compact_error
+        self.compactions = 0
+        self.gate = threading.Event()
+        self.gate.set()
+        self.writing = threading.Event()
+
+    def save_chats(self, user_id, records):
+        self.writing.set()
+        self.gate.wait()
+        if self.failures:
+            self.failures -= 1
+            raise IOError("write failed")
+        self.batches.append((user_id, [r["title"] for r in records]))
+
+    def needs_compaction(self, user_id):
+        return True
+
+    def compact(self, user_id):
+        self.compactions += 1
+        if self.compact_error:
+            raise IOError("compaction failed")
+
+
+def make_queue(storage):
+    return WriteBehindQueue(storage, max_retries=1, base_delay=0, max_delay=0.01)
+
+
+def test_failed_write_is_requeued_ahead_of_newer_turns():
+    storage = GatedStorage(failures=1)
+    storage.gate.clear()
+    queue = make_queue(storage)
+    queue.submit("u1", "t1", "q1", "a1")
+    assert storage.writing.wait(5)
+    queue.submit("u1", "t2", "q2", "a2")
+    storage.gate.set()
+
+    assert queue.flush(5)
+    assert storage.batches == [("u1", ["t1", "t2"])]
+    assert queue.stats()["write_failures"] == 1
+
+
+def test_reads_see_queued_and_in_flight_turns():
+    storage = GatedStorage()
+    storage.gate.clear()
+    queue = make_queue(storage)
+    queue.submit("u1", "t1", "q1", "a1")
+    assert storage.writing.wait(5)
+    queue.submit("u1", "t2", "q2", "a2")
+
+    chats, version = queue.overlay("u1", {"t0": {"question": "q0", "answer": "a0"}}, "v0")
+    assert list(chats) == ["t0", "t1", "t2"]
+    assert chats["t2"] == {"question": "q2", "answer": "a2"}
+    assert version != "v0"
+    assert queue.overlay("u2", {}, "v0") == ({}, "v0")
+
+    storage.gate.set()
+    assert queue.flush(5)
+    assert queue.pending("u1") == []
+
+
+def test_flush_times_out_while_a_write_is_stuck():
+    storage = GatedStorage()
+    storage.gate.clear()
+    queue = make_queue(storage)
+    queue.submit("u1", "t1", "q1", "a1")
+
+    assert not queue.flush(0.05)
+    assert queue.stats()["inflight_turns"] == 1
+    storage.gate.set()
+    assert queue.flush(5)
+    assert storage.batches == [("u1", ["t1"])]
+
+
+def test_failed_compaction_does_not_write_the_batch_again():
+    storage = GatedStorage(compact_error=True)
+    queue = make_queue(storage)
+    stored = []
+    queue.add_listener(lambda user_id, records: stored.append(len(records)))
+    queue.submit("u1", "t1", "q1", "a1")
+
+    assert queue.flush(5)
+    assert storage.batches == [("u1", ["t1"])]
+    assert storage.compactions == 1
+    assert stored == [1]
+    stats = queue.stats()
+    assert stats["compaction_failures"] == 1
+    assert stats["write_failures"] == 0
+
+
+def test_write_now_stores_compacts_and_notifies_before_returning():
+    storage = GatedStorage(failures=1)
+    queue = make_queue(storage)
+    queue.max_retries = 2
+    stored = []
+    queue.add_listener(lambda user_id, records: stored.append(user_id))
+
+    queue.write_now("u1", [{"title": "t1", "question": "q1", "answer": "a1"}])
+    assert storage.batches == [("u1", ["t1"])]
+    assert storage.compactions == 1
+    assert stored == ["u1"]
+    assert queue.stats()["turns_written"] == 1
@@ -0,0 +1,167 @@
+"""Write-behind queue for chat turns.
+
+Routes hand finished turns to ``WriteBehindQueue.submit`` and return
+immediately; a background thread persists them, writing every turn queued
+for the same user in one ``save_chats`` call. Failed writes are retried
+with jittered exponential backoff and stay queued until they succeed, and
+``flush`` blocks until everything queued so far is stored (call it on
+shutdown and before a Lambda invocation returns). Turns that are queued or
+in flight are overlaid on reads so a user always sees their own writes.
+After a batch is stored the worker compacts the user's log if it is due;
+a failed compaction is logged and left for the user's next write, and
+never makes the stored batch count as failed.
+Functions registered with ``add_listener`` are called with each batch once
+it is stored (e.g. to update a search index); ``flush`` waits for them too.
+"""
+import logging
+import random
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List
+
+from metrics import timed
+from storage import ChatStorage, apply_record, history_version, make_record
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindQueue:
+    def __init__(self, storage: ChatStorage, max_retries: int = 5,
+                 base_delay: float = 0.2, max_delay: float = 5.0):
+        self.storage = storage
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._pending: Dict[str, List[Dict]] = defaultdict(list)
+        self._inflight: Dict[str, List[Dict]] = {}
+        self._cond = threading.Condition()
+        self._worker = None
+        self._listeners: List[Callable[[str, List[Dict]], None]] = []
+        self.batches_written = 0
+        self.turns_written = 0
+        self.write_failures = 0
+        self.compaction_failures = 0
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self._worker.start()
+
+    def add_listener(self, listener: Callable[[str, List[Dict]], None]):
+        """Call ``listener(user_id, records)`` on the writer thread after each stored batch."""
+        self._listeners.append(listener)
+
+    def submit(self, user_id: str, title: str, question: str, answer: str, request_id: str = None,
+               faq: bool = True):
+        with self._cond:
+            self._pending[user_id].append(make_record(title, question, answer, request_id, faq))
+            self._ensure_worker()
+            self._cond.notify_all()
+
+    def pending(self, user_id: str) -> List[Dict]:
+        """Turns for ``user_id`` that are not yet confirmed written, oldest first."""
+        with self._cond:
+            return list(self._inflight.get(user_id, [])) + list(self._pending.get(user_id, []))
+
+    def overlay(self, user_id: str, chats: Dict, version: str):
+        """Apply not-yet-written turns to a loaded history and adjust its version."""
+        records = self.pending(user_id)
+        for record in records:
+            apply_record(chats, record)
+        if records:
+            version = history_version(version, *(r["title"] for r in records), len(records))
+        return chats, version
+
+    def _write(self, user_id: str, records: List[Dict]) -> bool:
+        for attempt in range(self.max_retries):
+            try:
+                with timed("storage_write"):
+                    self.storage.save_chats(user_id, records)
+                return True
+            except Exception:
+                self.write_failures += 1
+                delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+                logger.exception("Writing %d turn(s) for %s failed (attempt %d)", len(records), user_id, attempt + 1)
+                time.sleep(random.uniform(0, delay))
+        return False
+
+    def write_now(self, user_id: str, records: List[Dict]):
+        """Store ``records`` on the calling thread the way the worker does; raises if every attempt fails.
+
+        For jobs that must know a turn is stored before they move on: the
+        write is retried, the log compacted when due and listeners called.
+        """
+        if not self._write(user_id, records):
+            raise IOError(f"Writing {len(records)} turn(s) for {user_id} failed")
+        self._compact(user_id)
+        self._notify(user_id, records)
+        with self._cond:
+            self.batches_written += 1
+            self.turns_written += len(records)
+
+    def _compact(self, user_id: str):
+        # The batch is already stored, so retrying here could only append it
+        # again; compaction stays due and the user's next write tries again
+        try:
+            if self.storage.needs_compaction(user_id):
+                with timed("storage_compact"):
+                    self.storage.compact(user_id)
+        except Exception:
+            self.compaction_failures += 1
+            logger.exception("Compacting the history of %s failed", user_id)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                user_id, records = next(iter(self._pending.items()))
+                del self._pending[user_id]
+                self._inflight[user_id] = records
+            ok = self._write(user_id, records)
+            if ok:
+                self._compact(user_id)
+                self._notify(user_id, records)
+            with self._cond:
+                del self._inflight[user_id]
+                if ok:
+                    self.batches_written += 1
+                    self.turns_written += len(records)
+                else:
+                    # Keep the turns, ahead of anything queued since, for the next pass
+                    self._pending[user_id] = records + self._pending.get(user_id, [])
+                self._cond.notify_all()
+            if not ok:
+                time.sleep(self.max_delay)
+
+    def _notify(self, user_id: str, records: List[Dict]):
+        for listener in self._listeners:
+            try:
+                listener(user_id, records)
+            except Exception:
+                # The turns are stored; a failed listener must not write them again
+                logger.exception("Write listener %r failed for %s", listener, user_id)
+
+    def flush(self, timeout: float = None) -> bool:
+        """Wait until every queued turn is written; False if ``timeout`` ran out."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._inflight:
+                self._ensure_worker()
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stats(self) -> Dict:
+        with self._cond:
+            return {
+                "queued_turns": sum(len(r) for r in self._pending.values()),
+                "inflight_turns": sum(len(r) for r in self._inflight.values()),
+                "batches_written": self.batches_written,
+                "turns_written": self.turns_written,
+                "write_failures": self.write_failures,
+                "compaction_failures": self.compaction_failures,
+            }